@@ -0,0 +1,43 @@
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.orm import Session as DBSession
+from typing import List, Optional
+
+from app.models.schemas import LatencyStat, OutputRecord, ModelSummary
+from app.models.database import get_db
+from app.services.analytics_service import analytics_service
+
+router = APIRouter(prefix="/api/analytics", tags=["analytics"])
+
+
+@router.get("/latency", response_model=List[LatencyStat])
+async def get_latency_stats(
+    model: Optional[str] = None,
+    pose_id: Optional[str] = None,
+    since: Optional[int] = Query(None, description="起始时间（毫秒时间戳）"),
+    until: Optional[int] = Query(None, description="结束时间（毫秒时间戳）"),
+    db: DBSession = Depends(get_db),
+):
+    """按模型和姿势统计生成耗时"""
+    return analytics_service.latency_stats(db, model, pose_id, since, until)
+
+
+@router.get("/outputs/largest", response_model=List[OutputRecord])
+async def get_largest_outputs(
+    limit: int = Query(20, ge=1, le=500),
+    model: Optional[str] = None,
+    since: Optional[int] = Query(None, description="起始时间（毫秒时间戳）"),
+    until: Optional[int] = Query(None, description="结束时间（毫秒时间戳）"),
+    db: DBSession = Depends(get_db),
+):
+    """占用空间最大的生成图片"""
+    return analytics_service.largest(db, limit, model, since, until)
+
+
+@router.get("/summary", response_model=List[ModelSummary])
+async def get_summary(
+    since: Optional[int] = Query(None, description="起始时间（毫秒时间戳）"),
+    until: Optional[int] = Query(None, description="结束时间（毫秒时间戳）"),
+    db: DBSession = Depends(get_db),
+):
+    """按模型汇总生成数量、失败率、平均耗时和存储占用"""
+    return analytics_service.summary(db, since, until)
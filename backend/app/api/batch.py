@@ -0,0 +1,136 @@
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends
+from sqlalchemy.orm import Session as DBSession
+import asyncio
+import json
+import os
+import uuid
+from pathlib import Path
+
+from app.models.schemas import BatchJobStatus, ModelTier
+from app.models.database import BatchJob, get_db
+from app.services.batch_service import batch_service, MAX_MANIFEST_SIZE
+from app.services.image_service import image_service, UploadBudget, UploadValidationError
+from app.services.storage_service import storage_service
+
+router = APIRouter(prefix="/api", tags=["batch"])
+
+
+@router.post("/batch", response_model=BatchJobStatus)
+async def create_batch_job(
+    # 所有套装共用的参考图片
+    styling_ref: UploadFile = File(..., description="造型参考图"),
+    face_ref: UploadFile = File(..., description="面部参考图"),
+    # 服装清单与图片归档
+    manifest: UploadFile = File(..., description="服装清单，CSV 或 JSON"),
+    archive: UploadFile = File(..., description="服装和配饰图片的 zip 归档"),
+    # 参数
+    gender: str = Form(..., description="性别: female 或 male"),
+    background_mode: str = Form(..., description="背景模式: white 或 keep_original"),
+    selected_poses: str = Form(
+        "[]", description="默认姿势 ID 列表，JSON 格式；manifest 中未指定 poses 的套装使用"
+    ),
+    selected_model: str = Form(
+        "gemini-3-pro-image-preview", description="模型: gemini-3-pro-image-preview 或 gemini-2.5-flash-image"
+    ),
+    # 数据库会话
+    db: DBSession = Depends(get_db),
+):
+    """
+    创建目录批量生成任务
+
+    manifest 的每一行是一套服装，展开为 套装 × 姿势 后在后台以受控并发生成，
+    每套服装完成后写入历史记录。
+    """
+    job_id = str(uuid.uuid4())
+    job_dir = batch_service.job_dir(job_id)
+    Path(job_dir).mkdir(parents=True, exist_ok=True)
+
+    try:
+        default_poses = json.loads(selected_poses)
+        if not isinstance(default_poses, list):
+            raise HTTPException(status_code=400, detail="selected_poses must be a JSON list")
+        if selected_model not in {tier.value for tier in ModelTier}:
+            raise HTTPException(status_code=400, detail=f"Unsupported model: {selected_model}")
+
+        # 保存参考图与归档
+        budget = UploadBudget()
+        styling_ref_path = await image_service.save_upload_stream(styling_ref, budget, job_dir)
+        face_ref_path = await image_service.save_upload_stream(face_ref, budget, job_dir)
+
+        # 最多读取上限 + 1 字节，超出部分不进入内存，由 parse_manifest 拒绝
+        looks = batch_service.parse_manifest(
+            await manifest.read(MAX_MANIFEST_SIZE + 1), manifest.filename
+        )
+
+        archive_path = await batch_service.save_archive(archive, job_dir)
+        archive_files = await asyncio.to_thread(
+            batch_service.extract_archive, archive_path, batch_service.garments_dir(job_id)
+        )
+        storage_service.delete([archive_path])
+
+        job = batch_service.create_job(
+            db,
+            job_id=job_id,
+            looks=looks,
+            archive_files=archive_files,
+            default_poses=default_poses,
+            gender=gender,
+            background_mode=background_mode,
+            model=selected_model,
+            inputs={
+                "styling_ref": styling_ref.filename,
+                "face_ref": face_ref.filename,
+                "styling_ref_path": os.path.basename(styling_ref_path),
+                "face_ref_path": os.path.basename(face_ref_path),
+                "manifest": manifest.filename,
+            },
+        )
+
+        batch_service.start(job_id)
+
+        return batch_service.get_status(db, job)
+
+    except HTTPException:
+        storage_service.delete([job_dir])
+        raise
+
+    except UploadValidationError as e:
+        storage_service.delete([job_dir])
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+    except Exception as e:
+        storage_service.delete([job_dir])
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/batch/{job_id}", response_model=BatchJobStatus)
+async def get_batch_job(
+    job_id: str,
+    db: DBSession = Depends(get_db),
+):
+    """获取批量任务进度（含吞吐量和预计剩余时间）"""
+    job = db.query(BatchJob).filter(BatchJob.id == job_id).first()
+
+    if not job:
+        raise HTTPException(status_code=404, detail="Batch job not found")
+
+    return batch_service.get_status(db, job)
+
+
+@router.post("/batch/{job_id}/retry", response_model=BatchJobStatus)
+async def retry_batch_job(
+    job_id: str,
+    db: DBSession = Depends(get_db),
+):
+    """重新生成批量任务中失败的项"""
+    job = db.query(BatchJob).filter(BatchJob.id == job_id).first()
+
+    if not job:
+        raise HTTPException(status_code=404, detail="Batch job not found")
+
+    if job.status == "running":
+        raise HTTPException(status_code=409, detail="Batch job is still running")
+
+    batch_service.retry_failed(db, job)
+
+    return batch_service.get_status(db, job)
@@ -0,0 +1,121 @@
+from fastapi import APIRouter, HTTPException, Depends, Header, Query, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session as DBSession
+from typing import List, Optional
+import asyncio
+
+from app.config import settings
+from app.models.database import Session as SessionModel, get_db
+from app.services.export_service import export_service, RangeNotSatisfiable
+from app.services.retention_service import retention_service
+
+router = APIRouter(prefix="/api", tags=["export"])
+
+
+@router.get("/export")
+async def export_sessions(
+    session_id: Optional[List[str]] = Query(None, description="要导出的会话 ID，可重复"),
+    start: Optional[int] = Query(None, description="起始时间（毫秒时间戳，包含）"),
+    end: Optional[int] = Query(None, description="结束时间（毫秒时间戳，不包含）"),
+    range: Optional[str] = Header(None),
+    if_range: Optional[str] = Header(None),
+    db: DBSession = Depends(get_db),
+):
+    """
+    导出会话为 ZIP（生成图片 + manifest.json）
+
+    按会话 ID 或时间范围选择会话。归档边读边发送，支持 Range / If-Range 断点续传。
+    """
+    try:
+        if not session_id and start is None and end is None:
+            raise HTTPException(
+                status_code=400, detail="Specify session_id or a start/end time range"
+            )
+
+        query = db.query(SessionModel)
+        if session_id:
+            query = query.filter(SessionModel.id.in_(session_id))
+        if start is not None:
+            query = query.filter(SessionModel.timestamp >= start)
+        if end is not None:
+            query = query.filter(SessionModel.timestamp < end)
+
+        sessions = query.order_by(SessionModel.timestamp).limit(settings.export_max_sessions + 1).all()
+        if len(sessions) > settings.export_max_sessions:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Export is limited to {settings.export_max_sessions} sessions",
+            )
+
+        return await _export_response(sessions, range, if_range)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/history/{session_id}/export")
+async def export_session(
+    session_id: str,
+    range: Optional[str] = Header(None),
+    if_range: Optional[str] = Header(None),
+    db: DBSession = Depends(get_db),
+):
+    """导出单个会话为 ZIP"""
+    try:
+        session = db.query(SessionModel).filter(SessionModel.id == session_id).first()
+
+        if not session:
+            raise HTTPException(status_code=404, detail="Session not found")
+
+        return await _export_response([session], range, if_range)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def _export_response(
+    sessions: List[SessionModel], range_header: Optional[str], if_range: Optional[str]
+) -> Response:
+    if not sessions:
+        raise HTTPException(status_code=404, detail="No sessions to export")
+
+    for session in sessions:
+        retention_service.touch(session.id)
+
+    # 只读取文件元数据，确定归档大小和 ETag
+    archive = await asyncio.to_thread(export_service.build, sessions)
+
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": archive.etag,
+        "Content-Disposition": f'attachment; filename="{export_service.filename(sessions)}"',
+    }
+
+    # If-Range 与当前归档不一致（会话已变化）时忽略 Range，返回完整归档
+    byte_range = None
+    if range_header and (not if_range or if_range.strip() == archive.etag):
+        try:
+            byte_range = export_service.parse_range(range_header, archive.size)
+        except RangeNotSatisfiable:
+            headers["Content-Range"] = f"bytes */{archive.size}"
+            return Response(status_code=416, headers=headers)
+
+    if byte_range:
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{archive.size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(
+            export_service.stream(archive, start, end),
+            status_code=206,
+            media_type="application/zip",
+            headers=headers,
+        )
+
+    headers["Content-Length"] = str(archive.size)
+    return StreamingResponse(
+        export_service.stream(archive), media_type="application/zip", headers=headers
+    )
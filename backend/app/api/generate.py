@@ -1,22 +1,38 @@
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends
+from fastapi import APIRouter, UploadFile, File, Form, Header, HTTPException, Depends, Response
 from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session as DBSession
-from typing import List, Optional
-import time
+from typing import Dict, List, Optional, Tuple
 import uuid
 import json
 import asyncio
-
-from app.models.schemas import GenerateResponse, ErrorResponse
+import hashlib
+
+from app.models.schemas import (
+    GenerateResponse,
+    ErrorResponse,
+    RegenerateRequest,
+    ModelTier,
+)
+from app.config import settings
 from app.models.database import Session as SessionModel, get_db
-from app.services.gemini_service import gemini_service
-from app.services.image_service import image_service
+from app.services.admission_service import admission_service, AdmissionRejected, Ticket
+from app.services.generation_pipeline import (
+    generation_pipeline,
+    regeneration_pipeline,
+    GenerationContext,
+    RegenerationContext,
+)
+from app.services.idempotency_service import idempotency_service, IdempotencyConflict
+from app.services.image_service import image_service, UploadBudget, UploadValidationError
+from app.services.progress_service import progress_service, ProgressChannel
+from app.services.retention_service import retention_service
 
 router = APIRouter(prefix="/api", tags=["generate"])
 
 
 @router.post("/generate", response_model=GenerateResponse)
 async def generate_fashion_images(
+    response: Response,
     # 必需的参考图片
     styling_ref: UploadFile = File(..., description="造型参考图"),
     face_ref: UploadFile = File(..., description="面部参考图"),
@@ -27,6 +43,7 @@ async def generate_fashion_images(
     selected_model: str = Form(
         "gemini-3-pro-image-preview", description="模型: gemini-3-pro-image-preview 或 gemini-2.5-flash-image"
     ),
+    candidates_per_pose: int = Form(1, description="每个姿势生成的候选图片数量"),
     # 可选的服装图片
     top: Optional[UploadFile] = File(None),
     bottom: Optional[UploadFile] = File(None),
@@ -39,58 +56,43 @@ async def generate_fashion_images(
     hat: Optional[UploadFile] = File(None),
     bag: Optional[UploadFile] = File(None),
     belt: Optional[UploadFile] = File(None),
+    # 幂等键：重试时返回原结果或挂到进行中的生成上
+    idempotency_key: Optional[str] = Header(None),
     # 数据库会话
     db: DBSession = Depends(get_db),
 ):
     """
     生成时尚造型图片
 
-    接收用户上传的参考图片和参数，调用 Gemini API 生成时尚造型图片
+    接收用户上传的参考图片和参数，调用 Gemini API 生成时尚造型图片。
+    相同 Idempotency-Key 的重试、以及内容完全相同的并发请求只会触发一次生成。
     """
+    uploaded_files = []
+
     try:
         # 解析姿势列表
         pose_ids = json.loads(selected_poses)
         if not pose_ids or len(pose_ids) > 3:
             raise HTTPException(status_code=400, detail="Must select 1-3 poses")
+        if not 1 <= candidates_per_pose <= settings.max_candidates_per_pose:
+            raise HTTPException(
+                status_code=400,
+                detail=f"candidates_per_pose must be between 1 and {settings.max_candidates_per_pose}",
+            )
+        if selected_model not in {tier.value for tier in ModelTier}:
+            raise HTTPException(status_code=400, detail=f"Unsupported model: {selected_model}")
 
-        # 生成会话 ID
-        session_id = str(uuid.uuid4())
-        timestamp = int(time.time() * 1000)
-
-        # 保存上传的文件
-        uploaded_files = []
-
-        # 保存必需的参考图
-        styling_ref_path = await image_service.save_upload(
-            await styling_ref.read(), styling_ref.filename
-        )
-        uploaded_files.append(styling_ref_path)
-
-        face_ref_path = await image_service.save_upload(
-            await face_ref.read(), face_ref.filename
-        )
-        uploaded_files.append(face_ref_path)
-
-        # 加载参考图
-        styling_img = await image_service.load_image(styling_ref_path)
-        face_img = await image_service.load_image(face_ref_path)
-
-        # 处理服装图片
-        clothes = {}
+        # 分块保存上传的文件（边读边校验格式和大小，同时计算内容摘要）
+        budget = UploadBudget()
+        upload_paths = {}
+        digests = {}
         for name, file in [
+            ("styling_ref", styling_ref),
+            ("face_ref", face_ref),
             ("top", top),
             ("bottom", bottom),
             ("shoes", shoes),
             ("sunglasses", sunglasses),
-        ]:
-            if file:
-                path = await image_service.save_upload(await file.read(), file.filename)
-                uploaded_files.append(path)
-                clothes[name] = await image_service.load_image(path)
-
-        # 处理配饰图片
-        accessories = {}
-        for name, file in [
             ("necklace", necklace),
             ("earrings", earrings),
             ("jewelry", jewelry),
@@ -99,70 +101,78 @@ async def generate_fashion_images(
             ("belt", belt),
         ]:
             if file:
-                path = await image_service.save_upload(await file.read(), file.filename)
+                digest = hashlib.sha256()
+                path = await image_service.save_upload_stream(file, budget, digest=digest)
                 uploaded_files.append(path)
-                accessories[name] = await image_service.load_image(path)
-
-        # 调用 Gemini 生成图片
-        generated_images = await gemini_service.generate_batch(
-            styling_ref=styling_img,
-            face_ref=face_img,
-            pose_ids=pose_ids,
-            gender=gender,
-            background_mode=background_mode,
-            clothes=clothes if clothes else None,
-            accessories=accessories if accessories else None,
-            model=selected_model,
-        )
-
-        # 保存生成的图片
-        output_urls = []
-        for idx, img_bytes in enumerate(generated_images):
-            url = await image_service.save_generated_image(img_bytes, session_id, idx)
-            output_urls.append(url)
-
-        # 创建缩略图
-        thumbnail_url = None
-        if generated_images:
-            thumbnail_bytes = await image_service.create_thumbnail(generated_images[0])
-            thumbnail_url = await image_service.save_generated_image(
-                thumbnail_bytes, session_id, "thumb"
+                upload_paths[name] = path
+                digests[name] = digest.hexdigest()
+
+        parameters = {
+            "gender": gender,
+            "background_mode": background_mode,
+            "pose_ids": pose_ids,
+            "model": selected_model,
+            "candidates_per_pose": candidates_per_pose,
+        }
+        fingerprint = idempotency_service.fingerprint(parameters, digests)
+
+        # 同一 Idempotency-Key 已完成：直接返回原结果
+        if idempotency_key:
+            session_id = idempotency_service.lookup(db, idempotency_key, fingerprint)
+            if session_id:
+                session = db.query(SessionModel).filter(SessionModel.id == session_id).first()
+                if session:
+                    await image_service.cleanup_uploads(uploaded_files)
+                    response.headers["Idempotent-Replayed"] = "true"
+                    return _session_response(session)
+
+        # 相同内容正在生成：挂到已有任务上，否则启动新任务
+        task = idempotency_service.attach(fingerprint, idempotency_key)
+        if task:
+            await image_service.cleanup_uploads(uploaded_files)
+            response.headers["Idempotent-Replayed"] = "true"
+        else:
+            # 申请生成槽位，队列已满时直接拒绝
+            ticket = admission_service.enqueue(
+                selected_model, admission_service.lane_for(len(pose_ids) * candidates_per_pose)
             )
+            _, task = _start_generation(
+                ticket,
+                upload_paths=upload_paths,
+                filenames={"styling_ref": styling_ref.filename, "face_ref": face_ref.filename},
+                parameters=parameters,
+                fingerprint=fingerprint,
+                idempotency_key=idempotency_key,
+            )
+        # 上传文件交由生成任务清理
+        uploaded_files = []
 
-        # 保存到数据库
-        session_record = SessionModel(
-            id=session_id,
-            timestamp=timestamp,
-            gender=gender,
-            background_mode=background_mode,
-            pose_ids=pose_ids,
-            model=selected_model,
-            inputs={
-                "styling_ref": styling_ref.filename,
-                "face_ref": face_ref.filename,
-                "clothes": {k: True for k in clothes.keys()},
-                "accessories": {k: True for k in accessories.keys()},
-            },
-            outputs=output_urls,
-            thumbnail=thumbnail_url,
-        )
-        db.add(session_record)
-        db.commit()
-
-        # 清理上传的临时文件
-        await image_service.cleanup_uploads(uploaded_files)
-
-        return GenerateResponse(
-            session_id=session_id,
-            outputs=output_urls,
-            parameters={
-                "gender": gender,
-                "background_mode": background_mode,
-                "pose_ids": pose_ids,
-                "model": selected_model,
-            },
-            timestamp=timestamp,
-        )
+        # 客户端断开时不取消生成，其他挂在同一任务上的请求仍需要结果
+        return await asyncio.shield(task)
+
+    except HTTPException:
+        if uploaded_files:
+            await image_service.cleanup_uploads(uploaded_files)
+        raise
+
+    except UploadValidationError as e:
+        # 上传文件不合法（格式错误或超出大小限制）
+        if uploaded_files:
+            await image_service.cleanup_uploads(uploaded_files)
+
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+    except IdempotencyConflict as e:
+        if uploaded_files:
+            await image_service.cleanup_uploads(uploaded_files)
+
+        raise HTTPException(status_code=422, detail=str(e))
+
+    except AdmissionRejected as e:
+        if uploaded_files:
+            await image_service.cleanup_uploads(uploaded_files)
+
+        raise _busy(e)
 
     except Exception as e:
         # 清理上传的文件
@@ -172,6 +182,69 @@ async def generate_fashion_images(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _start_generation(
+    ticket: Ticket,
+    upload_paths: Dict[str, str],
+    filenames: Dict[str, str],
+    parameters: Dict,
+    fingerprint: str,
+    idempotency_key: Optional[str],
+) -> Tuple[ProgressChannel, asyncio.Task]:
+    """
+    在后台启动生成（/generate 和 /generate/stream 共用）
+
+    生成任务登记在 idempotency_service 中，进度发布到会话的事件缓冲：
+    两个接口的相同 key 或相同内容都会挂到同一次生成上，可以等待结果，也可以订阅进度流。
+    """
+    channel = progress_service.create(str(uuid.uuid4()), fingerprint)
+    channel.task = idempotency_service.start(
+        fingerprint,
+        idempotency_key,
+        _run_generation(channel, ticket, upload_paths, filenames, parameters),
+    )
+    return channel, channel.task
+
+
+async def _run_generation(
+    channel: ProgressChannel,
+    ticket: Ticket,
+    upload_paths: Dict[str, str],
+    filenames: Dict[str, str],
+    parameters: Dict,
+) -> GenerateResponse:
+    """执行一次完整生成，将进度发布到会话的事件缓冲，并返回结果"""
+    session_id = channel.session_id
+
+    try:
+        session = await generation_pipeline.run(
+            GenerationContext(upload_paths, filenames, parameters, session_id=session_id),
+            ticket,
+            on_event=channel.publish,
+        )
+
+        # 完成
+        channel.publish(_completed_event(session))
+        return _session_response(session)
+
+    except Exception as e:
+        channel.publish({'status': 'error', 'message': str(e), 'session_id': session_id})
+        raise
+
+    finally:
+        channel.close()
+
+
+def _session_response(session: SessionModel) -> GenerateResponse:
+    """根据已保存的会话构造生成结果"""
+    return GenerateResponse(
+        session_id=session.id,
+        outputs=session.outputs,
+        parameters=session.parameters(),
+        timestamp=session.timestamp,
+        poses=session.pose_results(),
+    )
+
+
 @router.post("/generate/stream")
 async def generate_fashion_images_stream(
     # 必需的参考图片
@@ -184,6 +257,7 @@ async def generate_fashion_images_stream(
     selected_model: str = Form(
         "gemini-3-pro-image-preview", description="模型: gemini-3-pro-image-preview 或 gemini-2.5-flash-image"
     ),
+    candidates_per_pose: int = Form(1, description="每个姿势生成的候选图片数量"),
     # 可选的服装图片
     top: Optional[UploadFile] = File(None),
     bottom: Optional[UploadFile] = File(None),
@@ -196,163 +270,188 @@ async def generate_fashion_images_stream(
     hat: Optional[UploadFile] = File(None),
     bag: Optional[UploadFile] = File(None),
     belt: Optional[UploadFile] = File(None),
+    # 幂等键：重试时回放原结果或订阅进行中的生成
+    idempotency_key: Optional[str] = Header(None),
     # 数据库会话
     db: DBSession = Depends(get_db),
 ):
     """
     生成时尚造型图片（流式响应，支持进度显示）
 
-    返回 Server-Sent Events 流，实时显示生成进度
+    返回 Server-Sent Events 流，实时显示生成进度。
+    生成在后台运行，连接断开不会中断生成；每个事件带有 id，
+    可通过 GET /api/generate/stream/{session_id} 携带 Last-Event-ID 重连。
     """
+    uploaded_files = []
+
+    try:
+        # 解析姿势列表
+        pose_ids = json.loads(selected_poses)
+        if not pose_ids or len(pose_ids) > 3:
+            raise HTTPException(status_code=400, detail="Must select 1-3 poses")
+        if not 1 <= candidates_per_pose <= settings.max_candidates_per_pose:
+            raise HTTPException(
+                status_code=400,
+                detail=f"candidates_per_pose must be between 1 and {settings.max_candidates_per_pose}",
+            )
+        if selected_model not in {tier.value for tier in ModelTier}:
+            raise HTTPException(status_code=400, detail=f"Unsupported model: {selected_model}")
+
+        # 在返回响应前读取上传文件（响应开始后上传文件会被关闭）
+        budget = UploadBudget()
+        upload_paths = {}
+        digests = {}
+        for name, file in [
+            ("styling_ref", styling_ref),
+            ("face_ref", face_ref),
+            ("top", top),
+            ("bottom", bottom),
+            ("shoes", shoes),
+            ("sunglasses", sunglasses),
+            ("necklace", necklace),
+            ("earrings", earrings),
+            ("jewelry", jewelry),
+            ("hat", hat),
+            ("bag", bag),
+            ("belt", belt),
+        ]:
+            if file:
+                digest = hashlib.sha256()
+                path = await image_service.save_upload_stream(file, budget, digest=digest)
+                uploaded_files.append(path)
+                upload_paths[name] = path
+                digests[name] = digest.hexdigest()
+
+        parameters = {
+            "gender": gender,
+            "background_mode": background_mode,
+            "pose_ids": pose_ids,
+            "model": selected_model,
+            "candidates_per_pose": candidates_per_pose,
+        }
+        fingerprint = idempotency_service.fingerprint(parameters, digests)
+
+        # 同一 Idempotency-Key 已完成：直接返回原结果
+        if idempotency_key:
+            previous_id = idempotency_service.lookup(db, idempotency_key, fingerprint)
+            previous = previous_id and (
+                db.query(SessionModel).filter(SessionModel.id == previous_id).first()
+            )
+            if previous:
+                await image_service.cleanup_uploads(uploaded_files)
+                return _sse_response(_replay_session(previous))
+
+        # 相同内容正在生成（包括 /generate 发起的）：挂到已有任务上，直接订阅其进度流
+        channel = idempotency_service.attach(fingerprint, idempotency_key) and progress_service.find(
+            fingerprint
+        )
+        if channel:
+            await image_service.cleanup_uploads(uploaded_files)
+            return _sse_response(progress_service.subscribe(channel))
 
-    async def event_generator():
+        # 申请生成槽位，队列已满时直接拒绝
+        ticket = admission_service.enqueue(
+            selected_model, admission_service.lane_for(len(pose_ids) * candidates_per_pose)
+        )
+
+        # 在后台启动生成
+        channel, _ = _start_generation(
+            ticket,
+            upload_paths=upload_paths,
+            filenames={"styling_ref": styling_ref.filename, "face_ref": face_ref.filename},
+            parameters=parameters,
+            fingerprint=fingerprint,
+            idempotency_key=idempotency_key,
+        )
+        # 上传文件交由生成任务清理
         uploaded_files = []
 
-        try:
-            # 解析姿势列表
-            pose_ids = json.loads(selected_poses)
-            if not pose_ids or len(pose_ids) > 3:
-                yield f"data: {json.dumps({'error': 'Must select 1-3 poses'})}\n\n"
-                return
+        return _sse_response(progress_service.subscribe(channel))
 
-            # 生成会话 ID
-            session_id = str(uuid.uuid4())
-            timestamp = int(time.time() * 1000)
+    except HTTPException:
+        if uploaded_files:
+            await image_service.cleanup_uploads(uploaded_files)
+        raise
 
-            yield f"data: {json.dumps({'status': 'uploading', 'message': '正在上传图片...'})}\n\n"
-            await asyncio.sleep(0.1)
+    except UploadValidationError as e:
+        if uploaded_files:
+            await image_service.cleanup_uploads(uploaded_files)
 
-            # 读取并保存上传的文件
-            styling_ref_bytes = await styling_ref.read()
-            styling_ref_path = await image_service.save_upload(
-                styling_ref_bytes, styling_ref.filename
-            )
-            uploaded_files.append(styling_ref_path)
+        raise HTTPException(status_code=e.status_code, detail=str(e))
 
-            face_ref_bytes = await face_ref.read()
-            face_ref_path = await image_service.save_upload(
-                face_ref_bytes, face_ref.filename
-            )
-            uploaded_files.append(face_ref_path)
-
-            # 加载参考图
-            styling_img = await image_service.load_image(styling_ref_path)
-            face_img = await image_service.load_image(face_ref_path)
-
-            # 处理服装图片
-            clothes = {}
-            for name, file in [
-                ("top", top),
-                ("bottom", bottom),
-                ("shoes", shoes),
-                ("sunglasses", sunglasses),
-            ]:
-                if file:
-                    file_bytes = await file.read()
-                    path = await image_service.save_upload(file_bytes, file.filename)
-                    uploaded_files.append(path)
-                    clothes[name] = await image_service.load_image(path)
-
-            # 处理配饰图片
-            accessories = {}
-            for name, file in [
-                ("necklace", necklace),
-                ("earrings", earrings),
-                ("jewelry", jewelry),
-                ("hat", hat),
-                ("bag", bag),
-                ("belt", belt),
-            ]:
-                if file:
-                    file_bytes = await file.read()
-                    path = await image_service.save_upload(file_bytes, file.filename)
-                    uploaded_files.append(path)
-                    accessories[name] = await image_service.load_image(path)
-
-            yield f"data: {json.dumps({'status': 'processing', 'message': '图片上传完成，开始生成...'})}\n\n"
-            await asyncio.sleep(0.1)
-
-            # 生成图片（带进度）
-            output_urls = []
-            total_poses = len(pose_ids)
-
-            for idx, pose_id in enumerate(pose_ids):
-                # 估算每张图片生成时间约30-60秒
-                estimated_time = 45
-
-                yield f"data: {json.dumps({'status': 'generating', 'message': f'正在生成第 {idx + 1}/{total_poses} 张图片 (姿势: {pose_id})', 'progress': idx / total_poses, 'current': idx + 1, 'total': total_poses})}\n\n"
-
-                # 倒计时显示
-                for remaining in range(estimated_time, 0, -5):
-                    yield f"data: {json.dumps({'status': 'generating', 'message': f'正在生成第 {idx + 1}/{total_poses} 张图片 (姿势: {pose_id})', 'progress': idx / total_poses, 'current': idx + 1, 'total': total_poses, 'remaining_seconds': remaining})}\n\n"
-                    await asyncio.sleep(5)
-
-                # 实际生成
-                img_bytes = await gemini_service.generate_fashion_image(
-                    styling_ref=styling_img,
-                    face_ref=face_img,
-                    pose_id=pose_id,
-                    gender=gender,
-                    background_mode=background_mode,
-                    clothes=clothes if clothes else None,
-                    accessories=accessories if accessories else None,
-                    model=selected_model,
-                )
-
-                # 保存生成的图片
-                url = await image_service.save_generated_image(img_bytes, session_id, idx)
-                output_urls.append(url)
-
-                yield f"data: {json.dumps({'status': 'generating', 'message': f'第 {idx + 1}/{total_poses} 张图片生成完成', 'progress': (idx + 1) / total_poses, 'current': idx + 1, 'total': total_poses, 'completed_image': url})}\n\n"
-                await asyncio.sleep(0.1)
-
-            # 创建缩略图
-            thumbnail_url = None
-            if output_urls:
-                yield f"data: {json.dumps({'status': 'finalizing', 'message': '正在创建缩略图...'})}\n\n"
-
-                # 读取第一张生成的图片
-                first_img_bytes = await image_service.read_generated_image(output_urls[0])
-                thumbnail_bytes = await image_service.create_thumbnail(first_img_bytes)
-                thumbnail_url = await image_service.save_generated_image(
-                    thumbnail_bytes, session_id, "thumb"
-                )
-
-            # 保存到数据库
-            session_record = SessionModel(
-                id=session_id,
-                timestamp=timestamp,
-                gender=gender,
-                background_mode=background_mode,
-                pose_ids=pose_ids,
-                model=selected_model,
-                inputs={
-                    "styling_ref": styling_ref.filename,
-                    "face_ref": face_ref.filename,
-                    "clothes": {k: True for k in clothes.keys()},
-                    "accessories": {k: True for k in accessories.keys()},
-                },
-                outputs=output_urls,
-                thumbnail=thumbnail_url,
-            )
-            db.add(session_record)
-            db.commit()
+    except IdempotencyConflict as e:
+        if uploaded_files:
+            await image_service.cleanup_uploads(uploaded_files)
 
-            # 清理上传的临时文件
+        raise HTTPException(status_code=422, detail=str(e))
+
+    except AdmissionRejected as e:
+        if uploaded_files:
             await image_service.cleanup_uploads(uploaded_files)
 
-            # 完成
-            yield f"data: {json.dumps({'status': 'completed', 'message': '生成完成！', 'session_id': session_id, 'outputs': output_urls, 'thumbnail': thumbnail_url, 'timestamp': timestamp})}\n\n"
+        raise _busy(e)
 
-        except Exception as e:
-            # 清理上传的文件
-            if uploaded_files:
-                await image_service.cleanup_uploads(uploaded_files)
+    except Exception as e:
+        if uploaded_files:
+            await image_service.cleanup_uploads(uploaded_files)
 
-            yield f"data: {json.dumps({'status': 'error', 'message': str(e)})}\n\n"
+        raise HTTPException(status_code=500, detail=str(e))
 
+
+@router.get("/generate/stream/{session_id}")
+async def resume_generation_stream(
+    session_id: str,
+    last_event_id: Optional[int] = Header(None),
+    db: DBSession = Depends(get_db),
+):
+    """
+    重新连接生成进度流
+
+    补发 Last-Event-ID 之后的事件并继续推送；生成已结束且缓冲过期时返回最终结果
+    """
+    channel = progress_service.get(session_id)
+    if channel:
+        return _sse_response(progress_service.subscribe(channel, last_event_id or 0))
+
+    session = db.query(SessionModel).filter(SessionModel.id == session_id).first()
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    return _sse_response(_replay_session(session))
+
+
+def _completed_event(session: SessionModel, replayed: bool = False) -> Dict:
+    """生成完成事件"""
+    event = {
+        'status': 'completed',
+        'message': '生成完成！',
+        'session_id': session.id,
+        'outputs': session.outputs,
+        'thumbnail': session.thumbnail,
+        'placeholder': session.placeholder(),
+        'timestamp': session.timestamp,
+        'poses': session.pose_results(),
+    }
+    if replayed:
+        event['replayed'] = True
+    return event
+
+
+async def _replay_session(session: SessionModel):
+    """对已结束的会话只发送最终结果"""
+    yield f"data: {json.dumps(_completed_event(session, replayed=True))}\n\n"
+
+
+def _busy(e: AdmissionRejected) -> HTTPException:
+    """等待队列已满：503，并按当前排空速度给出 Retry-After"""
+    return HTTPException(
+        status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)}
+    )
+
+
+def _sse_response(events) -> StreamingResponse:
     return StreamingResponse(
-        event_generator(),
+        events,
         media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
@@ -361,3 +460,57 @@ async def generate_fashion_images_stream(
         },
     )
 
+
+@router.post("/generate/{session_id}/regenerate", response_model=GenerateResponse)
+async def regenerate_poses(
+    session_id: str,
+    body: Optional[RegenerateRequest] = None,
+    db: DBSession = Depends(get_db),
+):
+    """
+    重新生成会话中的部分姿势
+
+    复用会话保存的参考图，只重新生成失败（或指定）的姿势，并原地更新会话记录
+    """
+    session = db.query(SessionModel).filter(SessionModel.id == session_id).first()
+
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    retention_service.touch(session.id)
+
+    references = (session.inputs or {}).get("references")
+    pose_status = [dict(pose) for pose in session.pose_results()]
+    if not references or not pose_status:
+        raise HTTPException(
+            status_code=409, detail="Session has no stored references to regenerate from"
+        )
+
+    # 默认重新生成所有失败的姿势
+    if body is None or body.pose_ids is None:
+        targets = [idx for idx, pose in enumerate(pose_status) if pose["status"] != "done"]
+    else:
+        unknown = set(body.pose_ids) - {pose["pose_id"] for pose in pose_status}
+        if unknown:
+            raise HTTPException(
+                status_code=400, detail=f"Poses not in session: {', '.join(sorted(unknown))}"
+            )
+        targets = [idx for idx, pose in enumerate(pose_status) if pose["pose_id"] in body.pose_ids]
+
+    if not targets:
+        return _session_response(session)
+
+    ctx = RegenerationContext(session, targets)
+    try:
+        ticket = admission_service.enqueue(
+            session.model, admission_service.lane_for(len(targets) * ctx.candidates_per_pose)
+        )
+    except AdmissionRejected as e:
+        raise _busy(e)
+
+    try:
+        updated = await regeneration_pipeline.run(ctx, ticket)
+        return _session_response(updated)
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
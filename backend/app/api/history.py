@@ -1,11 +1,14 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Header, Query, Response
 from sqlalchemy.orm import Session as DBSession
-from typing import List
-import os
+from typing import Dict, List, Optional, Tuple
 
-from app.models.schemas import HistoryListResponse, HistoryItem, SessionDetail
+from app.models.schemas import HistoryListResponse, HistoryAtlasResponse, SessionDetail
 from app.models.database import Session as SessionModel, get_db
-from app.config import settings
+from app.services.analytics_service import analytics_service
+from app.services.atlas_service import atlas_service
+from app.services.history_cache import history_cache
+from app.services.image_service import image_service
+from app.services.retention_service import retention_service
 
 router = APIRouter(prefix="/api", tags=["history"])
 
@@ -14,67 +17,109 @@ router = APIRouter(prefix="/api", tags=["history"])
 async def get_history(
     skip: int = 0,
     limit: int = 50,
+    if_none_match: Optional[str] = Header(None),
     db: DBSession = Depends(get_db),
 ):
     """获取历史记录列表"""
     try:
-        # 查询总数
-        total = db.query(SessionModel).count()
-
-        # 查询记录
-        sessions = (
-            db.query(SessionModel)
-            .order_by(SessionModel.timestamp.desc())
-            .offset(skip)
-            .limit(limit)
-            .all()
-        )
-
-        # 转换为响应格式
-        items = [
-            HistoryItem(
-                id=session.id,
-                timestamp=session.timestamp,
-                gender=session.gender,
-                background_mode=session.background_mode,
-                pose_ids=session.pose_ids,
-                model=session.model,
-                output_count=len(session.outputs),
-                thumbnail=session.thumbnail,
-            )
-            for session in sessions
-        ]
-
-        return HistoryListResponse(total=total, items=items)
+        key = ("list", skip, limit)
+        cached = history_cache.get(key)
+        if cached:
+            return _cached_response(cached, if_none_match)
+
+        version = history_cache.version
+        total, items = _history_page(db, skip, limit)
+
+        entry = history_cache.put(key, {"total": total, "items": items}, version)
+        return _cached_response(entry, if_none_match)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/history/atlas", response_model=HistoryAtlasResponse)
+async def get_history_atlas(
+    skip: int = 0,
+    # 超出时精灵图高度会超过 WebP 的尺寸上限
+    limit: int = Query(50, ge=1, le=atlas_service.max_page_size()),
+    if_none_match: Optional[str] = Header(None),
+    db: DBSession = Depends(get_db),
+):
+    """获取历史记录列表及整页缩略图的精灵图坐标"""
+    try:
+        key = ("atlas", skip, limit)
+        cached = history_cache.get(key)
+        # 精灵图本身可能已被淘汰，此时重新生成（已解码的缩略图仍可复用）
+        if cached and atlas_service.available(key):
+            return _cached_response(cached, if_none_match)
+
+        version = history_cache.version
+        total, items = _history_page(db, skip, limit)
+
+        atlas = await atlas_service.build(key, [(item["id"], item["thumbnail"]) for item in items])
+        for item in items:
+            item["sprite"] = atlas["sprites"].get(item["id"])
+
+        payload = {
+            "total": total,
+            "image": f"/api/history/atlas/{atlas['atlas_id']}.webp",
+            "width": atlas["width"],
+            "height": atlas["height"],
+            "items": items,
+        }
+        entry = history_cache.put(key, payload, version)
+        return _cached_response(entry, if_none_match)
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/history/atlas/{atlas_id}.webp")
+async def get_history_atlas_image(atlas_id: str):
+    """获取精灵图（内容寻址，可长期缓存）"""
+    data = atlas_service.get(atlas_id)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Atlas not found")
+
+    return Response(
+        content=data,
+        media_type="image/webp",
+        headers={"Cache-Control": "public, max-age=31536000, immutable"},
+    )
+
+
 @router.get("/history/{session_id}", response_model=SessionDetail)
 async def get_session_detail(
     session_id: str,
+    if_none_match: Optional[str] = Header(None),
     db: DBSession = Depends(get_db),
 ):
     """获取特定会话的详细信息"""
     try:
+        retention_service.touch(session_id)
+
+        key = ("detail", session_id)
+        cached = history_cache.get(key)
+        if cached:
+            return _cached_response(cached, if_none_match)
+
+        version = history_cache.version
         session = db.query(SessionModel).filter(SessionModel.id == session_id).first()
 
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
 
-        return SessionDetail(
-            id=session.id,
-            timestamp=session.timestamp,
-            inputs=session.inputs,
-            parameters={
-                "gender": session.gender,
-                "background_mode": session.background_mode,
-                "pose_ids": session.pose_ids,
-                "model": session.model,
-            },
-            outputs=session.outputs,
-        )
+        detail = {
+            "id": session.id,
+            "timestamp": session.timestamp,
+            "inputs": session.inputs,
+            "parameters": session.parameters(),
+            "outputs": session.outputs,
+            "poses": session.pose_results(),
+        }
+
+        entry = history_cache.put(key, detail, version)
+        return _cached_response(entry, if_none_match)
 
     except HTTPException:
         raise
@@ -82,6 +127,46 @@ async def get_session_detail(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _history_page(db: DBSession, skip: int, limit: int) -> Tuple[int, List[Dict]]:
+    """查询一页历史记录（字段与 HistoryItem 一致，跳过 Pydantic 校验直接序列化）"""
+    # 查询总数
+    total = db.query(SessionModel).count()
+
+    # 查询记录
+    sessions = (
+        db.query(SessionModel)
+        .order_by(SessionModel.timestamp.desc())
+        .offset(skip)
+        .limit(limit)
+        .all()
+    )
+
+    items = [
+        {
+            "id": session.id,
+            "timestamp": session.timestamp,
+            "gender": session.gender,
+            "background_mode": session.background_mode,
+            "pose_ids": session.pose_ids,
+            "model": session.model,
+            "output_count": len(session.outputs),
+            "thumbnail": session.thumbnail,
+            "placeholder": session.placeholder(),
+        }
+        for session in sessions
+    ]
+    return total, items
+
+
+def _cached_response(entry: Tuple[str, bytes], if_none_match: Optional[str]) -> Response:
+    """返回缓存的响应，ETag 匹配时返回 304"""
+    etag, body = entry
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if history_cache.matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
 @router.delete("/history/{session_id}")
 async def delete_session(
     session_id: str,
@@ -94,23 +179,17 @@ async def delete_session(
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
 
-        # 删除生成的图片文件
-        for output_url in session.outputs:
-            filepath = os.path.join(settings.output_dir, os.path.basename(output_url))
-            if os.path.exists(filepath):
-                os.remove(filepath)
+        # 删除生成的图片文件和缩略图（后台执行）
+        image_service.delete_generated_images(session.outputs + [session.thumbnail])
 
-        # 删除缩略图
-        if session.thumbnail:
-            thumb_path = os.path.join(
-                settings.output_dir, os.path.basename(session.thumbnail)
-            )
-            if os.path.exists(thumb_path):
-                os.remove(thumb_path)
+        # 删除保存的参考图
+        await image_service.delete_references(session.id)
 
         # 从数据库删除
+        analytics_service.delete_session(db, session.id)
         db.delete(session)
         db.commit()
+        history_cache.invalidate(session_id)
 
         return {"message": "Session deleted successfully"}
 
@@ -129,25 +208,16 @@ async def clear_all_history(
         # 获取所有会话
         sessions = db.query(SessionModel).all()
 
-        # 删除所有生成的文件
+        # 删除所有生成的文件（后台执行）
         for session in sessions:
-            for output_url in session.outputs:
-                filepath = os.path.join(
-                    settings.output_dir, os.path.basename(output_url)
-                )
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-
-            if session.thumbnail:
-                thumb_path = os.path.join(
-                    settings.output_dir, os.path.basename(session.thumbnail)
-                )
-                if os.path.exists(thumb_path):
-                    os.remove(thumb_path)
+            image_service.delete_generated_images(session.outputs + [session.thumbnail])
+            await image_service.delete_references(session.id)
 
         # 删除所有记录
+        analytics_service.delete_session(db)
         db.query(SessionModel).delete()
         db.commit()
+        history_cache.invalidate()
 
         return {"message": "All history cleared successfully"}
 
@@ -0,0 +1,31 @@
+from fastapi import APIRouter, HTTPException
+
+from app.config import settings
+from app.services.retention_service import retention_service
+
+router = APIRouter(prefix="/api/storage", tags=["storage"])
+
+
+@router.get("/gc")
+async def get_gc_status():
+    """存储清理状态（最近一次回收的空间和累计统计）"""
+    return {
+        "running": retention_service.running,
+        "interval_seconds": settings.gc_interval,
+        "quota_bytes": settings.storage_quota_bytes,
+        "retention_policy": settings.storage_retention_policy,
+        "last_run": retention_service.last_report,
+        "totals": retention_service.totals,
+    }
+
+
+@router.post("/gc")
+async def run_gc():
+    """立即执行一次存储清理"""
+    if retention_service.running:
+        raise HTTPException(status_code=409, detail="Storage GC is already running")
+
+    try:
+        return await retention_service.run()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
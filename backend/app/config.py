@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import List
+from typing import Dict, List, Tuple
 
 
 class Settings(BaseSettings):
@@ -16,7 +16,25 @@ class Settings(BaseSettings):
     # 存储配置
     upload_dir: str = "./uploads"
     output_dir: str = "./outputs"
+    reference_dir: str = "./references"  # 会话的参考图，用于单独重新生成某个姿势
     max_file_size: int = 10485760  # 10MB
+    max_request_size: int = 41943040  # 40MB，单次请求所有上传文件的总大小
+    upload_chunk_size: int = 262144  # 256KB，流式读取上传文件的分块大小
+    batch_dir: str = "./batches"
+    max_archive_size: int = 2147483648  # 2GB，批量任务服装归档（解压后）的大小上限
+
+    # 存储清理
+    gc_interval: int = 3600  # 秒，后台清理间隔，0 表示不自动运行
+    gc_grace_period: int = 3600  # 秒，未被数据库引用的文件至少保留这么久才会被清理
+    gc_batch_size: int = 500  # 每处理多少个文件让出一次事件循环
+    storage_quota_bytes: int = 0  # 已保存会话（生成图片与参考图）的总配额，0 表示不限制
+    storage_retention_policy: str = "age"  # 超出配额时的淘汰策略: age（最旧优先）或 lru（最久未访问优先）
+    storage_max_age_days: int = 0  # 会话最长保留天数，0 表示不限制
+
+    # 文件写入与删除
+    storage_fsync: str = "file"  # 写入后的刷盘策略: none、file（刷文件）或 full（同时刷目录）
+    storage_delete_batch_size: int = 100  # 排队的删除达到该数量时立即执行
+    storage_delete_interval: float = 0.5  # 秒，排队的删除最多等待这么久
 
     # 数据库
     database_url: str = "sqlite:///./vm_studio.db"
@@ -26,6 +44,69 @@ class Settings(BaseSettings):
     default_aspect_ratio: str = "9:16"
     default_image_size: str = "2K"
 
+    # Gemini 连接池（共享 HTTP 传输层）
+    gemini_http2: bool = True
+    gemini_pool_max_connections: int = 20
+    gemini_pool_max_keepalive: int = 10
+    gemini_keepalive_expiry: float = 300.0  # 秒
+    gemini_connect_timeout: float = 10.0  # 秒
+    gemini_request_timeout: float = 600.0  # 秒，单张生成可能需要数分钟
+    gemini_warmup_connections: int = 2  # 启动时预热的连接数，0 表示不预热
+
+    # 准入控制（按模型层级限制同时进行的生成和等待队列长度）
+    admission_concurrency: Dict[str, int] = {
+        "gemini-3-pro-image-preview": 4,
+        "gemini-2.5-flash-image": 8,
+    }
+    admission_queue_depth: Dict[str, int] = {
+        "gemini-3-pro-image-preview": 16,
+        "gemini-2.5-flash-image": 32,
+    }
+    admission_default_concurrency: int = 4  # 未单独配置的模型
+    admission_default_queue_depth: int = 16
+    admission_default_duration: float = 60.0  # 秒，尚无统计时假设的单次生成耗时
+    admission_max_retry_after: int = 300  # 秒，Retry-After 上限
+
+    # 参考图解码内存预算（所有进行中的请求共享，0 表示不限制）
+    image_budget_pixels: int = 150_000_000  # 同时解码的像素总数
+    image_budget_bytes: int = 536870912  # 512MB，同时解码占用的内存
+    reference_max_side: int = 2048  # 参考图长边上限，超出时缩小后再发送，0 表示不缩小
+    reference_jpeg_quality: int = 95  # 非 PNG 参考图重新编码为 JPEG 时的质量
+
+    # 多候选生成
+    max_candidates_per_pose: int = 4  # 单个姿势最多生成的候选图片数
+
+    # 导出
+    export_max_sessions: int = 1000  # 单次导出的会话数上限
+    export_chunk_size: int = 262144  # 256KB，流式读取文件的分块大小
+    export_crc_cache_size: int = 10000  # 缓存的文件 CRC 数量（断点续传时跳过的文件无需重新计算）
+
+    # 批量生成
+    batch_concurrency: int = 4  # 同时进行的生成请求数
+    batch_max_attempts: int = 2  # 单个生成项失败后的最大尝试次数
+
+    # SSE 进度流
+    sse_heartbeat_interval: float = 5.0  # 秒，无新事件时发送心跳的间隔
+    sse_retention: int = 600  # 秒，生成结束后事件缓冲的保留时间（用于断线重连）
+    sse_retry_ms: int = 3000  # 建议客户端的重连间隔
+
+    # 幂等
+    idempotency_ttl: int = 86400  # 秒，Idempotency-Key 的有效期
+
+    # 历史记录缓存
+    history_cache_size: int = 256  # 缓存的历史列表页和会话详情响应数量
+
+    # 图片占位图（内联在响应中的低清 WebP）
+    placeholder_size: int = 24  # 占位图长边像素
+    placeholder_quality: int = 40  # WebP 质量
+
+    # 缩略图精灵图
+    atlas_tile_size: Tuple[int, int] = (200, 300)  # 单个缩略图在精灵图中的最大尺寸
+    atlas_max_width: int = 2000  # 精灵图最大宽度，超出后换行
+    atlas_quality: int = 80  # WebP 质量
+    atlas_cache_size: int = 32  # 缓存的精灵图数量
+    atlas_tile_cache_size: int = 500  # 缓存的已解码缩略图数量
+
     @property
     def cors_origins_list(self) -> List[str]:
         return [origin.strip() for origin in self.cors_origins.split(",")]
@@ -5,7 +5,14 @@ from contextlib import asynccontextmanager
 
 from app.config import settings
 from app.models.database import init_db
-from app.api import generate, history
+from app.api import generate, history, batch, analytics, storage, export
+from app.services.http_transport import gemini_transport
+from app.services.admission_service import admission_service
+from app.services.batch_service import batch_service
+from app.services.memory_budget import memory_budget
+from app.services.retention_service import retention_service
+from app.services.storage_service import storage_service
+from app.utils.request_limits import RequestSizeLimitMiddleware
 
 
 @asynccontextmanager
@@ -13,9 +20,20 @@ async def lifespan(app: FastAPI):
     # 启动时初始化数据库
     init_db()
     print("✅ Database initialized")
+    # 预热 Gemini 连接池
+    await gemini_transport.warmup()
+    # 恢复上次未完成的批量任务
+    await batch_service.resume_pending()
+    # 启动后台存储清理
+    retention_service.start()
     yield
     # 关闭时的清理工作
     print("👋 Shutting down...")
+    await batch_service.shutdown()
+    await retention_service.stop()
+    # 执行排队中的删除
+    await storage_service.close()
+    gemini_transport.close()
 
 
 # 创建 FastAPI 应用
@@ -35,12 +53,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 限制上传请求体总大小（在解析 multipart 之前拒绝超大请求）
+app.add_middleware(RequestSizeLimitMiddleware, max_size=settings.max_request_size)
+
 # 挂载静态文件目录（用于访问生成的图片）
 app.mount("/outputs", StaticFiles(directory=settings.output_dir), name="outputs")
 
 # 注册路由
 app.include_router(generate.router)
 app.include_router(history.router)
+app.include_router(batch.router)
+app.include_router(analytics.router)
+app.include_router(storage.router)
+app.include_router(export.router)
 
 
 @app.get("/")
@@ -60,6 +85,24 @@ async def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/health/gemini")
+async def gemini_pool_status():
+    """Gemini 连接池状态（用于监控连接池饱和）"""
+    return gemini_transport.stats()
+
+
+@app.get("/health/admission")
+async def admission_status():
+    """各模型层级的生成槽位和等待队列"""
+    return admission_service.stats()
+
+
+@app.get("/health/memory")
+async def memory_status():
+    """参考图解码的内存预算使用情况"""
+    return memory_budget.stats()
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, String, Integer, Text, JSON
+from sqlalchemy import create_engine, inspect, text, Column, String, Integer, Text, JSON, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from app.config import settings
@@ -16,8 +16,113 @@ class Session(Base):
     pose_ids = Column(JSON, nullable=False)  # List[str]
     model = Column(String, nullable=False)
     inputs = Column(JSON, nullable=False)  # Dict
-    outputs = Column(JSON, nullable=False)  # List[str]
+    outputs = Column(JSON, nullable=False)  # List[str]，成功生成的图片
     thumbnail = Column(String, nullable=True)
+    pose_status = Column(JSON, nullable=True)  # List[Dict]: 每个姿势的 pose_id / status / output / error / candidates
+    candidates_per_pose = Column(Integer, nullable=True)  # 每个姿势生成的候选数，旧记录为空（即 1）
+    last_accessed_at = Column(Integer, nullable=True)  # 用于 LRU 淘汰
+
+    def pose_results(self) -> list:
+        """每个姿势的生成状态（兼容没有 pose_status 的旧记录）"""
+        if self.pose_status:
+            return self.pose_status
+        if len(self.outputs) == len(self.pose_ids):
+            return [
+                {"pose_id": pose_id, "status": "done", "output": output, "error": None}
+                for pose_id, output in zip(self.pose_ids, self.outputs)
+            ]
+        # 旧记录无法确定哪个姿势失败
+        return []
+
+    def parameters(self) -> dict:
+        return {
+            "gender": self.gender,
+            "background_mode": self.background_mode,
+            "pose_ids": self.pose_ids,
+            "model": self.model,
+            "candidates_per_pose": self.candidates_per_pose or 1,
+        }
+
+    def placeholder(self):
+        """缩略图（第一张成功的图片）的占位图"""
+        for pose in self.pose_status or []:
+            if pose.get("output"):
+                return pose.get("placeholder")
+        return None
+
+
+class Output(Base):
+    """单张生成图片及其生成元数据（用于统计分析）"""
+
+    __tablename__ = "outputs"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    session_id = Column(String, nullable=False, index=True)
+    pose_index = Column(Integer, nullable=False)
+    pose_id = Column(String, nullable=False, index=True)
+    model = Column(String, nullable=False, index=True)
+    status = Column(String, nullable=False, index=True)  # done / failed
+    url = Column(String, nullable=True)
+    latency_ms = Column(Integer, nullable=True)  # Gemini 调用耗时
+    byte_size = Column(Integer, nullable=True, index=True)
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(Integer, nullable=False, index=True)
+
+    __table_args__ = (
+        Index("ix_outputs_model_pose_created", "model", "pose_id", "created_at"),
+        Index("ix_outputs_session_pose", "session_id", "pose_index"),
+    )
+
+
+class BatchJob(Base):
+    """目录批量生成任务（一张面部参考 + 一张造型参考 × 多套服装）"""
+
+    __tablename__ = "batch_jobs"
+
+    id = Column(String, primary_key=True, index=True)
+    created_at = Column(Integer, nullable=False)
+    status = Column(String, nullable=False, default="pending")  # pending / running / completed / failed
+    gender = Column(String, nullable=False)
+    background_mode = Column(String, nullable=False)
+    model = Column(String, nullable=False)
+    inputs = Column(JSON, nullable=False)  # Dict: 参考图路径、manifest 文件名等
+    total_items = Column(Integer, nullable=False, default=0)
+    started_at = Column(Integer, nullable=True)  # 本次运行（含恢复）的开始时间
+    finished_at = Column(Integer, nullable=True)
+    error = Column(Text, nullable=True)
+
+
+class BatchItem(Base):
+    """批量任务中的单个生成项（一套服装 × 一个姿势），也是断点续跑的检查点"""
+
+    __tablename__ = "batch_items"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(String, nullable=False, index=True)
+    look_id = Column(String, nullable=False)
+    session_id = Column(String, nullable=False, index=True)  # 同一套服装的所有姿势归入一个会话
+    pose_id = Column(String, nullable=False)
+    pose_index = Column(Integer, nullable=False)
+    garments = Column(JSON, nullable=False)  # Dict[str, str]: 类别 -> 归档内相对路径
+    status = Column(String, nullable=False, default="pending", index=True)  # pending / running / done / failed
+    output = Column(String, nullable=True)
+    placeholder = Column(Text, nullable=True)  # 低清占位图，写入会话的 pose_status
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(Text, nullable=True)
+    finished_at = Column(Integer, nullable=True)
+
+
+class IdempotencyRecord(Base):
+    """Idempotency-Key 与生成结果的对应关系"""
+
+    __tablename__ = "idempotency_keys"
+
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)  # 请求内容（参数 + 上传文件）的哈希
+    session_id = Column(String, nullable=False)
+    created_at = Column(Integer, nullable=False)
 
 
 # 创建数据库引擎
@@ -33,6 +138,23 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 # 创建所有表
 def init_db():
     Base.metadata.create_all(bind=engine)
+    _add_missing_columns()
+
+
+def _add_missing_columns():
+    """为已有数据库补充新增的列（create_all 不会修改已存在的表）"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(
+                        text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+                    )
 
 
 # 获取数据库会话
@@ -2,6 +2,10 @@ from pydantic import BaseModel, Field
 from typing import Optional, List, Dict
 from enum import Enum
 
+# 可选的服装 / 配饰图片类别
+CLOTHES_KEYS = ["top", "bottom", "shoes", "sunglasses"]
+ACCESSORY_KEYS = ["necklace", "earrings", "jewelry", "hat", "bag", "belt"]
+
 
 class Gender(str, Enum):
     FEMALE = "female"
@@ -35,11 +39,31 @@ class GenerateRequest(BaseModel):
         }
 
 
+class Candidate(BaseModel):
+    output: str
+    placeholder: Optional[str] = None
+
+
+class PoseResult(BaseModel):
+    pose_id: str
+    status: str  # done / failed
+    output: Optional[str] = None  # 第一张候选
+    error: Optional[str] = None
+    placeholder: Optional[str] = None  # 低清占位图（data URI）
+    candidates: List[Candidate] = []  # 所有候选图片（包括 output）
+
+
 class GenerateResponse(BaseModel):
     session_id: str
     outputs: List[str]  # 生成的图片 URL 列表
     parameters: Dict
     timestamp: int
+    poses: List[PoseResult] = []  # 每个姿势的生成状态
+
+
+class RegenerateRequest(BaseModel):
+    # 需要重新生成的姿势，默认为所有失败的姿势
+    pose_ids: Optional[List[str]] = None
 
 
 class HistoryItem(BaseModel):
@@ -51,6 +75,7 @@ class HistoryItem(BaseModel):
     model: ModelTier
     output_count: int
     thumbnail: Optional[str] = None
+    placeholder: Optional[str] = None  # 缩略图的低清占位图（data URI）
 
 
 class HistoryListResponse(BaseModel):
@@ -58,12 +83,81 @@ class HistoryListResponse(BaseModel):
     items: List[HistoryItem]
 
 
+class SpriteRect(BaseModel):
+    x: int
+    y: int
+    w: int
+    h: int
+
+
+class AtlasItem(HistoryItem):
+    sprite: Optional[SpriteRect] = None  # 缩略图在精灵图中的位置，没有缩略图时为空
+
+
+class HistoryAtlasResponse(BaseModel):
+    total: int
+    image: str  # 精灵图 URL（WebP）
+    width: int
+    height: int
+    items: List[AtlasItem]
+
+
 class SessionDetail(BaseModel):
     id: str
     timestamp: int
     inputs: Dict
     parameters: Dict
     outputs: List[str]
+    poses: List[PoseResult] = []
+
+
+class BatchJobStatus(BaseModel):
+    job_id: str
+    status: str
+    created_at: int
+    total: int
+    completed: int
+    failed: int
+    pending: int
+    looks: int
+    sessions: List[str]  # 已完成的套装对应的会话 ID
+    items_per_minute: Optional[float] = None  # 本次运行的吞吐量
+    eta_seconds: Optional[int] = None
+    error: Optional[str] = None
+
+
+class LatencyStat(BaseModel):
+    model: str
+    pose_id: str
+    count: int
+    avg_latency_ms: Optional[int] = None
+    min_latency_ms: Optional[int] = None
+    max_latency_ms: Optional[int] = None
+
+
+class OutputRecord(BaseModel):
+    session_id: str
+    pose_index: int
+    pose_id: str
+    model: str
+    url: Optional[str] = None
+    latency_ms: Optional[int] = None
+    byte_size: Optional[int] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    created_at: int
+
+    class Config:
+        from_attributes = True
+
+
+class ModelSummary(BaseModel):
+    model: str
+    total: int
+    done: int
+    failed: int
+    avg_latency_ms: Optional[int] = None
+    total_bytes: int
 
 
 class ErrorResponse(BaseModel):
@@ -0,0 +1,200 @@
+from collections import deque
+from typing import Callable, Dict, List, Optional
+import asyncio
+import itertools
+import math
+import time
+
+from app.config import settings
+
+# 优先级通道：数值越小越先获得生成槽位
+LANE_INTERACTIVE = 0  # 单姿势的交互请求
+LANE_BULK = 1  # 多姿势请求和批量任务
+
+DEFAULT_TIER = "default"  # 未在 admission_concurrency 中配置的模型共用的层级
+
+
+class AdmissionRejected(Exception):
+    """等待队列已满"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """
+    一次生成的准入凭证
+
+    用法：
+        async with ticket:
+            ...  # 持有生成槽位
+    """
+
+    def __init__(self, tier: "_Tier", lane: int, seq: int):
+        self._tier = tier
+        self.lane = lane
+        self.seq = seq
+        self.admitted = False
+        self._released = False
+        self._admitted_at = None
+
+    def position(self) -> int:
+        """在等待队列中的位置（从 1 开始），已获得槽位时为 0"""
+        if self.admitted:
+            return 0
+        return self._tier.waiters.index(self) + 1
+
+    async def wait(self, on_position: Optional[Callable[[int], None]] = None):
+        """等待获得生成槽位，排队位置变化时调用 on_position"""
+        try:
+            reported = None
+            while not self.admitted:
+                position = self.position()
+                if on_position and position != reported:
+                    reported = position
+                    on_position(position)
+                try:
+                    await asyncio.wait_for(self._tier.changed.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._tier.release(self)
+
+    async def __aenter__(self):
+        await self.wait()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class _Tier:
+    """单个模型层级的槽位和等待队列"""
+
+    def __init__(self, concurrency: int, queue_depth: int):
+        self.concurrency = concurrency
+        self.queue_depth = queue_depth
+        self.active = 0
+        self.waiters: List[Ticket] = []  # 按 (通道, 到达顺序) 排序
+        self.changed = asyncio.Event()
+        self.durations = deque(maxlen=20)  # 最近完成的生成耗时，用于估算排空速度
+        self.rejected = 0
+
+    def admit(self, ticket: Ticket):
+        self.active += 1
+        ticket.admitted = True
+        ticket._admitted_at = time.monotonic()
+
+    def enqueue(self, ticket: Ticket):
+        self.waiters.append(ticket)
+        self.waiters.sort(key=lambda t: (t.lane, t.seq))
+
+    def release(self, ticket: Ticket):
+        if ticket.admitted:
+            self.active -= 1
+            self.durations.append(time.monotonic() - ticket._admitted_at)
+        elif ticket in self.waiters:
+            self.waiters.remove(ticket)
+
+        while self.waiters and self.active < self.concurrency:
+            self.admit(self.waiters.pop(0))
+        self.notify()
+
+    def retry_after(self) -> int:
+        """按最近的平均耗时估算队列排空所需的时间"""
+        average = (
+            sum(self.durations) / len(self.durations)
+            if self.durations
+            else settings.admission_default_duration
+        )
+        drain_rate = self.concurrency / max(average, 0.1)  # 每秒完成的生成数
+        seconds = math.ceil((len(self.waiters) + 1) / drain_rate)
+        return max(1, min(seconds, settings.admission_max_retry_after))
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class AdmissionService:
+    """
+    生成请求准入控制
+
+    - 每个模型层级有固定数量的生成槽位和有界等待队列
+    - 队列已满时立即拒绝（503 + Retry-After，按当前排空速度估算）
+    - 单姿势的交互请求优先于多姿势请求和批量任务获得槽位
+    """
+
+    def __init__(self):
+        self._tiers: Dict[str, _Tier] = {}
+        self._seq = itertools.count()
+
+    def enqueue(self, model: str, lane: int, reject: bool = True) -> Ticket:
+        """
+        申请生成槽位（不等待）
+
+        Args:
+            model: 模型层级
+            lane: 优先级通道
+            reject: 队列已满时是否拒绝；批量任务传 False，始终排队
+
+        Raises:
+            AdmissionRejected: 等待队列已满
+        """
+        tier = self._tier(model)
+        ticket = Ticket(tier, lane, next(self._seq))
+
+        if tier.active < tier.concurrency and not tier.waiters:
+            tier.admit(ticket)
+            return ticket
+
+        if reject and len(tier.waiters) >= tier.queue_depth:
+            tier.rejected += 1
+            raise AdmissionRejected(
+                "Server is busy, please retry later", retry_after=tier.retry_after()
+            )
+
+        tier.enqueue(ticket)
+        tier.notify()
+        return ticket
+
+    def lane_for(self, pose_count: int) -> int:
+        return LANE_INTERACTIVE if pose_count == 1 else LANE_BULK
+
+    def stats(self) -> Dict:
+        return {
+            model: {
+                "active": tier.active,
+                "concurrency": tier.concurrency,
+                "queued": len(tier.waiters),
+                "queue_depth": tier.queue_depth,
+                "rejected": tier.rejected,
+                "retry_after": tier.retry_after(),
+            }
+            for model, tier in self._tiers.items()
+        }
+
+    def _tier(self, model: str) -> _Tier:
+        # 未单独配置的模型共用一个默认层级，客户端无法通过任意模型名绕过并发限制
+        if model not in settings.admission_concurrency:
+            model = DEFAULT_TIER
+        tier = self._tiers.get(model)
+        if tier is None:
+            tier = _Tier(
+                settings.admission_concurrency.get(model, settings.admission_default_concurrency),
+                settings.admission_queue_depth.get(model, settings.admission_default_queue_depth),
+            )
+            self._tiers[model] = tier
+        return tier
+
+
+# 单例实例
+admission_service = AdmissionService()
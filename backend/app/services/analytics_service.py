@@ -0,0 +1,168 @@
+from sqlalchemy import case, func
+from sqlalchemy.orm import Session as DBSession
+from typing import Dict, List, Optional
+import time
+
+from app.models.database import Output
+from app.services.image_service import image_service
+
+
+class AnalyticsService:
+    """生成图片统计：写入 outputs 表的记录并提供聚合查询"""
+
+    def output_record(
+        self,
+        session_id: str,
+        pose_index: int,
+        pose_id: str,
+        model: str,
+        url: Optional[str],
+        image_bytes: Optional[bytes],
+        latency_ms: Optional[int],
+        error: Optional[str],
+    ) -> Output:
+        """单张生成图片的统计记录（由调用方与会话一起提交）"""
+        meta = image_service.describe(image_bytes) if image_bytes else {}
+        return Output(
+            session_id=session_id,
+            pose_index=pose_index,
+            pose_id=pose_id,
+            model=model,
+            status="done" if url else "failed",
+            url=url,
+            latency_ms=latency_ms,
+            error=error,
+            created_at=int(time.time() * 1000),
+            **meta,
+        )
+
+    def candidate_records(
+        self,
+        session_id: str,
+        pose_index: int,
+        pose_id: str,
+        model: str,
+        urls: List[str],
+        images: List[bytes],
+        latency_ms: Optional[int],
+        error: Optional[str],
+    ) -> List[Output]:
+        """
+        一个姿势的统计记录：每张候选图片一条（耗时均为整次生成的耗时），失败时为一条失败记录
+        """
+        if not urls:
+            return [
+                self.output_record(session_id, pose_index, pose_id, model, None, None, latency_ms, error)
+            ]
+        return [
+            self.output_record(session_id, pose_index, pose_id, model, url, image, latency_ms, None)
+            for url, image in zip(urls, images)
+        ]
+
+    def replace_record(self, db: DBSession, record: Output):
+        """替换会话中某个姿势的统计记录（不提交）"""
+        self.replace_records(db, [record])
+
+    def replace_records(self, db: DBSession, records: List[Output]):
+        """替换会话中某个姿势的所有统计记录（同一姿势的多张候选，不提交）"""
+        db.query(Output).filter(
+            Output.session_id == records[0].session_id,
+            Output.pose_index == records[0].pose_index,
+        ).delete(synchronize_session=False)
+        db.add_all(records)
+
+    def delete_session(self, db: DBSession, session_id: Optional[str] = None):
+        """删除会话的统计记录，session_id 为空时删除全部（不提交）"""
+        query = db.query(Output)
+        if session_id:
+            query = query.filter(Output.session_id == session_id)
+        query.delete(synchronize_session=False)
+
+    def latency_stats(
+        self,
+        db: DBSession,
+        model: Optional[str] = None,
+        pose_id: Optional[str] = None,
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+    ) -> List[Dict]:
+        """按模型和姿势分组的生成耗时统计（仅统计成功的生成）"""
+        query = db.query(
+            Output.model,
+            Output.pose_id,
+            func.count(Output.id),
+            func.avg(Output.latency_ms),
+            func.min(Output.latency_ms),
+            func.max(Output.latency_ms),
+        ).filter(Output.status == "done", Output.latency_ms.isnot(None))
+        query = self._filter(query, model, pose_id, since, until)
+
+        rows = query.group_by(Output.model, Output.pose_id).order_by(Output.model, Output.pose_id)
+        return [
+            {
+                "model": row[0],
+                "pose_id": row[1],
+                "count": row[2],
+                "avg_latency_ms": round(row[3]) if row[3] is not None else None,
+                "min_latency_ms": row[4],
+                "max_latency_ms": row[5],
+            }
+            for row in rows
+        ]
+
+    def largest(
+        self,
+        db: DBSession,
+        limit: int = 20,
+        model: Optional[str] = None,
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+    ) -> List[Output]:
+        """占用空间最大的生成图片"""
+        query = db.query(Output).filter(Output.status == "done")
+        query = self._filter(query, model, None, since, until)
+        return query.order_by(Output.byte_size.desc()).limit(limit).all()
+
+    def summary(
+        self,
+        db: DBSession,
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+    ) -> List[Dict]:
+        """按模型汇总的生成数量、失败数量、平均耗时和总大小"""
+        query = db.query(
+            Output.model,
+            func.count(Output.id),
+            func.sum(case((Output.status == "done", 1), else_=0)),
+            func.avg(Output.latency_ms),
+            func.sum(Output.byte_size),
+        )
+        query = self._filter(query, None, None, since, until)
+
+        rows = query.group_by(Output.model).order_by(Output.model)
+        return [
+            {
+                "model": row[0],
+                "total": row[1],
+                "done": row[2] or 0,
+                "failed": row[1] - (row[2] or 0),
+                "avg_latency_ms": round(row[3]) if row[3] is not None else None,
+                "total_bytes": row[4] or 0,
+            }
+            for row in rows
+        ]
+
+    def _filter(self, query, model, pose_id, since, until):
+        if model:
+            query = query.filter(Output.model == model)
+        if pose_id:
+            query = query.filter(Output.pose_id == pose_id)
+        if since is not None:
+            query = query.filter(Output.created_at >= since)
+        if until is not None:
+            query = query.filter(Output.created_at < until)
+        return query
+
+
+# 单例实例
+analytics_service = AnalyticsService()
@@ -0,0 +1,147 @@
+from collections import OrderedDict
+from PIL import Image
+from typing import Dict, Hashable, List, Optional, Tuple
+import asyncio
+import hashlib
+import io
+import os
+
+from app.config import settings
+
+# WebP 单边最大像素数
+WEBP_MAX_DIMENSION = 16383
+
+
+class AtlasService:
+    """
+    历史记录缩略图精灵图
+
+    将一页历史记录的缩略图按行排布（shelf packing）合成为一张 WebP，
+    并返回每个会话在图中的坐标，抽屉只需一次请求即可显示整页缩略图。
+
+    - 解码后的缩略图按 (URL, 修改时间) 缓存，新会话加入导致分页偏移时，
+      只需解码新增的缩略图，其余直接复用后重新拼合
+    - 精灵图按内容寻址（由各缩略图的标识计算 ID），内容不变时 ID 不变，可长期缓存
+    """
+
+    def __init__(self):
+        self._tiles: "OrderedDict[Tuple[str, int], Image.Image]" = OrderedDict()
+        self._atlases: "OrderedDict[str, bytes]" = OrderedDict()
+        # 分页游标 -> 最近一次生成的精灵图 ID，与精灵图一起淘汰
+        self._pages: "OrderedDict[Hashable, str]" = OrderedDict()
+
+    def max_page_size(self) -> int:
+        """单张精灵图最多容纳的缩略图数量（最坏情况下每个缩略图都占满最大尺寸，高度不超过 WebP 上限）"""
+        tile_width, tile_height = settings.atlas_tile_size
+        per_row = max(1, settings.atlas_max_width // tile_width)
+        return per_row * max(1, WEBP_MAX_DIMENSION // tile_height)
+
+    async def build(self, page: Hashable, thumbnails: List[Tuple[str, Optional[str]]]) -> Dict:
+        """
+        生成精灵图
+
+        Args:
+            page: 分页游标
+            thumbnails: [(session_id, thumbnail_url)]，没有缩略图的会话会被跳过
+
+        Returns:
+            {"atlas_id", "width", "height", "sprites": {session_id: {"x", "y", "w", "h"}}}
+        """
+        # 整页的 stat 在一次线程调用中完成，不在事件循环上逐个访问文件系统
+        entries = await asyncio.to_thread(self._stat_tiles, thumbnails)
+
+        signature = "|".join(f"{url}:{mtime}" for _, url, _, mtime in entries)
+        atlas_id = hashlib.sha256(signature.encode()).hexdigest()[:32]
+
+        tiles = [await self._tile(url, filepath, mtime) for _, url, filepath, mtime in entries]
+        width, height, positions = self._pack([tile.size for tile in tiles])
+
+        if atlas_id not in self._atlases:
+            data = await asyncio.to_thread(self._compose, tiles, positions, width, height)
+            self._store(self._atlases, atlas_id, data, settings.atlas_cache_size)
+            # 精灵图已被淘汰的分页游标一并删除
+            for stale in [key for key, value in self._pages.items() if value not in self._atlases]:
+                del self._pages[stale]
+        else:
+            self._atlases.move_to_end(atlas_id)
+        self._store(self._pages, page, atlas_id, settings.atlas_cache_size)
+
+        return {
+            "atlas_id": atlas_id,
+            "width": width,
+            "height": height,
+            "sprites": {
+                session_id: {"x": x, "y": y, "w": tile.width, "h": tile.height}
+                for (session_id, *_), tile, (x, y) in zip(entries, tiles, positions)
+            },
+        }
+
+    def get(self, atlas_id: str) -> Optional[bytes]:
+        """已生成的精灵图（WebP 字节）"""
+        return self._atlases.get(atlas_id)
+
+    def available(self, page: Hashable) -> bool:
+        """分页游标对应的精灵图是否仍在缓存中"""
+        return self._pages.get(page) in self._atlases
+
+    def _stat_tiles(self, thumbnails: List[Tuple[str, Optional[str]]]) -> List[Tuple[str, str, str, int]]:
+        """[(session_id, url, filepath, mtime)]，跳过没有缩略图或文件已删除的会话"""
+        entries = []
+        for session_id, url in thumbnails:
+            if not url:
+                continue
+            filepath = os.path.join(settings.output_dir, os.path.basename(url))
+            try:
+                mtime = os.stat(filepath).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            entries.append((session_id, url, filepath, mtime))
+        return entries
+
+    async def _tile(self, url: str, filepath: str, mtime: int) -> Image.Image:
+        key = (url, mtime)
+        tile = self._tiles.get(key)
+        if tile is None:
+            tile = await asyncio.to_thread(self._decode, filepath)
+            self._store(self._tiles, key, tile, settings.atlas_tile_cache_size)
+        else:
+            self._tiles.move_to_end(key)
+        return tile
+
+    def _decode(self, filepath: str) -> Image.Image:
+        with Image.open(filepath) as img:
+            img.thumbnail(settings.atlas_tile_size, Image.Resampling.LANCZOS)
+            return img.convert("RGB")
+
+    def _pack(self, sizes: List[Tuple[int, int]]) -> Tuple[int, int, List[Tuple[int, int]]]:
+        """按行排布，超出最大宽度时换行"""
+        positions = []
+        x = y = row_height = width = 0
+        for w, h in sizes:
+            if x and x + w > settings.atlas_max_width:
+                x, y = 0, y + row_height
+                row_height = 0
+            positions.append((x, y))
+            x += w
+            row_height = max(row_height, h)
+            width = max(width, x)
+        return max(width, 1), max(y + row_height, 1), positions
+
+    def _compose(self, tiles: List[Image.Image], positions, width: int, height: int) -> bytes:
+        atlas = Image.new("RGB", (width, height), (255, 255, 255))
+        for tile, position in zip(tiles, positions):
+            atlas.paste(tile, position)
+
+        buffer = io.BytesIO()
+        atlas.save(buffer, format="WEBP", quality=settings.atlas_quality)
+        return buffer.getvalue()
+
+    def _store(self, cache: OrderedDict, key, value, max_entries: int):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > max_entries:
+            cache.popitem(last=False)
+
+
+# 单例实例
+atlas_service = AtlasService()
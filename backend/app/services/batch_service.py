@@ -0,0 +1,569 @@
+from sqlalchemy import func
+from sqlalchemy.orm import Session as DBSession
+from typing import Dict, List
+from pathlib import Path
+import asyncio
+import csv
+import io
+import json
+import os
+import posixpath
+import shutil
+import time
+import uuid
+import zipfile
+
+import aiofiles
+
+from app.config import settings
+from app.models.database import (
+    BatchItem,
+    BatchJob,
+    Session as SessionModel,
+    SessionLocal,
+)
+from app.models.schemas import CLOTHES_KEYS, ACCESSORY_KEYS
+from app.services.admission_service import admission_service, LANE_BULK
+from app.services.analytics_service import analytics_service
+from app.services.gemini_service import gemini_service
+from app.services.history_cache import history_cache
+from app.services.image_service import image_service, UploadValidationError
+
+MAX_MANIFEST_SIZE = 5 * 1024 * 1024  # 5MB
+
+# 未结束的生成项状态
+OPEN_STATUSES = ("pending", "running")
+
+
+class BatchService:
+    """
+    目录批量生成
+
+    manifest 的每一行是一套服装（look），展开为 look × pose 个生成项，
+    以受控并发执行。每个生成项完成即写入数据库作为检查点，
+    进程崩溃重启后只会继续未完成的部分。
+    """
+
+    def __init__(self):
+        Path(settings.batch_dir).mkdir(parents=True, exist_ok=True)
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._finalizing = set()
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(settings.batch_dir, job_id)
+
+    def garments_dir(self, job_id: str) -> str:
+        """解压后的服装归档目录"""
+        return os.path.join(self.job_dir(job_id), "garments")
+
+    def parse_manifest(self, content: bytes, filename: str) -> List[Dict]:
+        """
+        解析 manifest（CSV 或 JSON）
+
+        每套服装包含 look_id（可选）、poses（可选，"F1|F2" 或列表）
+        以及服装 / 配饰类别到归档内文件路径的映射。
+        """
+        if len(content) > MAX_MANIFEST_SIZE:
+            raise UploadValidationError("Manifest is too large", status_code=413)
+
+        text = content.decode("utf-8-sig").strip()
+        try:
+            if (filename or "").lower().endswith(".json") or text[:1] in ("[", "{"):
+                rows = json.loads(text)
+                if isinstance(rows, dict):
+                    rows = rows.get("looks", [])
+            else:
+                rows = list(csv.DictReader(io.StringIO(text)))
+        except (ValueError, csv.Error) as e:
+            raise UploadValidationError(f"Invalid manifest: {str(e)}")
+
+        if not isinstance(rows, list) or not rows:
+            raise UploadValidationError("Manifest contains no looks")
+
+        looks = []
+        for index, row in enumerate(rows):
+            if not isinstance(row, dict):
+                raise UploadValidationError(f"Manifest row {index + 1} is not an object")
+
+            poses = row.get("poses") or []
+            if isinstance(poses, str):
+                poses = [p.strip() for p in poses.replace(",", "|").split("|") if p.strip()]
+
+            garments = {}
+            for key in CLOTHES_KEYS + ACCESSORY_KEYS:
+                value = row.get(key)
+                if value and str(value).strip():
+                    garments[key] = posixpath.normpath(str(value).strip())
+
+            looks.append(
+                {
+                    "look_id": str(row.get("look_id") or f"look-{index + 1}"),
+                    "poses": poses,
+                    "garments": garments,
+                }
+            )
+
+        return looks
+
+    async def save_archive(self, file, directory: str) -> str:
+        """分块保存服装归档（zip）"""
+        filepath = os.path.join(directory, "archive.zip")
+        written = 0
+        async with aiofiles.open(filepath, "wb") as f:
+            while True:
+                chunk = await file.read(settings.upload_chunk_size)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > settings.max_archive_size:
+                    raise UploadValidationError(
+                        f"Archive exceeds {settings.max_archive_size} bytes", status_code=413
+                    )
+                await f.write(chunk)
+        return filepath
+
+    def extract_archive(self, archive_path: str, directory: str) -> set:
+        """解压服装归档，返回归档内的文件相对路径集合"""
+        try:
+            archive = zipfile.ZipFile(archive_path)
+        except zipfile.BadZipFile:
+            raise UploadValidationError("Archive is not a valid zip file")
+
+        with archive:
+            entries = [
+                info
+                for info in archive.infolist()
+                if not info.is_dir() and not info.filename.startswith("__MACOSX/")
+            ]
+            if sum(info.file_size for info in entries) > settings.max_archive_size:
+                raise UploadValidationError(
+                    f"Archive exceeds {settings.max_archive_size} bytes", status_code=413
+                )
+
+            names = set()
+            for info in entries:
+                name = posixpath.normpath(info.filename)
+                # 防止路径穿越
+                if name.startswith("/") or name.split("/")[0] == "..":
+                    raise UploadValidationError(f"Unsafe path in archive: {info.filename}")
+
+                target = os.path.join(directory, name)
+                Path(target).parent.mkdir(parents=True, exist_ok=True)
+                with archive.open(info) as src, open(target, "wb") as dst:
+                    shutil.copyfileobj(src, dst, settings.upload_chunk_size)
+                names.add(name)
+
+        return names
+
+    def create_job(
+        self,
+        db: DBSession,
+        job_id: str,
+        looks: List[Dict],
+        archive_files: set,
+        default_poses: List[str],
+        gender: str,
+        background_mode: str,
+        model: str,
+        inputs: Dict,
+    ) -> BatchJob:
+        """将 manifest 展开为 look × pose 个生成项并保存任务"""
+        # 允许 manifest 只写文件名（归档内有子目录时）
+        by_basename = {}
+        for name in archive_files:
+            by_basename.setdefault(posixpath.basename(name), []).append(name)
+
+        missing = []
+        items = []
+        for look in looks:
+            garments = {}
+            for key, name in look["garments"].items():
+                if name not in archive_files and len(by_basename.get(name, [])) == 1:
+                    name = by_basename[name][0]
+                if name not in archive_files:
+                    missing.append(f"{look['look_id']}/{key}: {name}")
+                garments[key] = name
+
+            poses = look["poses"] or default_poses
+            if not poses:
+                raise UploadValidationError(f"Look {look['look_id']} has no poses")
+
+            session_id = str(uuid.uuid4())
+            for pose_index, pose_id in enumerate(poses):
+                items.append(
+                    BatchItem(
+                        job_id=job_id,
+                        look_id=look["look_id"],
+                        session_id=session_id,
+                        pose_id=pose_id,
+                        pose_index=pose_index,
+                        garments=garments,
+                    )
+                )
+
+        if missing:
+            raise UploadValidationError(
+                f"Files not found in archive: {', '.join(missing[:20])}"
+            )
+
+        job = BatchJob(
+            id=job_id,
+            created_at=int(time.time() * 1000),
+            status="pending",
+            gender=gender,
+            background_mode=background_mode,
+            model=model,
+            inputs=inputs,
+            total_items=len(items),
+        )
+        db.add(job)
+        db.add_all(items)
+        db.commit()
+        return job
+
+    def start(self, job_id: str):
+        """在后台运行任务（同一任务只会有一个运行实例）"""
+        task = self._tasks.get(job_id)
+        if task and not task.done():
+            return
+        self._tasks[job_id] = asyncio.create_task(self.run_job(job_id))
+
+    async def resume_pending(self):
+        """启动时恢复未完成的任务"""
+        db = SessionLocal()
+        try:
+            jobs = db.query(BatchJob).filter(BatchJob.status.in_(OPEN_STATUSES)).all()
+            for job in jobs:
+                print(f"🔁 Resuming batch job {job.id}")
+                self.start(job.id)
+        finally:
+            db.close()
+
+    async def shutdown(self):
+        """停止所有运行中的任务，未完成的生成项在下次启动时恢复"""
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks.clear()
+
+    def retry_failed(self, db: DBSession, job: BatchJob):
+        """将失败的生成项重新加入队列"""
+        db.query(BatchItem).filter(
+            BatchItem.job_id == job.id, BatchItem.status == "failed"
+        ).update({"status": "pending", "error": None}, synchronize_session=False)
+        job.status = "pending"
+        job.error = None
+        db.commit()
+        self.start(job.id)
+
+    async def run_job(self, job_id: str):
+        db = SessionLocal()
+        try:
+            job = db.query(BatchJob).filter(BatchJob.id == job_id).first()
+            if not job:
+                return
+
+            # 上次运行中断时处于 running 的生成项重新排队
+            db.query(BatchItem).filter(
+                BatchItem.job_id == job_id, BatchItem.status == "running"
+            ).update({"status": "pending"}, synchronize_session=False)
+            job.status = "running"
+            job.started_at = int(time.time() * 1000)
+            job.finished_at = None
+            db.commit()
+
+            job_dir = self.job_dir(job_id)
+            styling_img = await image_service.load_reference(
+                os.path.join(job_dir, job.inputs["styling_ref_path"])
+            )
+            face_img = await image_service.load_reference(
+                os.path.join(job_dir, job.inputs["face_ref_path"])
+            )
+
+            item_ids = [
+                row.id
+                for row in db.query(BatchItem.id)
+                .filter(BatchItem.job_id == job_id, BatchItem.status == "pending")
+                .order_by(BatchItem.id)
+                .all()
+            ]
+
+            semaphore = asyncio.Semaphore(settings.batch_concurrency)
+
+            async def worker(item_id: int):
+                # 与在线请求共享生成槽位，使用低优先级通道且不会被拒绝
+                async with semaphore:
+                    async with admission_service.enqueue(job.model, LANE_BULK, reject=False):
+                        await self._process_item(job, item_id, styling_img, face_img)
+
+            workers = [asyncio.create_task(worker(item_id)) for item_id in item_ids]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                # 某个生成项异常或任务被取消时，先停止其余生成项并等待其退出，再更新任务状态
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+            await self._finalize_job(db, job)
+
+            db.refresh(job)
+            job.status = "completed"
+            job.finished_at = int(time.time() * 1000)
+            db.commit()
+            print(f"✅ Batch job {job_id} completed")
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            db.rollback()
+            job = db.query(BatchJob).filter(BatchJob.id == job_id).first()
+            if job:
+                job.status = "failed"
+                job.error = str(e)
+                job.finished_at = int(time.time() * 1000)
+                db.commit()
+            print(f"Batch job {job_id} failed: {str(e)}")
+        finally:
+            db.close()
+            self._tasks.pop(job_id, None)
+
+    async def _process_item(self, job: BatchJob, item_id: int, styling_img, face_img):
+        """生成单个 look × pose，并写入检查点"""
+        db = SessionLocal()
+        try:
+            item = db.query(BatchItem).filter(BatchItem.id == item_id).first()
+            item.status = "running"
+            db.commit()
+
+            try:
+                clothes, accessories = await self._load_garments(job.id, item.garments)
+
+                last_error = None
+                img_bytes = None
+                for _ in range(settings.batch_max_attempts):
+                    item.attempts += 1
+                    started = time.monotonic()
+                    try:
+                        img_bytes = await gemini_service.generate_fashion_image(
+                            styling_ref=styling_img,
+                            face_ref=face_img,
+                            pose_id=item.pose_id,
+                            gender=job.gender,
+                            background_mode=job.background_mode,
+                            clothes=clothes or None,
+                            accessories=accessories or None,
+                            model=job.model,
+                        )
+                        break
+                    except Exception as e:
+                        last_error = e
+
+                if img_bytes is None:
+                    raise last_error
+
+                # 写入文件并在线程中生成占位图
+                (saved,) = await image_service.save_candidates(
+                    [img_bytes], item.session_id, item.pose_index
+                )
+                item.output = saved["output"]
+                item.placeholder = saved["placeholder"]
+                item.status = "done"
+                item.error = None
+                record = analytics_service.output_record(
+                    item.session_id, item.pose_index, item.pose_id, job.model, item.output,
+                    img_bytes, int((time.monotonic() - started) * 1000), None,
+                )
+
+            except Exception as e:
+                print(f"Error generating look {item.look_id} pose {item.pose_id}: {str(e)}")
+                item.status = "failed"
+                item.error = str(e)
+                record = analytics_service.output_record(
+                    item.session_id, item.pose_index, item.pose_id, job.model, None,
+                    None, None, str(e),
+                )
+
+            # 检查点：每个生成项完成后立即提交（统计记录同一事务写入）
+            analytics_service.replace_record(db, record)
+            item.finished_at = int(time.time() * 1000)
+            db.commit()
+
+            await self._finalize_look(db, job, item.session_id)
+
+        finally:
+            db.close()
+
+    async def _load_garments(self, job_id: str, garments: Dict[str, str]):
+        clothes = {}
+        accessories = {}
+        for key, name in garments.items():
+            img = await image_service.load_reference(os.path.join(self.garments_dir(job_id), name))
+            if key in CLOTHES_KEYS:
+                clothes[key] = img
+            else:
+                accessories[key] = img
+        return clothes, accessories
+
+    async def _finalize_look(self, db: DBSession, job: BatchJob, session_id: str):
+        """
+        一套服装的所有姿势都结束后，写入或更新历史记录
+
+        outputs 和 pose_status 始终由生成项重新构建，重试成功的姿势会更新到已有会话中；
+        内容没有变化时不写入。
+        """
+        if session_id in self._finalizing:
+            return
+
+        self._finalizing.add(session_id)
+        try:
+            items = (
+                db.query(BatchItem)
+                .filter(BatchItem.session_id == session_id)
+                .order_by(BatchItem.pose_index)
+                .all()
+            )
+            if any(item.status in OPEN_STATUSES for item in items):
+                return
+
+            done = [item for item in items if item.status == "done"]
+            if not done:
+                return
+
+            outputs = [item.output for item in done]
+            pose_status = [
+                {
+                    "pose_id": item.pose_id,
+                    "status": item.status,
+                    "output": item.output,
+                    "error": item.error,
+                    "placeholder": item.placeholder,
+                }
+                for item in items
+            ]
+
+            session = db.query(SessionModel).filter(SessionModel.id == session_id).first()
+            if session and session.outputs == outputs and session.pose_status == pose_status:
+                return
+
+            # 缩略图始终对应第一张成功的图片
+            thumbnail_url = session.thumbnail if session else None
+            if not thumbnail_url or session.outputs[:1] != outputs[:1]:
+                first_img_bytes = await image_service.read_generated_image(outputs[0])
+                thumbnail_bytes = await image_service.create_thumbnail(first_img_bytes)
+                thumbnail_url = await image_service.save_generated_image(
+                    thumbnail_bytes, session_id, "thumb"
+                )
+
+            if session:
+                session.outputs = outputs
+                session.pose_status = pose_status
+                session.thumbnail = thumbnail_url
+            else:
+                garments = done[0].garments
+                db.add(
+                    SessionModel(
+                        id=session_id,
+                        timestamp=int(time.time() * 1000),
+                        gender=job.gender,
+                        background_mode=job.background_mode,
+                        pose_ids=[item.pose_id for item in items],
+                        model=job.model,
+                        inputs={
+                            "styling_ref": job.inputs["styling_ref"],
+                            "face_ref": job.inputs["face_ref"],
+                            "clothes": {k: True for k in garments if k in CLOTHES_KEYS},
+                            "accessories": {k: True for k in garments if k in ACCESSORY_KEYS},
+                            "batch_job": job.id,
+                            "look_id": done[0].look_id,
+                        },
+                        outputs=outputs,
+                        thumbnail=thumbnail_url,
+                        pose_status=pose_status,
+                    )
+                )
+            db.commit()
+            history_cache.invalidate(session_id)
+        finally:
+            self._finalizing.discard(session_id)
+
+    async def _finalize_job(self, db: DBSession, job: BatchJob):
+        """
+        补写所有已结束但历史记录缺失或过期的套装
+
+        进程在生成项提交之后、会话写入之前停止时，恢复后没有待处理的生成项会触发写入，
+        因此每次运行结束时统一检查一遍。
+        """
+        session_ids = [
+            row.session_id
+            for row in db.query(BatchItem.session_id)
+            .filter(BatchItem.job_id == job.id)
+            .distinct()
+            .all()
+        ]
+        for session_id in session_ids:
+            await self._finalize_look(db, job, session_id)
+
+    def get_status(self, db: DBSession, job: BatchJob) -> Dict:
+        """任务进度、吞吐量和预计剩余时间"""
+        counts = dict(
+            db.query(BatchItem.status, func.count(BatchItem.id))
+            .filter(BatchItem.job_id == job.id)
+            .group_by(BatchItem.status)
+            .all()
+        )
+        completed = counts.get("done", 0)
+        failed = counts.get("failed", 0)
+        pending = job.total_items - completed - failed
+
+        session_ids = (
+            db.query(BatchItem.session_id)
+            .filter(BatchItem.job_id == job.id)
+            .distinct()
+        )
+        looks = session_ids.count()
+        sessions = [
+            row.id
+            for row in db.query(SessionModel.id).filter(
+                SessionModel.id.in_(session_ids.scalar_subquery())
+            )
+        ]
+
+        # 吞吐量只统计本次运行（恢复后重新计时）
+        items_per_minute = None
+        eta_seconds = None
+        if job.started_at:
+            end = job.finished_at or int(time.time() * 1000)
+            elapsed = max(end - job.started_at, 1) / 1000
+            finished_this_run = (
+                db.query(func.count(BatchItem.id))
+                .filter(
+                    BatchItem.job_id == job.id,
+                    BatchItem.status.in_(("done", "failed")),
+                    BatchItem.finished_at >= job.started_at,
+                )
+                .scalar()
+            )
+            if finished_this_run:
+                rate = finished_this_run / elapsed
+                items_per_minute = round(rate * 60, 2)
+                if job.status in OPEN_STATUSES:
+                    eta_seconds = int(pending / rate)
+
+        return {
+            "job_id": job.id,
+            "status": job.status,
+            "created_at": job.created_at,
+            "total": job.total_items,
+            "completed": completed,
+            "failed": failed,
+            "pending": pending,
+            "looks": looks,
+            "sessions": sessions,
+            "items_per_minute": items_per_minute,
+            "eta_seconds": eta_seconds,
+            "error": job.error,
+        }
+
+
+# 单例实例
+batch_service = BatchService()
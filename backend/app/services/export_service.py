@@ -0,0 +1,349 @@
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+import asyncio
+import hashlib
+import os
+import struct
+import time
+import zlib
+
+import aiofiles
+import orjson
+
+from app.config import settings
+from app.models.database import Session as SessionModel
+
+# ZIP 格式常量
+ZIP64_LIMIT = 0xFFFFFFFF  # 达到该值的偏移和大小需要 zip64 扩展
+ZIP64_COUNT_LIMIT = 0xFFFF
+ZIP64_MARKER = 0xFFFFFFFF  # 32 位字段中表示"见 zip64 扩展"
+ZIP64_COUNT_MARKER = 0xFFFF
+FLAG_UTF8 = 0x0800
+VERSION_DEFAULT = 20
+VERSION_ZIP64 = 45
+MADE_BY_UNIX = 3 << 8
+FILE_ATTRIBUTES = 0o100644 << 16
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+ZIP64_EXTRA = struct.Struct("<HHQ")
+ZIP64_END = struct.Struct("<IQHHIIQQQQ")
+ZIP64_LOCATOR = struct.Struct("<IIQI")
+END_RECORD = struct.Struct("<IHHHHIIH")
+
+
+class RangeNotSatisfiable(Exception):
+    """请求的字节范围超出归档大小"""
+
+
+class ExportChanged(Exception):
+    """导出过程中文件被修改或删除，已发送的数据与声明的布局不一致"""
+
+
+class _Entry:
+    """归档中的一个文件（不压缩：生成的 PNG 已经是压缩格式）"""
+
+    def __init__(
+        self,
+        name: str,
+        timestamp: int,
+        path: Optional[str] = None,
+        data: Optional[bytes] = None,
+        size: int = 0,
+        mtime_ns: int = 0,
+    ):
+        self.name = name.encode()
+        self.path = path
+        self.data = data
+        self.size = len(data) if data is not None else size
+        self.mtime_ns = mtime_ns
+        self.crc = zlib.crc32(data) if data is not None else None
+        self.offset = 0
+        self.dos_time, self.dos_date = _dos_datetime(timestamp)
+
+    @property
+    def header_size(self) -> int:
+        return LOCAL_HEADER.size + len(self.name)
+
+    @property
+    def local_size(self) -> int:
+        return self.header_size + self.size
+
+    @property
+    def central_size(self) -> int:
+        extra = ZIP64_EXTRA.size if self.offset >= ZIP64_LIMIT else 0
+        return CENTRAL_HEADER.size + len(self.name) + extra
+
+    def local_header(self) -> bytes:
+        return LOCAL_HEADER.pack(
+            0x04034B50, VERSION_DEFAULT, FLAG_UTF8, 0, self.dos_time, self.dos_date,
+            self.crc, self.size, self.size, len(self.name), 0,
+        ) + self.name
+
+    def central_header(self) -> bytes:
+        zip64 = self.offset >= ZIP64_LIMIT
+        extra = ZIP64_EXTRA.pack(0x0001, 8, self.offset) if zip64 else b""
+        version = VERSION_ZIP64 if zip64 else VERSION_DEFAULT
+        return CENTRAL_HEADER.pack(
+            0x02014B50, MADE_BY_UNIX | VERSION_ZIP64, version, FLAG_UTF8, 0,
+            self.dos_time, self.dos_date, self.crc, self.size, self.size,
+            len(self.name), len(extra), 0, 0, 0, FILE_ATTRIBUTES,
+            ZIP64_MARKER if zip64 else self.offset,
+        ) + self.name + extra
+
+
+class ExportArchive:
+    """
+    一次导出的 ZIP 布局
+
+    布局只依赖文件名和文件大小，在读取任何文件内容之前即可确定总大小、每个条目的偏移和 ETag，
+    因此可以声明 Content-Length 并响应任意字节范围（断点续传）。
+    """
+
+    def __init__(self, entries: List[_Entry]):
+        self.entries = entries
+
+        offset = 0
+        for entry in entries:
+            entry.offset = offset
+            offset += entry.local_size
+        self.cd_offset = offset
+        self.cd_size = sum(entry.central_size for entry in entries)
+
+        self.zip64 = (
+            len(entries) >= ZIP64_COUNT_LIMIT
+            or self.cd_offset >= ZIP64_LIMIT
+            or self.cd_size >= ZIP64_LIMIT
+        )
+        trailer = END_RECORD.size
+        if self.zip64:
+            trailer += ZIP64_END.size + ZIP64_LOCATOR.size
+        self.size = self.cd_offset + self.cd_size + trailer
+
+        digest = hashlib.sha256()
+        for entry in entries:
+            digest.update(entry.name)
+            digest.update(struct.pack("<QQ", entry.size, entry.mtime_ns))
+            if entry.data is not None:
+                digest.update(entry.data)
+        self.etag = f'"{digest.hexdigest()[:32]}"'
+
+    def trailer(self) -> bytes:
+        """中央目录之后的结束记录"""
+        count = len(self.entries)
+        records = b""
+        if self.zip64:
+            zip64_end_offset = self.cd_offset + self.cd_size
+            records += ZIP64_END.pack(
+                0x06064B50, ZIP64_END.size - 12, MADE_BY_UNIX | VERSION_ZIP64, VERSION_ZIP64,
+                0, 0, count, count, self.cd_size, self.cd_offset,
+            )
+            records += ZIP64_LOCATOR.pack(0x07064B50, 0, zip64_end_offset, 1)
+        return records + END_RECORD.pack(
+            0x06054B50, 0, 0,
+            ZIP64_COUNT_MARKER if count >= ZIP64_COUNT_LIMIT else count,
+            ZIP64_COUNT_MARKER if count >= ZIP64_COUNT_LIMIT else count,
+            ZIP64_MARKER if self.cd_size >= ZIP64_LIMIT else self.cd_size,
+            ZIP64_MARKER if self.cd_offset >= ZIP64_LIMIT else self.cd_offset,
+            0,
+        )
+
+
+class ExportService:
+    """
+    会话导出（流式 ZIP）
+
+    - 归档包含所选会话的生成图片和一份 manifest.json
+    - 边读边发送，内存占用与归档大小无关；每个文件在发送本地文件头前计算一次 CRC
+    - 支持单个 Range 请求：跳过的文件不发送，但仍需要 CRC 来生成中央目录（结果会缓存）
+    """
+
+    def __init__(self):
+        self._crc_cache: "OrderedDict[Tuple[str, int, int], int]" = OrderedDict()
+
+    def build(self, sessions: List[SessionModel]) -> ExportArchive:
+        """根据会话构造归档布局（只读取文件元数据）"""
+        entries = []
+        manifest = []
+        for session in sessions:
+            files = {}
+            for url in session.outputs or []:
+                filename = os.path.basename(url)
+                path = os.path.join(settings.output_dir, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                name = f"{session.id}/{filename}"
+                files[url] = name
+                entries.append(
+                    _Entry(name, session.timestamp, path=path, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+                )
+
+            manifest.append(self._describe(session, files))
+
+        manifest_bytes = orjson.dumps(
+            {"sessions": manifest}, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS
+        )
+        newest = max((session.timestamp for session in sessions), default=0)
+        entries.insert(0, _Entry("manifest.json", newest, data=manifest_bytes))
+        return ExportArchive(entries)
+
+    def parse_range(self, header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+        """
+        解析 Range 请求头
+
+        Returns:
+            (start, end)，end 为包含的最后一个字节；无 Range 或无法处理的格式（如多个范围）返回 None
+
+        Raises:
+            RangeNotSatisfiable: 范围超出归档大小
+        """
+        if not header or not header.startswith("bytes=") or "," in header:
+            return None
+        start_text, _, end_text = header[len("bytes="):].strip().partition("-")
+        try:
+            if not start_text:
+                # 最后 N 个字节
+                length = int(end_text)
+                if length <= 0:
+                    raise RangeNotSatisfiable()
+                return max(size - length, 0), size - 1
+            start = int(start_text)
+            end = int(end_text) if end_text else size - 1
+        except ValueError:
+            return None
+
+        if start >= size or end < start:
+            raise RangeNotSatisfiable()
+        return start, min(end, size - 1)
+
+    async def stream(
+        self, archive: ExportArchive, start: int = 0, end: Optional[int] = None
+    ) -> AsyncIterator[bytes]:
+        """按顺序生成归档中 [start, end] 范围内的字节"""
+        end = archive.size - 1 if end is None else end
+
+        for entry in archive.entries:
+            data_offset = entry.offset + entry.header_size
+            entry_end = entry.offset + entry.local_size
+            if entry_end <= start:
+                continue
+            if entry.offset > end:
+                break
+
+            await self._ensure_crc(entry)
+            chunk = _slice(entry.local_header(), entry.offset, start, end)
+            if chunk:
+                yield chunk
+
+            if entry.data is not None:
+                chunk = _slice(entry.data, data_offset, start, end)
+                if chunk:
+                    yield chunk
+            else:
+                async for chunk in self._read(entry, max(start - data_offset, 0), min(end + 1, entry_end) - data_offset):
+                    yield chunk
+
+        if end >= archive.cd_offset:
+            # 中央目录需要所有文件的 CRC（Range 跳过的文件在这里补算）
+            for entry in archive.entries:
+                await self._ensure_crc(entry)
+            tail = b"".join(entry.central_header() for entry in archive.entries) + archive.trailer()
+            chunk = _slice(tail, archive.cd_offset, start, end)
+            if chunk:
+                yield chunk
+
+    def filename(self, sessions: List[SessionModel]) -> str:
+        if len(sessions) == 1:
+            return f"vm-studio-{sessions[0].id}.zip"
+        return f"vm-studio-export-{time.strftime('%Y%m%d-%H%M%S')}.zip"
+
+    def _describe(self, session: SessionModel, files: Dict[str, str]) -> Dict:
+        """manifest 中的会话描述，图片路径为归档内路径"""
+        inputs = {
+            key: value for key, value in (session.inputs or {}).items() if key != "references"
+        }
+        poses = []
+        for pose in session.pose_results():
+            urls = [candidate["output"] for candidate in pose.get("candidates") or []]
+            if not urls and pose.get("output"):
+                urls = [pose["output"]]
+            poses.append(
+                {
+                    "pose_id": pose["pose_id"],
+                    "status": pose["status"],
+                    "error": pose.get("error"),
+                    "files": [files[url] for url in urls if url in files],
+                }
+            )
+        return {
+            "id": session.id,
+            "timestamp": session.timestamp,
+            "parameters": session.parameters(),
+            "inputs": inputs,
+            "poses": poses,
+        }
+
+    async def _ensure_crc(self, entry: _Entry):
+        if entry.crc is not None:
+            return
+        key = (entry.path, entry.size, entry.mtime_ns)
+        crc = self._crc_cache.get(key)
+        if crc is None:
+            crc = await asyncio.to_thread(self._file_crc, entry)
+            self._crc_cache[key] = crc
+            while len(self._crc_cache) > settings.export_crc_cache_size:
+                self._crc_cache.popitem(last=False)
+        else:
+            self._crc_cache.move_to_end(key)
+        entry.crc = crc
+
+    def _file_crc(self, entry: _Entry) -> int:
+        self._check_unchanged(entry)
+        crc = 0
+        with open(entry.path, "rb") as f:
+            while True:
+                chunk = f.read(settings.export_chunk_size)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+        return crc
+
+    async def _read(self, entry: _Entry, start: int, stop: int) -> AsyncIterator[bytes]:
+        """读取文件中 [start, stop) 范围的数据"""
+        await asyncio.to_thread(self._check_unchanged, entry)
+        async with aiofiles.open(entry.path, "rb") as f:
+            await f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = await f.read(min(settings.export_chunk_size, remaining))
+                if not chunk:
+                    raise ExportChanged(f"{entry.path} was truncated during export")
+                remaining -= len(chunk)
+                yield chunk
+
+    def _check_unchanged(self, entry: _Entry):
+        try:
+            stat = os.stat(entry.path)
+        except OSError:
+            raise ExportChanged(f"{entry.path} was removed during export")
+        if stat.st_size != entry.size or stat.st_mtime_ns != entry.mtime_ns:
+            raise ExportChanged(f"{entry.path} was modified during export")
+
+
+def _slice(data: bytes, offset: int, start: int, end: int) -> bytes:
+    """data 位于归档偏移 offset 处，返回其落在 [start, end] 内的部分"""
+    return data[max(start - offset, 0):max(end + 1 - offset, 0)]
+
+
+def _dos_datetime(timestamp_ms: int) -> Tuple[int, int]:
+    """毫秒时间戳转换为 ZIP 使用的 DOS 日期和时间（本地时间，最早 1980 年）"""
+    t = time.localtime(max(timestamp_ms / 1000, 315532800))
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+# 单例实例
+export_service = ExportService()
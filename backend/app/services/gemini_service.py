@@ -1,11 +1,18 @@
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 from PIL import Image
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Union
 from app.config import settings
+from app.services.http_transport import gemini_transport
+import asyncio
 import base64
 import io
 
+# 参考图：已编码的 PNG / JPEG 字节（ImageService.load_reference）或 PIL 图片
+ReferenceImage = Union[bytes, Image.Image]
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
 
 class GeminiService:
     def __init__(self):
@@ -13,16 +20,20 @@ class GeminiService:
             api_key=settings.gemini_api_key,
             http_options={'base_url': settings.google_gemini_base_url}
         )
+        # 使用共享连接池（HTTP/2 + keep-alive）
+        gemini_transport.install(self.client._api_client)
+        # 各模型是否支持 candidate_count（请求被拒绝后记为 False）
+        self._candidate_count_supported: Dict[str, bool] = {}
 
     async def generate_fashion_image(
         self,
-        styling_ref: Image.Image,
-        face_ref: Image.Image,
+        styling_ref: ReferenceImage,
+        face_ref: ReferenceImage,
         pose_id: str,
         gender: str,
         background_mode: str,
-        clothes: Optional[Dict[str, Image.Image]] = None,
-        accessories: Optional[Dict[str, Image.Image]] = None,
+        clothes: Optional[Dict[str, ReferenceImage]] = None,
+        accessories: Optional[Dict[str, ReferenceImage]] = None,
         model: str = None,
     ) -> bytes:
         """
@@ -41,6 +52,39 @@ class GeminiService:
         Returns:
             生成的图片字节数据
         """
+        images = await self.generate_candidates(
+            styling_ref=styling_ref,
+            face_ref=face_ref,
+            pose_id=pose_id,
+            gender=gender,
+            background_mode=background_mode,
+            clothes=clothes,
+            accessories=accessories,
+            model=model,
+        )
+        return images[0]
+
+    async def generate_candidates(
+        self,
+        styling_ref: ReferenceImage,
+        face_ref: ReferenceImage,
+        pose_id: str,
+        gender: str,
+        background_mode: str,
+        clothes: Optional[Dict[str, ReferenceImage]] = None,
+        accessories: Optional[Dict[str, ReferenceImage]] = None,
+        model: str = None,
+        count: int = 1,
+    ) -> List[bytes]:
+        """
+        为同一姿势生成多张候选图片
+
+        优先在一次请求中通过 candidate_count 获取所有候选；模型不支持或返回的候选不足时，
+        用共享同一份 contents 的并发请求补齐。部分请求失败时返回已成功的候选。
+
+        Returns:
+            候选图片字节数据列表（至少一张）
+        """
         model_name = model or settings.gemini_model
 
         # 构建提示词
@@ -54,79 +98,153 @@ class GeminiService:
 
         # 调用 Gemini API
         try:
-            # 构建 multimodal contents - 文本 + 图片标注 + 图片数据
-            contents = [prompt]
-
-            # 添加 Styling Reference
-            contents.append("\n[Reference Image: Styling Reference]")
-            contents.append(styling_ref)
-
-            # 添加 Face Reference
-            contents.append("\n[Reference Image: Face Reference]")
-            contents.append(face_ref)
-
-            # 添加服装图片
-            if clothes:
-                clothing_labels = {
-                    'top': 'Garment Top',
-                    'bottom': 'Garment Bottom',
-                    'shoes': 'Shoes',
-                    'sunglasses': 'Sunglasses'
-                }
-                for key, img in clothes.items():
-                    if img:
-                        label = clothing_labels.get(key, key.title())
-                        contents.append(f"\n[Reference Image: {label}]")
-                        contents.append(img)
-
-            # 添加配饰图片
-            if accessories:
-                accessory_labels = {
-                    'necklace': 'Necklace',
-                    'earrings': 'Earrings',
-                    'jewelry': 'Jewelry',
-                    'hat': 'Hat/Scarf',
-                    'bag': 'Bag',
-                    'belt': 'Belt'
-                }
-                for key, img in accessories.items():
-                    if img:
-                        label = accessory_labels.get(key, key.title())
-                        contents.append(f"\n[Reference Image: {label}]")
-                        contents.append(img)
-
-            # 使用 generate_content API with IMAGE response modality
-            response = self.client.models.generate_content(
-                model=model_name,
-                contents=contents,
-                config=types.GenerateContentConfig(
-                    response_modalities=["IMAGE"],
-                    temperature=1.0,
-                ),
-            )
-
-            # 提取生成的图片
-            if response.candidates and len(response.candidates) > 0:
-                candidate = response.candidates[0]
-                if candidate.content and candidate.content.parts:
-                    for part in candidate.content.parts:
-                        if hasattr(part, "inline_data") and part.inline_data:
-                            # inline_data.data 是 base64 编码的字符串，需要解码
-                            if isinstance(part.inline_data.data, str):
-                                return base64.b64decode(part.inline_data.data)
-                            else:
-                                return part.inline_data.data
-                        elif hasattr(part, "image") and part.image:
-                            # 如果是 PIL Image，转换为字节
-                            img_bytes = io.BytesIO()
-                            part.image.save(img_bytes, format='PNG')
-                            return img_bytes.getvalue()
-
-            raise Exception("No image generated in response")
+            contents = self._build_contents(prompt, styling_ref, face_ref, clothes, accessories)
+
+            images = []
+            if count > 1 and self._candidate_count_supported.get(model_name, True):
+                images = await self._generate_multi(model_name, contents, count)
+
+            missing = count - len(images)
+            if missing:
+                responses = await asyncio.gather(
+                    *[self._generate(model_name, contents) for _ in range(missing)],
+                    return_exceptions=True,
+                )
+                failures = []
+                for response in responses:
+                    if isinstance(response, BaseException):
+                        failures.append(response)
+                        continue
+                    try:
+                        images.append(self._extract_image(response))
+                    except Exception as e:
+                        failures.append(e)
+                if not images:
+                    raise failures[0]
+
+            return images[:count]
 
         except Exception as e:
             raise Exception(f"Gemini API error: {str(e)}")
 
+    def _build_contents(
+        self,
+        prompt: str,
+        styling_ref: ReferenceImage,
+        face_ref: ReferenceImage,
+        clothes: Optional[Dict[str, ReferenceImage]],
+        accessories: Optional[Dict[str, ReferenceImage]],
+    ) -> list:
+        """构建 multimodal contents - 文本 + 图片标注 + 图片数据"""
+        contents = [prompt]
+
+        # 添加 Styling Reference
+        contents.append("\n[Reference Image: Styling Reference]")
+        contents.append(self._image_part(styling_ref))
+
+        # 添加 Face Reference
+        contents.append("\n[Reference Image: Face Reference]")
+        contents.append(self._image_part(face_ref))
+
+        # 添加服装图片
+        if clothes:
+            clothing_labels = {
+                'top': 'Garment Top',
+                'bottom': 'Garment Bottom',
+                'shoes': 'Shoes',
+                'sunglasses': 'Sunglasses'
+            }
+            for key, img in clothes.items():
+                if img:
+                    label = clothing_labels.get(key, key.title())
+                    contents.append(f"\n[Reference Image: {label}]")
+                    contents.append(self._image_part(img))
+
+        # 添加配饰图片
+        if accessories:
+            accessory_labels = {
+                'necklace': 'Necklace',
+                'earrings': 'Earrings',
+                'jewelry': 'Jewelry',
+                'hat': 'Hat/Scarf',
+                'bag': 'Bag',
+                'belt': 'Belt'
+            }
+            for key, img in accessories.items():
+                if img:
+                    label = accessory_labels.get(key, key.title())
+                    contents.append(f"\n[Reference Image: {label}]")
+                    contents.append(self._image_part(img))
+
+        return contents
+
+    async def _generate(
+        self, model_name: str, contents: list, candidate_count: Optional[int] = None
+    ) -> types.GenerateContentResponse:
+        # 使用 generate_content API with IMAGE response modality
+        # 在 Gemini 专用线程池中执行同步请求，不阻塞事件循环，也不占用默认线程池
+        return await gemini_transport.run(
+            self.client.models.generate_content,
+            model=model_name,
+            contents=contents,
+            config=types.GenerateContentConfig(
+                response_modalities=["IMAGE"],
+                temperature=1.0,
+                candidate_count=candidate_count,
+            ),
+        )
+
+    async def _generate_multi(self, model_name: str, contents: list, count: int) -> List[bytes]:
+        """一次请求获取多个候选；模型拒绝 candidate_count 时记录下来，之后直接使用并发请求"""
+        try:
+            response = await self._generate(model_name, contents, candidate_count=count)
+        except errors.APIError as e:
+            # 只有拒绝的是 candidate_count 时才回退（如 "Multiple candidates is not enabled"、
+            # "candidateCount must be 1"），其他 400 错误（如参考图不合法）照常抛出
+            if e.code != 400 or "candidate" not in (e.message or "").lower():
+                raise
+            print(f"⚠️ {model_name} rejected candidate_count, using concurrent requests: {e.message}")
+            self._candidate_count_supported[model_name] = False
+            return []
+        return self._extract_images(response)
+
+    def _image_part(self, image: ReferenceImage):
+        """已编码的参考图直接作为 inline_data 发送，无需每个姿势重新编码"""
+        if isinstance(image, bytes):
+            mime_type = "image/png" if image.startswith(PNG_SIGNATURE) else "image/jpeg"
+            return types.Part(inline_data=types.Blob(mime_type=mime_type, data=image))
+        return image
+
+    def _extract_image(self, response: types.GenerateContentResponse) -> bytes:
+        """从响应中提取第一张生成的图片"""
+        if response.candidates and len(response.candidates) > 0:
+            image = self._candidate_image(response.candidates[0])
+            if image:
+                return image
+
+        raise Exception("No image generated in response")
+
+    def _extract_images(self, response: types.GenerateContentResponse) -> List[bytes]:
+        """提取每个候选中的图片（没有图片的候选被跳过）"""
+        images = [self._candidate_image(candidate) for candidate in response.candidates or []]
+        return [image for image in images if image]
+
+    def _candidate_image(self, candidate: types.Candidate) -> Optional[bytes]:
+        if candidate.content and candidate.content.parts:
+            for part in candidate.content.parts:
+                if hasattr(part, "inline_data") and part.inline_data:
+                    # inline_data.data 是 base64 编码的字符串，需要解码
+                    if isinstance(part.inline_data.data, str):
+                        return base64.b64decode(part.inline_data.data)
+                    else:
+                        return part.inline_data.data
+                elif hasattr(part, "image") and part.image:
+                    # 如果是 PIL Image，转换为字节
+                    img_bytes = io.BytesIO()
+                    part.image.save(img_bytes, format='PNG')
+                    return img_bytes.getvalue()
+        return None
+
     def _build_prompt(
         self,
         pose_id: str,
@@ -205,40 +323,6 @@ I will provide the images labeled by their category below.
 
         return prompt
 
-    async def generate_batch(
-        self,
-        styling_ref: Image.Image,
-        face_ref: Image.Image,
-        pose_ids: List[str],
-        gender: str,
-        background_mode: str,
-        clothes: Optional[Dict[str, Image.Image]] = None,
-        accessories: Optional[Dict[str, Image.Image]] = None,
-        model: str = None,
-    ) -> List[bytes]:
-        """批量生成多个姿势的图片"""
-
-        results = []
-        for pose_id in pose_ids:
-            try:
-                image_bytes = await self.generate_fashion_image(
-                    styling_ref=styling_ref,
-                    face_ref=face_ref,
-                    pose_id=pose_id,
-                    gender=gender,
-                    background_mode=background_mode,
-                    clothes=clothes,
-                    accessories=accessories,
-                    model=model,
-                )
-                results.append(image_bytes)
-            except Exception as e:
-                print(f"Error generating pose {pose_id}: {str(e)}")
-                # 继续生成其他姿势
-                continue
-
-        return results
-
 
 # 单例实例
 gemini_service = GeminiService()
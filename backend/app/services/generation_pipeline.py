@@ -0,0 +1,381 @@
+from typing import Callable, Dict, List, Optional, Set
+import asyncio
+import time
+import uuid
+
+from app.config import settings
+from app.models.database import Output, Session as SessionModel, SessionLocal
+from app.models.schemas import CLOTHES_KEYS, ACCESSORY_KEYS
+from app.services.admission_service import Ticket
+from app.services.analytics_service import analytics_service
+from app.services.gemini_service import gemini_service
+from app.services.history_cache import history_cache
+from app.services.image_service import image_service
+
+
+class GenerationContext:
+    """一次生成在各阶段之间传递的状态"""
+
+    def __init__(
+        self,
+        upload_paths: Dict[str, str],
+        filenames: Dict[str, str],
+        parameters: Dict,
+        session_id: Optional[str] = None,
+    ):
+        self.session_id = session_id or str(uuid.uuid4())
+        self.timestamp = int(time.time() * 1000)
+        self.upload_paths = upload_paths
+        self.filenames = filenames
+        self.parameters = parameters
+
+        # ingest
+        # 参考图只保留编码后的字节，解码后的像素加载完即释放
+        self.styling_img: Optional[bytes] = None
+        self.face_img: Optional[bytes] = None
+        self.clothes: Dict[str, bytes] = {}
+        self.accessories: Dict[str, bytes] = {}
+
+        # generate / save（按姿势序号）
+        pose_ids = parameters["pose_ids"]
+        self.targets: List[int] = list(range(len(pose_ids)))  # 需要生成的姿势序号
+        self.pose_status: List[Optional[Dict]] = [None] * len(pose_ids)
+        self.output_records: List[List[Output]] = [[] for _ in pose_ids]  # 每张候选一条统计记录
+        self.thumbnail_source: Optional[int] = None  # 用于生成缩略图的姿势序号（第一张成功的图片）
+        self.thumbnail_url: Optional[str] = None
+
+        # 每个阶段的累计耗时（毫秒）
+        self.timings: Dict[str, int] = {}
+
+    @property
+    def total(self) -> int:
+        return len(self.parameters["pose_ids"])
+
+    @property
+    def candidates_per_pose(self) -> int:
+        return self.parameters.get("candidates_per_pose", 1)
+
+
+def output_urls(pose_status: List[Dict]) -> List[str]:
+    """会话的所有成功图片：按姿势顺序，每个姿势的第一张候选在前"""
+    urls = []
+    for pose in pose_status:
+        candidates = [candidate["output"] for candidate in pose.get("candidates") or []]
+        urls.extend(candidates or ([pose["output"]] if pose.get("output") else []))
+    return urls
+
+
+class GenerationPipeline:
+    """
+    分阶段的生成流水线（/api/generate 和 /api/generate/stream 共用）
+
+    admit → ingest → generate（逐个姿势）→ save（与下一个姿势的生成重叠）→ thumbnail → persist
+
+    - 姿势 N 生成完成后，保存、占位图和缩略图在后台进行，同时开始生成姿势 N+1
+    - 每个阶段单独计时，结果记录在 GenerationContext.timings
+    - 阶段均为普通方法，可在子类中替换
+    - 进度通过 on_event 回调发布，流式接口将其转发到 SSE
+    - 进行中的会话登记在 active_sessions() 中（包括重新生成），存储清理不会删除其文件
+    """
+
+    # 进行中的会话 -> 正在运行的生成数（所有流水线实例共享）
+    _active: Dict[str, int] = {}
+
+    def active_sessions(self) -> Set[str]:
+        """正在生成（尚未写入数据库）的会话"""
+        return set(self._active)
+
+    async def run(
+        self,
+        ctx: GenerationContext,
+        ticket: Ticket,
+        on_event: Optional[Callable[[Dict], None]] = None,
+    ) -> SessionModel:
+        emit = on_event or (lambda event: None)
+        saves: List[asyncio.Task] = []
+        self._active[ctx.session_id] = self._active.get(ctx.session_id, 0) + 1
+
+        try:
+            await self._timed(ctx, "admit", self.admit(ctx, ticket, emit))
+
+            emit({'status': 'processing', 'message': '图片上传完成，开始生成...', 'session_id': ctx.session_id})
+            await self._timed(ctx, "ingest", self.ingest(ctx))
+
+            for idx in ctx.targets:
+                pose_id = ctx.parameters["pose_ids"][idx]
+                emit({'status': 'generating', 'message': f'正在生成第 {idx + 1}/{ctx.total} 张图片 (姿势: {pose_id})', 'progress': idx / ctx.total, 'current': idx + 1, 'total': ctx.total})
+
+                result = await self._timed(ctx, "generate", self.generate_pose(ctx, idx, pose_id))
+                self.select_thumbnail(ctx, idx, result)
+
+                # 保存与下一个姿势的生成并行
+                saves.append(
+                    asyncio.create_task(self._timed(ctx, "save", self.save_pose(ctx, idx, result, emit)))
+                )
+
+            await asyncio.gather(*saves)
+
+            if ctx.thumbnail_source is not None:
+                emit({'status': 'finalizing', 'message': '正在创建缩略图...'})
+
+            return await self._timed(ctx, "persist", self.persist(ctx))
+
+        finally:
+            ticket.release()
+            self._active[ctx.session_id] -= 1
+            if not self._active[ctx.session_id]:
+                del self._active[ctx.session_id]
+            for task in saves:
+                task.cancel()
+            await asyncio.gather(*saves, return_exceptions=True)
+            await self.cleanup(ctx)
+
+            if settings.debug:
+                stages = ", ".join(f"{name}={ms}ms" for name, ms in ctx.timings.items())
+                print(f"⏱️ Session {ctx.session_id}: {stages}")
+
+    async def admit(self, ctx: GenerationContext, ticket: Ticket, emit: Callable[[Dict], None]):
+        """等待生成槽位；排队期间不解码参考图，等待的请求只占用磁盘上的上传文件"""
+        await ticket.wait(
+            on_position=lambda position: emit({'status': 'queued', 'message': f'排队中，当前第 {position} 位', 'position': position, 'session_id': ctx.session_id})
+        )
+
+    async def ingest(self, ctx: GenerationContext):
+        """加载参考图、服装和配饰图片（在全局内存预算内逐张解码）"""
+        ctx.styling_img = await image_service.load_reference(ctx.upload_paths["styling_ref"])
+        ctx.face_img = await image_service.load_reference(ctx.upload_paths["face_ref"])
+
+        for name, path in ctx.upload_paths.items():
+            if name in CLOTHES_KEYS:
+                ctx.clothes[name] = await image_service.load_reference(path)
+            elif name in ACCESSORY_KEYS:
+                ctx.accessories[name] = await image_service.load_reference(path)
+
+    async def generate_pose(self, ctx: GenerationContext, idx: int, pose_id: str) -> Dict:
+        """
+        生成单个姿势的所有候选（失败不影响其他姿势）
+
+        Returns:
+            {"pose_id", "image": 第一张候选或 None, "images": 所有候选, "error": str 或 None, "latency_ms": int}
+        """
+        started = time.monotonic()
+        try:
+            images = await gemini_service.generate_candidates(
+                styling_ref=ctx.styling_img,
+                face_ref=ctx.face_img,
+                pose_id=pose_id,
+                gender=ctx.parameters["gender"],
+                background_mode=ctx.parameters["background_mode"],
+                clothes=ctx.clothes or None,
+                accessories=ctx.accessories or None,
+                model=ctx.parameters["model"],
+                count=ctx.candidates_per_pose,
+            )
+            error = None
+        except Exception as e:
+            print(f"Error generating pose {pose_id}: {str(e)}")
+            images, error = [], str(e)
+
+        return {
+            "pose_id": pose_id,
+            "image": images[0] if images else None,
+            "images": images,
+            "error": error,
+            "latency_ms": int((time.monotonic() - started) * 1000),
+        }
+
+    def select_thumbnail(self, ctx: GenerationContext, idx: int, result: Dict):
+        """第一张成功的图片用于生成缩略图（在保存时并发创建）"""
+        if result["image"] and ctx.thumbnail_source is None:
+            ctx.thumbnail_source = idx
+
+    def output_index(self, ctx: GenerationContext, idx: int):
+        """生成图片文件名中的姿势序号部分"""
+        return idx
+
+    async def save_pose(
+        self, ctx: GenerationContext, idx: int, result: Dict, emit: Callable[[Dict], None]
+    ):
+        """
+        保存生成的所有候选（文件按姿势序号命名）、占位图和统计记录，第一张成功的图片同时生成缩略图
+
+        候选的写入和缩略图并发进行
+        """
+        candidates = []
+        if result["images"]:
+            work = [
+                image_service.save_candidates(
+                    result["images"], ctx.session_id, self.output_index(ctx, idx)
+                )
+            ]
+            if idx == ctx.thumbnail_source:
+                work.append(self._timed(ctx, "thumbnail", self.thumbnail(ctx, result["image"])))
+            candidates = (await asyncio.gather(*work))[0]
+
+        url = candidates[0]["output"] if candidates else None
+        placeholder = candidates[0]["placeholder"] if candidates else None
+        ctx.pose_status[idx] = {
+            "pose_id": result["pose_id"],
+            "status": "done" if url else "failed",
+            "output": url,
+            "error": result["error"],
+            "placeholder": placeholder,
+            "candidates": candidates,
+        }
+        ctx.output_records[idx] = analytics_service.candidate_records(
+            ctx.session_id, idx, result["pose_id"], ctx.parameters["model"],
+            [candidate["output"] for candidate in candidates], result["images"],
+            result["latency_ms"], result["error"],
+        )
+
+        if url:
+            emit({'status': 'generating', 'message': f'第 {idx + 1}/{ctx.total} 张图片生成完成', 'progress': (idx + 1) / ctx.total, 'current': idx + 1, 'total': ctx.total, 'completed_image': url, 'placeholder': placeholder, 'candidates': candidates})
+        else:
+            emit({'status': 'generating', 'message': f'第 {idx + 1}/{ctx.total} 张图片生成失败', 'progress': (idx + 1) / ctx.total, 'current': idx + 1, 'total': ctx.total, 'failed_pose': result["pose_id"], 'error': result["error"]})
+
+    async def thumbnail(self, ctx: GenerationContext, image_bytes: bytes):
+        """创建缩略图"""
+        thumbnail_bytes = await image_service.create_thumbnail(image_bytes)
+        ctx.thumbnail_url = await image_service.save_generated_image(
+            thumbnail_bytes, ctx.session_id, "thumb"
+        )
+
+    async def persist(self, ctx: GenerationContext) -> SessionModel:
+        """保留参考图（便于之后只重新生成失败的姿势）并写入数据库"""
+        references = await image_service.save_references(ctx.session_id, ctx.upload_paths)
+
+        session_record = SessionModel(
+            id=ctx.session_id,
+            timestamp=ctx.timestamp,
+            gender=ctx.parameters["gender"],
+            background_mode=ctx.parameters["background_mode"],
+            pose_ids=ctx.parameters["pose_ids"],
+            model=ctx.parameters["model"],
+            candidates_per_pose=ctx.candidates_per_pose,
+            inputs={
+                "styling_ref": ctx.filenames["styling_ref"],
+                "face_ref": ctx.filenames["face_ref"],
+                "clothes": {k: True for k in ctx.clothes.keys()},
+                "accessories": {k: True for k in ctx.accessories.keys()},
+                "references": references,
+            },
+            outputs=output_urls(ctx.pose_status),
+            thumbnail=ctx.thumbnail_url,
+            pose_status=ctx.pose_status,
+        )
+
+        db = SessionLocal()
+        try:
+            db.add(session_record)
+            db.add_all(record for records in ctx.output_records for record in records)
+            db.commit()
+            db.refresh(session_record)
+            db.expunge(session_record)
+        finally:
+            db.close()
+
+        history_cache.invalidate(ctx.session_id)
+        return session_record
+
+    async def cleanup(self, ctx: GenerationContext):
+        """清理上传的临时文件（已移入参考图目录的文件会被跳过）"""
+        await image_service.cleanup_uploads(list(ctx.upload_paths.values()))
+
+    async def _timed(self, ctx: GenerationContext, stage: str, coro):
+        started = time.monotonic()
+        try:
+            return await coro
+        finally:
+            elapsed = int((time.monotonic() - started) * 1000)
+            ctx.timings[stage] = ctx.timings.get(stage, 0) + elapsed
+
+
+class RegenerationContext(GenerationContext):
+    """重新生成已保存会话中部分姿势的状态：参考图来自会话的参考图目录，其余姿势保留原有结果"""
+
+    def __init__(self, session: SessionModel, targets: List[int]):
+        references = session.inputs["references"]
+        super().__init__(
+            {name: image_service.reference_path(path) for name, path in references.items()},
+            {},
+            session.parameters(),
+            session_id=session.id,
+        )
+        self.targets = targets
+        self.pose_status = [dict(pose) for pose in session.pose_results()]
+        self.previous_outputs: List[str] = list(session.outputs or [])
+        self.thumbnail_url = session.thumbnail
+        self.replaced: List[str] = []  # 被新图片替换的旧图片，写入数据库后删除
+
+
+class RegenerationPipeline(GenerationPipeline):
+    """
+    重新生成会话中的部分姿势（/api/generate/{session_id}/regenerate）
+
+    复用生成流水线的 ingest / generate / save 阶段，persist 原地更新会话记录：
+    - 新图片使用带随机后缀的文件名，避免客户端缓存旧图片
+    - 重新生成失败时保留原有结果
+    - 缩略图始终对应第一张成功的图片
+    """
+
+    def select_thumbnail(self, ctx: RegenerationContext, idx: int, result: Dict):
+        # 其他姿势的结果可能保持不变，缩略图在 persist 中根据最终结果决定
+        pass
+
+    def output_index(self, ctx: RegenerationContext, idx: int):
+        return f"{idx}_{uuid.uuid4().hex[:8]}"
+
+    async def save_pose(
+        self, ctx: RegenerationContext, idx: int, result: Dict, emit: Callable[[Dict], None]
+    ):
+        previous = ctx.pose_status[idx]
+        if not result["images"]:
+            # 保留原有结果，未成功过的姿势记录本次失败
+            ctx.pose_status[idx] = {**previous, "error": result["error"]}
+            if previous["status"] != "done":
+                ctx.output_records[idx] = analytics_service.candidate_records(
+                    ctx.session_id, idx, result["pose_id"], ctx.parameters["model"], [],
+                    [], result["latency_ms"], result["error"],
+                )
+            return
+
+        await super().save_pose(ctx, idx, result, emit)
+        ctx.replaced.extend(output_urls([previous]))
+
+    async def persist(self, ctx: RegenerationContext) -> SessionModel:
+        """更新会话记录和统计记录，然后删除被替换的旧图片"""
+        urls = output_urls(ctx.pose_status)
+        if urls and (not ctx.thumbnail_url or urls[:1] != ctx.previous_outputs[:1]):
+            first_img_bytes = await image_service.read_generated_image(urls[0])
+            await self._timed(ctx, "thumbnail", self.thumbnail(ctx, first_img_bytes))
+
+        db = SessionLocal()
+        try:
+            session_record = db.query(SessionModel).filter(SessionModel.id == ctx.session_id).first()
+            if not session_record:
+                raise Exception("Session was deleted during regeneration")
+
+            session_record.pose_status = ctx.pose_status
+            session_record.outputs = urls
+            session_record.thumbnail = ctx.thumbnail_url
+            for records in ctx.output_records:
+                if records:
+                    analytics_service.replace_records(db, records)
+            db.commit()
+            db.refresh(session_record)
+            db.expunge(session_record)
+        finally:
+            db.close()
+
+        history_cache.invalidate(ctx.session_id)
+        image_service.delete_generated_images(ctx.replaced)
+        return session_record
+
+    async def cleanup(self, ctx: RegenerationContext):
+        # 参考图属于会话，不能删除
+        pass
+
+
+# 单例实例
+generation_pipeline = GenerationPipeline()
+regeneration_pipeline = RegenerationPipeline()
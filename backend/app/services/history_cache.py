@@ -0,0 +1,80 @@
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+import hashlib
+
+import orjson
+
+from app.config import settings
+
+
+class HistoryCache:
+    """
+    历史记录响应缓存
+
+    缓存序列化后的 JSON 字节和对应的强 ETag。客户端携带匹配的 If-None-Match
+    时直接返回 304，不查询数据库也不重新序列化。
+
+    会话写入（生成、重新生成、批量任务、删除、清理）后调用 invalidate 失效：
+    列表页全部失效，详情只失效对应会话。
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Tuple[str, bytes]]" = OrderedDict()
+        self._version = 0  # 每次失效递增，防止失效前开始的查询把旧结果写回缓存
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def get(self, key: Hashable) -> Optional[Tuple[str, bytes]]:
+        entry = self._entries.get(key)
+        if entry:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: Hashable, payload: Any, version: int) -> Tuple[str, bytes]:
+        """
+        序列化并缓存响应
+
+        Args:
+            key: 缓存键
+            payload: 可被 orjson 序列化的响应内容
+            version: 开始查询时的 version，期间发生过失效则不写入缓存
+
+        Returns:
+            (etag, body)
+        """
+        body = orjson.dumps(payload)
+        entry = (f'"{hashlib.sha256(body).hexdigest()[:32]}"', body)
+        if version == self._version:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, session_id: Optional[str] = None):
+        """失效所有列表页和指定会话的详情，session_id 为空时清空全部"""
+        self._version += 1
+        if session_id is None:
+            self._entries.clear()
+            return
+        for key in list(self._entries):
+            if key[0] != "detail" or key[1] == session_id:
+                del self._entries[key]
+
+    @staticmethod
+    def matches(if_none_match: Optional[str], etag: str) -> bool:
+        """If-None-Match 是否命中（支持多个 ETag、弱比较前缀和 *）"""
+        if not if_none_match:
+            return False
+        for candidate in if_none_match.split(","):
+            candidate = candidate.strip()
+            if candidate == "*" or candidate.removeprefix("W/") == etag:
+                return True
+        return False
+
+
+# 单例实例
+history_cache = HistoryCache(settings.history_cache_size)
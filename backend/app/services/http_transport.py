@@ -0,0 +1,197 @@
+from google.genai import errors
+from google.genai._api_client import ApiClient, HttpRequest, HttpResponse, RequestJsonEncoder
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
+from app.config import settings
+import asyncio
+import functools
+import json
+import threading
+import time
+import httpx
+
+
+class GeminiTransport:
+    """
+    共享的 Gemini HTTP 传输层
+
+    SDK 默认每次请求都新建 requests.Session，无法复用连接，空闲后还要重新与
+    google_gemini_base_url 代理握手。这里用一个进程级 httpx.Client 替代：
+    连接池大小、keep-alive 过期时间和 HTTP/2 均由 Settings 配置。
+
+    同步的 SDK 调用在专用线程池中执行（线程数与连接数相同）。单次生成可能持续数分钟，
+    不能占用默认线程池，否则文件读写、删除和导出都要排在 Gemini 请求之后。
+    """
+
+    def __init__(self):
+        self.max_connections = settings.gemini_pool_max_connections
+        self._transport = httpx.HTTPTransport(
+            http2=settings.gemini_http2,
+            limits=httpx.Limits(
+                max_connections=settings.gemini_pool_max_connections,
+                max_keepalive_connections=settings.gemini_pool_max_keepalive,
+                keepalive_expiry=settings.gemini_keepalive_expiry,
+            ),
+        )
+        self.client = httpx.Client(
+            transport=self._transport,
+            timeout=httpx.Timeout(
+                settings.gemini_request_timeout,
+                connect=settings.gemini_connect_timeout,
+                pool=None,  # 连接池满时排队等待，而不是直接失败
+            ),
+        )
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings.gemini_pool_max_connections, thread_name_prefix="gemini"
+        )
+
+        # 连接池使用统计
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._peak_in_flight = 0
+        self._total_requests = 0
+        self._saturated_requests = 0
+        self._last_saturated_at = None
+        self._warmed_up = False
+
+    def install(self, api_client: ApiClient):
+        """将 SDK 客户端的非流式请求切换到共享连接池"""
+        original = api_client._request_unauthorized
+
+        def _request_unauthorized(http_request: HttpRequest, stream: bool = False) -> HttpResponse:
+            # 流式请求依赖 requests 的 iter_lines 语义，仍走 SDK 原始实现
+            if stream:
+                return original(http_request, stream=stream)
+            return self.send(http_request)
+
+        api_client._request_unauthorized = _request_unauthorized
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """在 Gemini 专用线程池中执行同步的 SDK 调用"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def send(self, http_request: HttpRequest) -> HttpResponse:
+        """通过共享连接池发送请求（同步，SDK 会在线程中调用）"""
+        data = http_request.data
+        if data and not isinstance(data, bytes):
+            data = json.dumps(data, cls=RequestJsonEncoder)
+
+        self._acquire()
+        try:
+            response = self.client.request(
+                http_request.method.upper(),
+                http_request.url,
+                headers=http_request.headers,
+                content=data or None,
+            )
+        finally:
+            self._release()
+
+        # 与 SDK 自身的请求路径一致：4xx 抛出 ClientError，5xx 抛出 ServerError
+        errors.APIError.raise_for_response(_ErrorResponse(response))
+
+        return HttpResponse(response.headers, [response.text])
+
+    async def warmup(self):
+        """预热连接，避免第一批请求承担 TLS 握手开销"""
+        count = settings.gemini_warmup_connections
+        if count <= 0:
+            return
+
+        # HTTP/2 下一条连接即可多路复用
+        if settings.gemini_http2:
+            count = 1
+
+        url = settings.google_gemini_base_url
+
+        def _ping():
+            try:
+                # 任何响应（包括 404）都说明连接已建立并进入连接池
+                self.client.head(url)
+                return True
+            except Exception as e:
+                print(f"⚠️ Gemini connection warm-up failed: {str(e)}")
+                return False
+
+        results = await asyncio.gather(
+            *[self.run(_ping) for _ in range(count)]
+        )
+        self._warmed_up = any(results)
+        if self._warmed_up:
+            print(f"✅ Gemini connection pool warmed up ({sum(results)} connection(s))")
+
+    def stats(self) -> Dict:
+        """连接池使用情况"""
+        connections = self._connections()
+        with self._lock:
+            return {
+                "http2": settings.gemini_http2,
+                "warmed_up": self._warmed_up,
+                "max_connections": self.max_connections,
+                "connections": len(connections),
+                "idle_connections": sum(1 for connection in connections if connection.is_idle()),
+                "in_flight": self._in_flight,
+                "peak_in_flight": self._peak_in_flight,
+                "total_requests": self._total_requests,
+                "saturated_requests": self._saturated_requests,
+                "saturated": self._saturated(connections),
+                "last_saturated_at": self._last_saturated_at,
+            }
+
+    def close(self):
+        """关闭所有连接"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.client.close()
+
+    def _connections(self) -> list:
+        """连接池中当前的连接（httpcore 连接对象）"""
+        pool = getattr(self._transport, "_pool", None)
+        return list(getattr(pool, "connections", []))
+
+    def _saturated(self, connections: list) -> bool:
+        """
+        连接数已达上限且没有可用连接（新请求需要排队）
+
+        HTTP/2 下一条连接可承载多个并发流，只有流也用满时 is_available() 才为 False
+        """
+        return len(connections) >= self.max_connections and not any(
+            connection.is_available() for connection in connections
+        )
+
+    def _acquire(self):
+        saturated = self._saturated(self._connections())
+        with self._lock:
+            # 发起时连接池已没有可用连接，本次请求需要排队等待
+            if saturated:
+                self._saturated_requests += 1
+                self._last_saturated_at = int(time.time() * 1000)
+                print(
+                    f"⚠️ Gemini connection pool saturated "
+                    f"({self.max_connections} connections busy, {self._in_flight} in flight)"
+                )
+            self._in_flight += 1
+            self._total_requests += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+
+
+class _ErrorResponse:
+    """让 SDK 的 APIError 能够解析 httpx 响应"""
+
+    def __init__(self, response: httpx.Response):
+        try:
+            body = response.json()
+        except ValueError:
+            body = {"message": response.text, "status": response.reason_phrase}
+        error = body.get("error", body) if isinstance(body, dict) else {"message": str(body)}
+        self.status_code = response.status_code
+        self.body_segments = [{"error": error}]
+
+
+# 单例实例
+gemini_transport = GeminiTransport()
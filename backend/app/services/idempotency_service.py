@@ -0,0 +1,117 @@
+from sqlalchemy.orm import Session as DBSession
+from typing import Awaitable, Dict, Optional
+import asyncio
+import hashlib
+import json
+import time
+
+from app.config import settings
+from app.models.database import IdempotencyRecord, SessionLocal
+
+
+class IdempotencyConflict(Exception):
+    """同一个 Idempotency-Key 被用于不同的请求内容"""
+
+
+class IdempotencyService:
+    """
+    生成请求去重
+
+    - Idempotency-Key：同一个 key 重试时返回原结果，或挂到正在进行的生成上
+    - Single-flight：内容完全相同（参数 + 上传文件哈希）的并发请求共享同一次生成
+
+    相同内容的请求在完成后再次提交不会被合并（temperature=1.0，重新生成是有意义的），
+    需要重试语义时请使用 Idempotency-Key。
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}  # fingerprint -> 生成任务
+        self._inflight_keys: Dict[str, str] = {}  # key -> fingerprint
+
+    def fingerprint(self, params: Dict, digests: Dict[str, str]) -> str:
+        """根据生成参数和上传文件内容摘要计算请求指纹"""
+        payload = json.dumps({"params": params, "files": digests}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def lookup(self, db: DBSession, key: str, fingerprint: str) -> Optional[str]:
+        """
+        查询 key 已完成的生成结果
+
+        Returns:
+            已完成的 session_id，未完成或不存在时返回 None
+
+        Raises:
+            IdempotencyConflict: key 已用于不同内容的请求
+        """
+        inflight_fingerprint = self._inflight_keys.get(key)
+        if inflight_fingerprint and inflight_fingerprint != fingerprint:
+            raise IdempotencyConflict("Idempotency-Key is already used by a different request")
+
+        record = db.query(IdempotencyRecord).filter(IdempotencyRecord.key == key).first()
+        if not record:
+            return None
+
+        # 过期的 key 可以重新使用
+        if record.created_at < int(time.time() * 1000) - settings.idempotency_ttl * 1000:
+            db.delete(record)
+            db.commit()
+            return None
+
+        if record.fingerprint != fingerprint:
+            raise IdempotencyConflict("Idempotency-Key is already used by a different request")
+
+        return record.session_id
+
+    def attach(self, fingerprint: str, key: Optional[str] = None) -> Optional[asyncio.Task]:
+        """返回相同内容正在进行的生成任务"""
+        task = self._inflight.get(fingerprint)
+        if task and key:
+            self._inflight_keys[key] = fingerprint
+        return task
+
+    def start(self, fingerprint: str, key: Optional[str], coro: Awaitable) -> asyncio.Task:
+        """
+        启动生成任务
+
+        任务独立于发起请求运行：发起方断开后，挂在同一任务上的其他请求仍能拿到结果。
+        """
+        task = asyncio.create_task(self._run(fingerprint, coro))
+        # 无人等待时也要取出异常，避免 "exception was never retrieved" 警告
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._inflight[fingerprint] = task
+        if key:
+            self._inflight_keys[key] = fingerprint
+        return task
+
+    def record(self, key: str, fingerprint: str, session_id: str):
+        """保存 key 对应的生成结果"""
+        db = SessionLocal()
+        try:
+            record = db.query(IdempotencyRecord).filter(IdempotencyRecord.key == key).first()
+            if not record:
+                record = IdempotencyRecord(key=key)
+                db.add(record)
+            record.fingerprint = fingerprint
+            record.session_id = session_id
+            record.created_at = int(time.time() * 1000)
+            db.commit()
+        finally:
+            db.close()
+
+    async def _run(self, fingerprint: str, coro: Awaitable):
+        try:
+            result = await coro
+            # 发起方可能已断开，由任务自身为所有挂在上面的 key 保存结果
+            for key, fp in list(self._inflight_keys.items()):
+                if fp == fingerprint:
+                    self.record(key, fingerprint, result.session_id)
+            return result
+        finally:
+            self._inflight.pop(fingerprint, None)
+            for key, fp in list(self._inflight_keys.items()):
+                if fp == fingerprint:
+                    self._inflight_keys.pop(key, None)
+
+
+# 单例实例
+idempotency_service = IdempotencyService()
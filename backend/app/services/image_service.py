@@ -1,10 +1,49 @@
 from PIL import Image
-from typing import Optional
+from typing import Dict, List, Optional, Union
+import asyncio
+import base64
 import io
 import os
 import uuid
+
+import aiofiles
 from pathlib import Path
 from app.config import settings
+from app.services.memory_budget import memory_budget
+from app.services.storage_service import storage_service
+
+
+# 支持的图片格式及其文件头（magic bytes）
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+    (b"BM", "BMP"),
+]
+
+
+class UploadValidationError(Exception):
+    """上传文件不合法（格式错误或超出大小限制）"""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class UploadBudget:
+    """单次请求的上传字节预算"""
+
+    def __init__(self, max_bytes: int = None):
+        self.max_bytes = max_bytes or settings.max_request_size
+        self.used = 0
+
+    def consume(self, size: int):
+        self.used += size
+        if self.used > self.max_bytes:
+            raise UploadValidationError(
+                f"Total upload size exceeds {self.max_bytes} bytes", status_code=413
+            )
 
 
 class ImageService:
@@ -12,31 +51,150 @@ class ImageService:
         # 确保目录存在
         Path(settings.upload_dir).mkdir(parents=True, exist_ok=True)
         Path(settings.output_dir).mkdir(parents=True, exist_ok=True)
+        Path(settings.reference_dir).mkdir(parents=True, exist_ok=True)
+
+    async def save_upload_stream(
+        self,
+        file,
+        budget: Optional[UploadBudget] = None,
+        directory: Optional[str] = None,
+        digest=None,
+    ) -> str:
+        """
+        分块保存上传的文件
+
+        边读边校验：首个分块即检查文件头，非图片直接拒绝；
+        单文件大小和整个请求的总大小在读取过程中实时检查，超限立即中止。
 
-    async def save_upload(self, file_bytes: bytes, filename: str) -> str:
-        """保存上传的文件"""
-        # 生成唯一文件名
-        ext = os.path.splitext(filename)[1]
-        unique_filename = f"{uuid.uuid4()}{ext}"
-        filepath = os.path.join(settings.upload_dir, unique_filename)
+        Args:
+            file: 上传文件（需支持 async read(size)，如 UploadFile）
+            budget: 本次请求的上传字节预算
+            directory: 保存目录，默认为 upload_dir
+            digest: 可选的 hashlib 对象，读取时同步计算内容摘要
 
-        # 保存文件
-        with open(filepath, "wb") as f:
-            f.write(file_bytes)
+        Returns:
+            保存后的文件路径
+        """
+        # 已知大小时提前拒绝，无需读取任何数据
+        size = getattr(file, "size", None)
+        if size is not None and size > settings.max_file_size:
+            raise UploadValidationError(
+                f"{file.filename} exceeds {settings.max_file_size} bytes", status_code=413
+            )
+
+        ext = os.path.splitext(file.filename or "")[1]
+        filepath = os.path.join(directory or settings.upload_dir, f"{uuid.uuid4()}{ext}")
+
+        written = 0
+        try:
+            async with aiofiles.open(filepath, "wb") as f:
+                while True:
+                    chunk = await file.read(settings.upload_chunk_size)
+                    if not chunk:
+                        break
+
+                    if written == 0 and not self.sniff_format(chunk):
+                        raise UploadValidationError(
+                            f"{file.filename} is not a supported image", status_code=415
+                        )
+
+                    written += len(chunk)
+                    if written > settings.max_file_size:
+                        raise UploadValidationError(
+                            f"{file.filename} exceeds {settings.max_file_size} bytes",
+                            status_code=413,
+                        )
+                    if budget:
+                        budget.consume(len(chunk))
+                    if digest:
+                        digest.update(chunk)
+
+                    await f.write(chunk)
+
+            if written == 0:
+                raise UploadValidationError(f"{file.filename} is empty")
+
+            if not await asyncio.to_thread(self.validate_image, filepath):
+                raise UploadValidationError(f"{file.filename} is not a valid image")
+
+        except Exception:
+            # 删除写了一半的文件
+            await self.cleanup_uploads([filepath])
+            raise
 
         return filepath
 
     async def load_image(self, filepath: str) -> Image.Image:
-        """加载图片"""
+        """加载图片（在线程中读取和解码）"""
+        try:
+            return await asyncio.to_thread(self._load_rgb, filepath)
+        except Exception as e:
+            raise Exception(f"Failed to load image: {str(e)}")
+
+    def _load_rgb(self, filepath: str) -> Image.Image:
+        img = Image.open(filepath)
+        # 转换为 RGB 模式
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        return img
+
+    async def load_reference(self, filepath: str) -> bytes:
+        """
+        加载参考图并重新编码（用于发送给 Gemini）
+
+        - PNG 或带透明通道的图片编码为 PNG（保留透明通道），其余编码为 JPEG（reference_jpeg_quality）
+        - 长边超过 reference_max_side 时缩小，JPEG 在解码时直接按比例缩小
+        - 解码在全局内存预算内进行，预算不足时等待
+        - 返回编码后的字节，解码后的像素在返回前释放，不会在整个生成期间常驻内存
+        """
         try:
-            img = Image.open(filepath)
-            # 转换为 RGB 模式
-            if img.mode != "RGB":
-                img = img.convert("RGB")
-            return img
+            size, pixels, nbytes = await asyncio.to_thread(self._plan_reference, filepath)
+            async with memory_budget.reserve(pixels, nbytes):
+                return await asyncio.to_thread(self._encode_reference, filepath, size)
         except Exception as e:
             raise Exception(f"Failed to load image: {str(e)}")
 
+    def _plan_reference(self, filepath: str):
+        """读取文件头，返回目标尺寸及解码峰值的像素数和字节数（不解码）"""
+        with Image.open(filepath) as img:
+            width, height = img.size
+            scale = 1.0
+            if settings.reference_max_side and max(width, height) > settings.reference_max_side:
+                scale = settings.reference_max_side / max(width, height)
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+
+            img.draft("RGB", size)
+            decoded = img.size[0] * img.size[1]
+            # Pillow 中单通道图片每像素 1 字节，其余模式每像素 4 字节
+            bytes_per_pixel = 1 if img.mode in ("1", "L", "P") else 4
+            converted = decoded if img.mode != "RGB" else 0
+            resized = size[0] * size[1] if img.size != size else 0
+
+        pixels = decoded + converted + resized
+        nbytes = decoded * bytes_per_pixel + (converted + resized) * 4
+        return size, pixels, nbytes
+
+    def _encode_reference(self, filepath: str, size) -> bytes:
+        with Image.open(filepath) as img:
+            # 无损格式的参考图（服装细节、透明背景的配饰）不做有损压缩
+            lossless = img.format == "PNG" or self._has_alpha(img)
+            img.draft("RGB", size)
+            mode = "RGBA" if self._has_alpha(img) else "RGB"
+            if img.mode != mode:
+                img = img.convert(mode)
+            if img.size != size:
+                img = img.resize(size, Image.LANCZOS)
+
+            buffer = io.BytesIO()
+            if lossless:
+                img.save(buffer, format="PNG")
+            else:
+                img.save(buffer, format="JPEG", quality=settings.reference_jpeg_quality)
+            return buffer.getvalue()
+
+    def _has_alpha(self, img: Image.Image) -> bool:
+        return img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+
     async def save_generated_image(
         self, image_bytes: bytes, session_id: str, index: int
     ) -> str:
@@ -44,15 +202,17 @@ class ImageService:
         filename = f"{session_id}_{index}.png"
         filepath = os.path.join(settings.output_dir, filename)
 
-        # 保存图片
-        with open(filepath, "wb") as f:
-            f.write(image_bytes)
+        # 原子写入，静态文件服务不会读到写了一半的图片
+        await storage_service.write_bytes(filepath, image_bytes)
 
         # 返回相对路径或 URL
         return f"/outputs/{filename}"
 
     async def create_thumbnail(self, image_bytes: bytes, size=(200, 300)) -> bytes:
-        """创建缩略图"""
+        """创建缩略图（在线程中解码和缩放）"""
+        return await asyncio.to_thread(self._thumbnail, image_bytes, size)
+
+    def _thumbnail(self, image_bytes: bytes, size) -> bytes:
         img = Image.open(io.BytesIO(image_bytes))
         img.thumbnail(size, Image.Resampling.LANCZOS)
 
@@ -61,6 +221,57 @@ class ImageService:
         img.save(buffer, format="PNG")
         return buffer.getvalue()
 
+    def create_placeholder(self, image_bytes: bytes) -> Optional[str]:
+        """生成低清占位图（约几百字节的 WebP data URI），客户端在原图加载完成前显示"""
+        try:
+            img = Image.open(io.BytesIO(image_bytes))
+            # JPEG 可直接按缩小比例解码
+            img.draft("RGB", (settings.placeholder_size, settings.placeholder_size))
+            img = img.convert("RGB")
+            img.thumbnail(
+                (settings.placeholder_size, settings.placeholder_size), Image.Resampling.BILINEAR
+            )
+
+            buffer = io.BytesIO()
+            img.save(buffer, format="WEBP", quality=settings.placeholder_quality)
+            return "data:image/webp;base64," + base64.b64encode(buffer.getvalue()).decode()
+        except Exception:
+            return None
+
+    async def save_candidates(
+        self, images: List[bytes], session_id: str, index: Union[int, str]
+    ) -> List[Dict]:
+        """
+        保存同一姿势的所有候选图片
+
+        第一张候选使用 {session_id}_{index}.png，其余为 {session_id}_{index}_c{n}.png；
+        所有文件并发写入，占位图在一次线程调用中批量生成。
+
+        Returns:
+            [{"output": url, "placeholder": data URI}]，顺序与 images 一致
+        """
+        urls = await asyncio.gather(
+            *[
+                self.save_generated_image(image, session_id, index if n == 0 else f"{index}_c{n}")
+                for n, image in enumerate(images)
+            ]
+        )
+        placeholders = await asyncio.to_thread(
+            lambda: [self.create_placeholder(image) for image in images]
+        )
+        return [
+            {"output": url, "placeholder": placeholder}
+            for url, placeholder in zip(urls, placeholders)
+        ]
+
+    def describe(self, image_bytes: bytes) -> Dict:
+        """图片字节大小和尺寸（只解析文件头，不解码像素）"""
+        try:
+            width, height = Image.open(io.BytesIO(image_bytes)).size
+        except Exception:
+            width, height = None, None
+        return {"byte_size": len(image_bytes), "width": width, "height": height}
+
     async def read_generated_image(self, url: str) -> bytes:
         """读取生成的图片"""
         # 从 URL 提取文件名
@@ -68,22 +279,58 @@ class ImageService:
         filepath = os.path.join(settings.output_dir, filename)
 
         # 读取文件
-        with open(filepath, "rb") as f:
-            return f.read()
+        return await storage_service.read_bytes(filepath)
+
+    def delete_generated_images(self, urls: list):
+        """批量删除生成的图片（后台执行）"""
+        storage_service.delete(
+            os.path.join(settings.output_dir, os.path.basename(url)) for url in urls if url
+        )
+
+    async def save_references(
+        self, session_id: str, upload_paths: Dict[str, str]
+    ) -> Dict[str, str]:
+        """
+        将上传的参考图移入会话参考图目录，供之后单独重新生成某个姿势
+
+        Returns:
+            类别 -> 相对于 reference_dir 的路径
+        """
+        directory = os.path.join(settings.reference_dir, session_id)
+
+        references = {}
+        for name, path in upload_paths.items():
+            filename = f"{name}{os.path.splitext(path)[1]}"
+            await storage_service.move(path, os.path.join(directory, filename))
+            references[name] = f"{session_id}/{filename}"
+
+        return references
+
+    def reference_path(self, relative_path: str) -> str:
+        """参考图相对路径转为文件路径"""
+        return os.path.join(settings.reference_dir, relative_path)
+
+    async def delete_references(self, session_id: str):
+        """删除会话的参考图（后台执行）"""
+        storage_service.delete([os.path.join(settings.reference_dir, session_id)])
 
     async def cleanup_uploads(self, filepaths: list):
-        """清理上传的临时文件"""
-        for filepath in filepaths:
-            try:
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-            except Exception as e:
-                print(f"Failed to cleanup {filepath}: {str(e)}")
-
-    def validate_image(self, file_bytes: bytes) -> bool:
-        """验证图片文件"""
+        """清理上传的临时文件（后台执行，已不存在的文件会被跳过）"""
+        storage_service.delete(filepaths)
+
+    def sniff_format(self, head: bytes) -> Optional[str]:
+        """根据文件头识别图片格式，无法识别返回 None"""
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            return "WEBP"
+        for signature, fmt in IMAGE_SIGNATURES:
+            if head.startswith(signature):
+                return fmt
+        return None
+
+    def validate_image(self, source: Union[bytes, str]) -> bool:
+        """验证图片文件（字节数据或文件路径）"""
         try:
-            img = Image.open(io.BytesIO(file_bytes))
+            img = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
             img.verify()
             return True
         except:
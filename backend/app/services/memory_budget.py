@@ -0,0 +1,77 @@
+from contextlib import asynccontextmanager
+import asyncio
+
+from app.config import settings
+
+
+class MemoryBudget:
+    """
+    解码图片的全局内存预算（所有进行中的请求共享）
+
+    - 解码前按图片尺寸预留像素数和字节数，超出预算时等待其他请求释放
+    - 单张图片超过整个预算时，等预算空闲后独占执行，不会永久等待
+    - 预算为 0 表示不限制
+    """
+
+    def __init__(self):
+        self.pixels = 0
+        self.bytes = 0
+        self.waiting = 0
+        self.peak_pixels = 0
+        self.peak_bytes = 0
+        self._changed = asyncio.Event()
+
+    @asynccontextmanager
+    async def reserve(self, pixels: int, nbytes: int):
+        """
+        预留解码所需的内存，退出时释放
+
+        用法：
+            async with memory_budget.reserve(pixels, nbytes):
+                ...  # 解码
+        """
+        if settings.image_budget_pixels:
+            pixels = min(pixels, settings.image_budget_pixels)
+        if settings.image_budget_bytes:
+            nbytes = min(nbytes, settings.image_budget_bytes)
+
+        while not self._fits(pixels, nbytes):
+            self.waiting += 1
+            try:
+                await self._changed.wait()
+            finally:
+                self.waiting -= 1
+
+        self.pixels += pixels
+        self.bytes += nbytes
+        self.peak_pixels = max(self.peak_pixels, self.pixels)
+        self.peak_bytes = max(self.peak_bytes, self.bytes)
+        try:
+            yield
+        finally:
+            self.pixels -= pixels
+            self.bytes -= nbytes
+            self._changed.set()
+            self._changed = asyncio.Event()
+
+    def stats(self) -> dict:
+        return {
+            "pixels": self.pixels,
+            "pixel_limit": settings.image_budget_pixels,
+            "bytes": self.bytes,
+            "byte_limit": settings.image_budget_bytes,
+            "waiting": self.waiting,
+            "peak_pixels": self.peak_pixels,
+            "peak_bytes": self.peak_bytes,
+        }
+
+    def _fits(self, pixels: int, nbytes: int) -> bool:
+        if settings.image_budget_pixels and self.pixels + pixels > settings.image_budget_pixels:
+            return False
+        if settings.image_budget_bytes and self.bytes + nbytes > settings.image_budget_bytes:
+            return False
+        return True
+
+
+# 单例实例
+memory_budget = MemoryBudget()
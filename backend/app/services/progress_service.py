@@ -0,0 +1,113 @@
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+import asyncio
+import json
+import time
+
+from app.config import settings
+
+
+class ProgressChannel:
+    """单个生成会话的进度事件缓冲"""
+
+    def __init__(self, session_id: str, fingerprint: Optional[str] = None):
+        self.session_id = session_id
+        self.fingerprint = fingerprint
+        self.events: List[Tuple[int, Dict]] = []
+        self.closed = False
+        self.created_at = time.monotonic()
+        self.closed_at = None
+        self.task: Optional[asyncio.Task] = None
+        self._waiter = asyncio.Event()
+
+    def publish(self, event: Dict) -> int:
+        event_id = len(self.events) + 1
+        self.events.append((event_id, event))
+        self._notify()
+        return event_id
+
+    def close(self):
+        self.closed = True
+        self.closed_at = time.monotonic()
+        self._notify()
+
+    def events_after(self, last_event_id: int) -> List[Tuple[int, Dict]]:
+        # 事件 ID 从 1 开始连续递增，可直接按下标切片
+        return self.events[max(last_event_id, 0):]
+
+    async def wait(self, last_event_id: int, timeout: float) -> bool:
+        """等待新事件，超时返回 False"""
+        if len(self.events) > last_event_id or self.closed:
+            return True
+        try:
+            await asyncio.wait_for(self._waiter.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def _notify(self):
+        self._waiter.set()
+        self._waiter = asyncio.Event()
+
+
+class ProgressService:
+    """
+    可恢复的 SSE 进度流
+
+    生成在后台任务中运行，不依赖响应的生命周期；事件带有单调递增的 id
+    并按会话缓存。客户端断线后携带 Last-Event-ID 重连即可补发错过的事件并继续接收。
+    """
+
+    def __init__(self):
+        self._channels: Dict[str, ProgressChannel] = {}
+
+    def create(self, session_id: str, fingerprint: Optional[str] = None) -> ProgressChannel:
+        self._purge()
+        channel = ProgressChannel(session_id, fingerprint)
+        self._channels[session_id] = channel
+        return channel
+
+    def get(self, session_id: str) -> Optional[ProgressChannel]:
+        self._purge()
+        return self._channels.get(session_id)
+
+    def find(self, fingerprint: str) -> Optional[ProgressChannel]:
+        """查找内容相同且仍在进行中的生成"""
+        for channel in self._channels.values():
+            if channel.fingerprint == fingerprint and not channel.closed:
+                return channel
+        return None
+
+    async def subscribe(
+        self, channel: ProgressChannel, last_event_id: int = 0
+    ) -> AsyncIterator[str]:
+        """补发 last_event_id 之后的事件，然后持续推送新事件和心跳"""
+        yield f"retry: {settings.sse_retry_ms}\n\n"
+
+        cursor = last_event_id
+        while True:
+            for event_id, event in channel.events_after(cursor):
+                yield f"id: {event_id}\ndata: {json.dumps(event)}\n\n"
+                cursor = event_id
+
+            if channel.closed:
+                return
+
+            if not await channel.wait(cursor, settings.sse_heartbeat_interval):
+                # 心跳不带 id，不进入缓冲，也不影响重连位置
+                elapsed = int(time.monotonic() - channel.created_at)
+                yield f"data: {json.dumps({'status': 'heartbeat', 'session_id': channel.session_id, 'elapsed_seconds': elapsed})}\n\n"
+
+    def _purge(self):
+        """清理结束已久的会话缓冲"""
+        now = time.monotonic()
+        expired = [
+            session_id
+            for session_id, channel in self._channels.items()
+            if channel.closed and now - channel.closed_at > settings.sse_retention
+        ]
+        for session_id in expired:
+            del self._channels[session_id]
+
+
+# 单例实例
+progress_service = ProgressService()
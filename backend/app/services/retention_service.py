@@ -0,0 +1,329 @@
+from sqlalchemy import func
+from sqlalchemy.orm import Session as DBSession
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import os
+import re
+import shutil
+import time
+
+from app.config import settings
+from app.models.database import BatchItem, Output, Session as SessionModel, SessionLocal
+from app.services.history_cache import history_cache
+from app.services.image_service import image_service
+from app.services.generation_pipeline import generation_pipeline
+from app.services.storage_service import TEMP_SUFFIX
+
+# 生成图片文件名以会话 ID 开头：{session_id}_{index}.png
+SESSION_FILE_PATTERN = re.compile(r"^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})_")
+
+
+class RetentionService:
+    """
+    存储清理
+
+    - 将 outputs / references 中的文件与 sessions 表对账，删除超过宽限期的孤立文件
+    - 删除 upload_dir 中残留的临时上传文件，以及原子写入中途退出时残留的临时文件
+    - 按保留天数和存储配额淘汰旧会话（age：最旧优先，lru：最久未访问优先）
+
+    目录分批遍历，文件属性读取和删除都在线程中执行，每批之后让出事件循环，大目录也不会阻塞服务。
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._running = False
+        self._accessed: Dict[str, int] = {}  # 会话最近访问时间，清理时批量写入数据库
+        self.last_report: Optional[Dict] = None
+        self.totals = {"runs": 0, "files_removed": 0, "bytes_reclaimed": 0, "sessions_evicted": 0}
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    def touch(self, session_id: str):
+        """记录会话被访问（用于 LRU 淘汰，不产生数据库写入）"""
+        self._accessed[session_id] = int(time.time() * 1000)
+
+    def start(self):
+        """启动后台定期清理"""
+        if settings.gc_interval > 0 and not self._task:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def run(self) -> Dict:
+        """执行一次完整清理，返回本次回收的空间"""
+        if self._running:
+            raise RuntimeError("Storage GC is already running")
+
+        self._running = True
+        started = time.monotonic()
+        report = {
+            "started_at": int(time.time() * 1000),
+            "files_scanned": 0,
+            "files_removed": 0,
+            "bytes_reclaimed": 0,
+            "sessions_evicted": 0,
+            "storage_bytes": 0,
+        }
+        db = SessionLocal()
+
+        try:
+            self._flush_access(db)
+            referenced = self._referenced_sessions(db)
+            cutoff = time.time() - settings.gc_grace_period
+
+            usage = await self._sweep_outputs(referenced, cutoff, report)
+            await self._sweep_references(referenced, cutoff, usage, report)
+            await self._sweep_uploads(cutoff, report)
+            await self._enforce_retention(db, usage, report)
+            if report["sessions_evicted"]:
+                history_cache.invalidate()
+
+            report["storage_bytes"] = sum(usage.values())
+            report["duration_ms"] = int((time.monotonic() - started) * 1000)
+
+            self.last_report = report
+            self.totals["runs"] += 1
+            for key in ("files_removed", "bytes_reclaimed", "sessions_evicted"):
+                self.totals[key] += report[key]
+
+            if report["files_removed"]:
+                print(
+                    f"🧹 Storage GC removed {report['files_removed']} file(s), "
+                    f"reclaimed {report['bytes_reclaimed']} bytes"
+                )
+            return report
+
+        finally:
+            db.close()
+            self._running = False
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Storage GC failed: {str(e)}")
+            await asyncio.sleep(settings.gc_interval)
+
+    def _flush_access(self, db: DBSession):
+        accessed, self._accessed = self._accessed, {}
+        for session_id, accessed_at in accessed.items():
+            db.query(SessionModel).filter(SessionModel.id == session_id).update(
+                {"last_accessed_at": accessed_at}, synchronize_session=False
+            )
+        db.commit()
+
+    def _referenced_sessions(self, db: DBSession) -> set:
+        """仍被引用的会话：已保存的会话、批量任务中尚未写入历史的会话、进行中的生成"""
+        referenced = {row[0] for row in db.query(SessionModel.id)}
+        referenced.update(row[0] for row in db.query(BatchItem.session_id).distinct())
+        referenced.update(generation_pipeline.active_sessions())
+        return referenced
+
+    async def _scan(self, directory: str):
+        """
+        分批遍历目录，每批的目录项和文件属性在线程中读取，之后让出事件循环
+
+        产出 (name, path, is_dir, mtime, size)，目录的 size 为其中所有文件的总大小
+        """
+        if not await asyncio.to_thread(os.path.isdir, directory):
+            return
+        entries = await asyncio.to_thread(os.scandir, directory)
+        try:
+            while True:
+                batch = await asyncio.to_thread(self._read_batch, entries)
+                if not batch:
+                    break
+                for item in batch:
+                    yield item
+        finally:
+            entries.close()
+
+    def _read_batch(self, entries) -> List[Tuple[str, str, bool, float, int]]:
+        batch = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            size = self._dir_size(entry.path) if is_dir else stat.st_size
+            batch.append((entry.name, entry.path, is_dir, stat.st_mtime, size))
+            if len(batch) >= settings.gc_batch_size:
+                break
+        return batch
+
+    async def _sweep_outputs(self, referenced: set, cutoff: float, report: Dict) -> Dict[str, int]:
+        """清理孤立的生成图片和残留的临时文件，返回每个会话占用的字节数"""
+        usage: Dict[str, int] = {}
+        orphans = []
+        async for name, path, is_dir, mtime, size in self._scan(settings.output_dir):
+            if is_dir:
+                continue
+
+            # 进程在原子写入中途退出时残留的临时文件（.{filename}.{随机后缀}.tmp）
+            if name.startswith(".") and name.endswith(TEMP_SUFFIX):
+                report["files_scanned"] += 1
+                if mtime <= cutoff:
+                    orphans.append(path)
+                continue
+
+            match = SESSION_FILE_PATTERN.match(name)
+            if not match:
+                continue
+            report["files_scanned"] += 1
+
+            session_id = match.group(1)
+            if session_id in referenced or mtime > cutoff:
+                usage[session_id] = usage.get(session_id, 0) + size
+                continue
+
+            orphans.append(path)
+
+        await self._remove_files(orphans, report)
+        return usage
+
+    async def _sweep_references(
+        self, referenced: set, cutoff: float, usage: Dict[str, int], report: Dict
+    ):
+        """清理孤立会话的参考图目录"""
+        async for name, path, is_dir, mtime, size in self._scan(settings.reference_dir):
+            if not is_dir:
+                continue
+            report["files_scanned"] += 1
+
+            if name in referenced or mtime > cutoff:
+                usage[name] = usage.get(name, 0) + size
+                continue
+
+            await asyncio.to_thread(shutil.rmtree, path, True)
+            report["files_removed"] += 1
+            report["bytes_reclaimed"] += size
+
+    async def _sweep_uploads(self, cutoff: float, report: Dict):
+        """清理进程异常退出时残留的临时上传文件"""
+        stale = []
+        async for name, path, is_dir, mtime, size in self._scan(settings.upload_dir):
+            if is_dir:
+                continue
+            report["files_scanned"] += 1
+            if mtime <= cutoff:
+                stale.append(path)
+
+        await self._remove_files(stale, report)
+
+    async def _enforce_retention(self, db: DBSession, usage: Dict[str, int], report: Dict):
+        """按保留天数和存储配额淘汰会话"""
+        candidates = db.query(
+            SessionModel.id, SessionModel.outputs, SessionModel.thumbnail, SessionModel.pose_status
+        )
+
+        # 超过最长保留天数
+        if settings.storage_max_age_days > 0:
+            expire_before = int(time.time() * 1000) - settings.storage_max_age_days * 86400000
+            expired = candidates.filter(SessionModel.timestamp < expire_before).all()
+            for count, row in enumerate(expired, 1):
+                await self._evict(db, row, usage, report)
+                if count % settings.gc_batch_size == 0:
+                    db.commit()
+                    await asyncio.sleep(0)
+            db.commit()
+
+        # 超出存储配额：只统计可淘汰的会话（已保存且未在生成中），
+        # 进行中的生成、尚未写入历史的批量会话和宽限期内的孤立文件不计入，
+        # 否则这部分占用超过配额时会把所有历史会话都删掉
+        quota = settings.storage_quota_bytes
+        if quota <= 0:
+            return
+
+        active = generation_pipeline.active_sessions()
+        evictable = {
+            row.id: usage.get(row.id, 0) for row in candidates if row.id not in active
+        }
+        total = sum(evictable.values())
+        if total <= quota:
+            return
+
+        if settings.storage_retention_policy == "lru":
+            order = func.coalesce(SessionModel.last_accessed_at, SessionModel.timestamp)
+        else:
+            order = SessionModel.timestamp
+
+        count = 0
+        for row in candidates.order_by(order.asc()).all():
+            if total <= quota:
+                break
+            if row.id not in evictable:
+                continue
+            total -= evictable.pop(row.id)
+            await self._evict(db, row, usage, report)
+            count += 1
+            if count % settings.gc_batch_size == 0:
+                db.commit()
+                await asyncio.sleep(0)
+        db.commit()
+
+    async def _evict(self, db: DBSession, row, usage: Dict[str, int], report: Dict):
+        """删除会话及其所有文件（不提交）"""
+        urls = set(row.outputs or [])
+        urls.update(pose["output"] for pose in row.pose_status or [] if pose.get("output"))
+        if row.thumbnail:
+            urls.add(row.thumbnail)
+
+        await self._remove_files(
+            [os.path.join(settings.output_dir, os.path.basename(url)) for url in urls], report
+        )
+
+        reference_dir = os.path.join(settings.reference_dir, row.id)
+        if await asyncio.to_thread(os.path.isdir, reference_dir):
+            report["bytes_reclaimed"] += await asyncio.to_thread(self._dir_size, reference_dir)
+            report["files_removed"] += 1
+            await image_service.delete_references(row.id)
+
+        db.query(Output).filter(Output.session_id == row.id).delete(synchronize_session=False)
+        db.query(SessionModel).filter(SessionModel.id == row.id).delete(synchronize_session=False)
+        usage.pop(row.id, None)
+        report["sessions_evicted"] += 1
+
+    async def _remove_files(self, paths: List[str], report: Dict):
+        """在线程中分批删除文件，已不存在的文件会被跳过"""
+        for offset in range(0, len(paths), settings.gc_batch_size):
+            removed, reclaimed = await asyncio.to_thread(
+                self._remove_batch, paths[offset:offset + settings.gc_batch_size]
+            )
+            report["files_removed"] += removed
+            report["bytes_reclaimed"] += reclaimed
+
+    def _remove_batch(self, paths: List[str]) -> Tuple[int, int]:
+        removed = reclaimed = 0
+        for path in paths:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+            reclaimed += size
+        return removed, reclaimed
+
+    def _dir_size(self, path: str) -> int:
+        total = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+
+# 单例实例
+retention_service = RetentionService()
@@ -0,0 +1,121 @@
+from typing import Iterable, List, Optional
+import asyncio
+import os
+import shutil
+import uuid
+
+import aiofiles
+import aiofiles.os
+
+from app.config import settings
+
+# 原子写入使用的临时文件后缀（写完后重命名为目标文件名）
+TEMP_SUFFIX = ".tmp"
+
+
+class StorageService:
+    """
+    非阻塞文件存储
+
+    - 所有文件操作都在线程池中执行，不阻塞事件循环
+    - 写入先写临时文件再重命名，StaticFiles 等读取方不会读到写了一半的文件
+    - fsync 策略可配置：none（不刷盘）、file（刷文件）、full（刷文件和所在目录，保证重命名持久化）
+    - 删除请求先进入队列，由后台任务按批次在一次线程切换中完成
+    """
+
+    def __init__(self):
+        self._pending: List[str] = []  # 待删除的文件或目录
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def write_bytes(self, path: str, data: bytes):
+        """原子写入文件"""
+        directory, filename = os.path.split(path)
+        temp_path = os.path.join(directory, f".{filename}.{uuid.uuid4().hex[:8]}{TEMP_SUFFIX}")
+        try:
+            async with aiofiles.open(temp_path, "wb") as f:
+                await f.write(data)
+                if settings.storage_fsync in ("file", "full"):
+                    await f.flush()
+                    await asyncio.to_thread(os.fsync, f.fileno())
+            await aiofiles.os.replace(temp_path, path)
+        except BaseException:
+            await asyncio.to_thread(self._remove, temp_path)
+            raise
+
+        if settings.storage_fsync == "full":
+            await asyncio.to_thread(self._fsync_dir, directory)
+
+    async def read_bytes(self, path: str) -> bytes:
+        async with aiofiles.open(path, "rb") as f:
+            return await f.read()
+
+    async def move(self, src: str, dst: str):
+        """移动文件，目标目录不存在时自动创建"""
+        await aiofiles.os.makedirs(os.path.dirname(dst), exist_ok=True)
+        await asyncio.to_thread(shutil.move, src, dst)
+
+    async def exists(self, path: str) -> bool:
+        return await aiofiles.os.path.exists(path)
+
+    def delete(self, paths: Iterable[str]):
+        """
+        提交删除（文件或目录），不等待完成
+
+        删除在后台按批次执行；需要确认已删除时调用 flush()。
+        """
+        self._pending.extend(path for path in paths if path)
+        if len(self._pending) >= settings.storage_delete_batch_size:
+            self._schedule(0)
+        else:
+            self._schedule(settings.storage_delete_interval)
+
+    async def flush(self):
+        """立即执行所有排队的删除"""
+        while self._pending:
+            batch, self._pending = self._pending, []
+            await asyncio.to_thread(self._remove_all, batch)
+
+    async def close(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
+
+    def _schedule(self, delay: float):
+        if self._flush_task and not self._flush_task.done():
+            if delay > 0:
+                return
+            self._flush_task.cancel()
+        self._flush_task = asyncio.create_task(self._flush_after(delay))
+
+    async def _flush_after(self, delay: float):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.flush()
+
+    def _remove_all(self, paths: List[str]):
+        for path in paths:
+            self._remove(path)
+
+    def _remove(self, path: str):
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Failed to delete {path}: {str(e)}")
+
+    def _fsync_dir(self, directory: str):
+        fd = os.open(directory or ".", os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+# 单例实例
+storage_service = StorageService()
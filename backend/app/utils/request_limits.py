@@ -0,0 +1,78 @@
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+import json
+
+
+class RequestSizeLimitMiddleware:
+    """
+    限制上传接口的请求体总大小
+
+    在 multipart 解析之前生效：Content-Length 超限时直接返回 413，
+    分块传输（无 Content-Length）时边接收边计数，超限后不再读取剩余数据。
+    """
+
+    def __init__(self, app: ASGIApp, max_size: int, path_prefix: str = "/api/generate"):
+        self.app = app
+        self.max_size = max_size
+        self.path_prefix = path_prefix
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or not scope["path"].startswith(self.path_prefix)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_size:
+            await self._reject(send)
+            return
+
+        received = 0
+        exceeded = False
+        response_started = False
+
+        async def limited_receive() -> Message:
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_size:
+                    exceeded = True
+                    # 模拟客户端断开，停止解析剩余请求体
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def limited_send(message: Message):
+            nonlocal response_started
+            if exceeded and not response_started:
+                # 用 413 替换下游因请求体被截断而产生的错误响应
+                if message["type"] == "http.response.start":
+                    response_started = True
+                    await self._reject(send)
+                return
+            if exceeded:
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        await self.app(scope, limited_receive, limited_send)
+
+    async def _reject(self, send: Send):
+        body = json.dumps(
+            {"detail": f"Request body exceeds {self.max_size} bytes"}
+        ).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 413,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,330 @@
+"""
+图片处理热路径的微基准测试
+
+只使用 CPU 和固定的合成图片（多种分辨率和格式），记录每个操作的耗时和峰值内存，
+并与 benchmarks/baseline.json 中保存的基线比较，超出阈值时以非零状态退出。
+
+用法（在 backend 目录下运行）：
+    python -m benchmarks.bench_pipeline                 # 与基线比较
+    python -m benchmarks.bench_pipeline --update        # 重新生成基线
+    python -m benchmarks.bench_pipeline -k thumbnail    # 只运行名称包含 thumbnail 的用例
+
+超出阈值的用例会重新测量（--confirm 次），每次都超出才算回归。
+
+基线与机器相关，更换机器或环境后请先用 --update 重新生成。
+"""
+
+from typing import Callable, Dict, List, Optional, Tuple
+import argparse
+import asyncio
+import base64
+import ctypes
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# 基准测试不访问 Gemini，只需满足配置校验
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+os.environ.setdefault("GOOGLE_GEMINI_BASE_URL", "http://127.0.0.1:9/")
+
+from google.genai import types  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from app.config import settings  # noqa: E402
+from app.services.gemini_service import gemini_service  # noqa: E402
+from app.services.image_service import image_service  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# 合成图片的分辨率（9:16，覆盖上传参考图和 1K / 2K 生成结果）
+RESOLUTIONS = {
+    "540p": (540, 960),
+    "1k": (768, 1365),
+    "2k": (1536, 2730),
+}
+FORMATS = ["JPEG", "PNG", "WEBP"]
+
+# 耗时很短的操作会被放大噪声，低于这些绝对差值的变化不算回归
+TIME_SLACK_MS = 2.0
+MEMORY_SLACK_KB = 1024
+
+
+def synthetic_image(size: Tuple[int, int]) -> Image.Image:
+    """固定内容的合成图片：渐变 + 条纹，压缩率接近真实照片而不是纯色"""
+    width, height = size
+    horizontal = Image.linear_gradient("L").resize(size)
+    vertical = Image.linear_gradient("L").rotate(90).resize(size)
+    radial = Image.radial_gradient("L").resize(size)
+    img = Image.merge("RGB", (horizontal, vertical, radial))
+
+    stripes = Image.new("L", (width, height), 0)
+    stripe = Image.new("L", (max(width // 64, 1), height), 96)
+    for x in range(0, width, max(width // 32, 2)):
+        stripes.paste(stripe, (x, 0))
+    return Image.composite(img.rotate(180), img, stripes)
+
+
+def encode(img: Image.Image, fmt: str) -> bytes:
+    buffer = io.BytesIO()
+    if fmt in ("JPEG", "WEBP"):
+        img.save(buffer, format=fmt, quality=90)
+    else:
+        img.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def gemini_response(image_bytes: bytes, as_base64: bool) -> types.GenerateContentResponse:
+    """模拟 Gemini 返回的单张图片响应"""
+    data = base64.b64encode(image_bytes).decode() if as_base64 else image_bytes
+    blob = types.Blob.model_construct(mime_type="image/png", data=data)
+    return types.GenerateContentResponse(
+        candidates=[
+            types.Candidate(
+                content=types.Content(role="model", parts=[types.Part(inline_data=blob)])
+            )
+        ]
+    )
+
+
+class Case:
+    def __init__(self, name: str, func: Callable[[], object], number: int = 1):
+        self.name = name
+        self.func = func
+        self.number = number  # 每个样本内的调用次数（用于非常快的操作）
+
+
+def build_cases(workdir: str) -> List[Case]:
+    loop = asyncio.new_event_loop()
+    run = loop.run_until_complete
+    cases = []
+
+    for label, size in RESOLUTIONS.items():
+        img = synthetic_image(size)
+        png_bytes = encode(img, "PNG")
+
+        for fmt in FORMATS:
+            data = encode(img, fmt)
+            path = os.path.join(workdir, f"{label}.{fmt.lower()}")
+            with open(path, "wb") as f:
+                f.write(data)
+
+            # load_image 对 RGB 图片是惰性的，调用方随后一定会解码，这里一并计入
+            cases.append(
+                Case(
+                    f"load_image/{fmt.lower()}/{label}",
+                    lambda path=path: run(image_service.load_image(path)).load(),
+                )
+            )
+            cases.append(
+                Case(
+                    f"load_reference/{fmt.lower()}/{label}",
+                    lambda path=path: run(image_service.load_reference(path)),
+                )
+            )
+            cases.append(
+                Case(
+                    f"create_thumbnail/{fmt.lower()}/{label}",
+                    lambda data=data: run(image_service.create_thumbnail(data)),
+                )
+            )
+
+        cases.append(
+            Case(
+                f"save_generated_image/png/{label}",
+                lambda data=png_bytes: run(
+                    image_service.save_generated_image(data, "benchmark", 0)
+                ),
+            )
+        )
+        for encoding, as_base64 in (("bytes", False), ("base64", True)):
+            response = gemini_response(png_bytes, as_base64)
+            cases.append(
+                Case(
+                    f"extract_image/{encoding}/{label}",
+                    lambda response=response: gemini_service._extract_image(response),
+                    number=10,
+                )
+            )
+
+    cases.append(
+        Case(
+            "build_prompt",
+            lambda: gemini_service._build_prompt(
+                pose_id="F9",
+                gender="female",
+                background_mode="white",
+                has_clothes=True,
+                has_accessories=False,
+            ),
+            number=1000,
+        )
+    )
+    return cases
+
+
+def _pin_malloc_thresholds():
+    """
+    固定 glibc 的 mmap / trim 阈值
+
+    默认的动态阈值会让释放后的大块内存留在堆中，之后的分配不再增加 RSS，
+    峰值内存会被严重低估。固定阈值后大块内存总是 mmap 分配、释放即归还。
+    """
+    try:
+        libc = ctypes.CDLL("libc.so.6")
+        libc.mallopt(-3, 128 * 1024)  # M_MMAP_THRESHOLD
+        libc.mallopt(-1, 128 * 1024)  # M_TRIM_THRESHOLD
+    except (OSError, AttributeError):
+        pass
+
+
+def _reset_peak_rss() -> bool:
+    """重置进程的峰值 RSS（Linux），不支持时返回 False"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _rss_kb() -> Dict[str, int]:
+    values = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(("VmRSS:", "VmHWM:")):
+                key, value = line.split(":")
+                values[key] = int(value.split()[0])
+    return values
+
+
+def measure_memory(case: Case) -> int:
+    """单次调用的峰值内存增量（KB）；包含 Pillow 在 C 层分配的像素缓冲"""
+    if _reset_peak_rss():
+        before = _rss_kb()["VmRSS"]
+        case.func()
+        return max(_rss_kb()["VmHWM"] - before, 0)
+
+    # 非 Linux：退化为只统计 Python 堆
+    tracemalloc.start()
+    case.func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak // 1024
+
+
+def measure_time(case: Case, repeat: int) -> float:
+    """每次调用的最短耗时（毫秒）；最小值受调度和其他进程干扰最小，比平均值稳定"""
+    case.func()  # 预热
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(case.number):
+            case.func()
+        samples.append((time.perf_counter() - started) * 1000 / case.number)
+    return min(samples)
+
+
+def measure(case: Case, repeat: int) -> Dict:
+    return {
+        "peak_kb": measure_memory(case),
+        "time_ms": round(measure_time(case, repeat), 4),
+    }
+
+
+def compare(
+    result: Dict,
+    baseline: Optional[Dict],
+    time_tolerance: float,
+    memory_tolerance: float,
+) -> List[str]:
+    """返回超出阈值的指标说明"""
+    if not baseline:
+        return []
+    failures = []
+    time_limit = max(
+        baseline["time_ms"] * (1 + time_tolerance), baseline["time_ms"] + TIME_SLACK_MS
+    )
+    if result["time_ms"] > time_limit:
+        failures.append(f"time {result['time_ms']:.3f}ms > {time_limit:.3f}ms")
+    memory_limit = max(
+        baseline["peak_kb"] * (1 + memory_tolerance), baseline["peak_kb"] + MEMORY_SLACK_KB
+    )
+    if result["peak_kb"] > memory_limit:
+        failures.append(f"memory {result['peak_kb']}KB > {memory_limit:.0f}KB")
+    return failures
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="图片处理热路径微基准测试")
+    parser.add_argument("--update", action="store_true", help="用本次结果覆盖基线")
+    parser.add_argument("-k", dest="keyword", help="只运行名称包含该关键字的用例")
+    parser.add_argument("--repeat", type=int, default=7, help="每个用例的计时样本数")
+    parser.add_argument(
+        "--confirm", type=int, default=2, help="超出阈值时重新测量的次数，每次都超出才算回归"
+    )
+    parser.add_argument("--time-tolerance", type=float, default=0.5, help="允许的耗时增幅")
+    parser.add_argument("--memory-tolerance", type=float, default=0.15, help="允许的峰值内存增幅")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="基线文件路径")
+    args = parser.parse_args(argv)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    _pin_malloc_thresholds()
+
+    results = {}
+    regressions = 0
+    with tempfile.TemporaryDirectory() as workdir:
+        settings.output_dir = workdir
+        cases = build_cases(workdir)
+        if args.keyword:
+            cases = [case for case in cases if args.keyword in case.name]
+
+        print(f"{'case':<36} {'time (ms)':>10} {'base':>10} {'peak (KB)':>10} {'base':>10}")
+        for case in cases:
+            result = measure(case, args.repeat)
+            baseline = baselines.get(case.name)
+            failures = [] if args.update else compare(
+                result, baseline, args.time_tolerance, args.memory_tolerance
+            )
+            # 偶发的调度抖动不应导致失败：重新测量，每次都超出阈值才算回归
+            for _ in range(args.confirm if failures else 0):
+                retry = measure(case, args.repeat)
+                result = {key: min(result[key], retry[key]) for key in result}
+                failures = compare(result, baseline, args.time_tolerance, args.memory_tolerance)
+                if not failures:
+                    break
+            results[case.name] = result
+
+            regressions += bool(failures)
+            print(
+                f"{case.name:<36} {result['time_ms']:>10.3f} "
+                f"{baseline['time_ms'] if baseline else '-':>10} "
+                f"{result['peak_kb']:>10} {baseline['peak_kb'] if baseline else '-':>10}"
+                + (f"  ❌ {'; '.join(failures)}" if failures else "")
+            )
+
+    if args.update:
+        baselines.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"✅ Baseline written to {args.baseline}")
+        return 0
+
+    if regressions:
+        print(f"❌ {regressions} benchmark(s) regressed past the baseline")
+        return 1
+
+    print("✅ No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,30 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+# 测试使用独立的临时目录和数据库，需在导入 app 之前设置
+_root = tempfile.mkdtemp(prefix="vm_studio_test_")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("GOOGLE_GEMINI_BASE_URL", "http://127.0.0.1:9/")
+os.environ["UPLOAD_DIR"] = os.path.join(_root, "uploads")
+os.environ["OUTPUT_DIR"] = os.path.join(_root, "outputs")
+os.environ["REFERENCE_DIR"] = os.path.join(_root, "references")
+os.environ["BATCH_DIR"] = os.path.join(_root, "batches")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_root, 'test.db')}"
+os.environ["GC_INTERVAL"] = "0"
+
+
+@pytest.fixture(autouse=True)
+def storage():
+    """每个测试使用空的数据库和存储目录"""
+    from app.config import settings
+    from app.models.database import Base, engine, init_db
+
+    Base.metadata.drop_all(bind=engine)
+    init_db()
+    for directory in (settings.output_dir, settings.reference_dir, settings.upload_dir):
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+    yield
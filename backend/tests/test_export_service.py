@@ -0,0 +1,151 @@
+import asyncio
+import io
+import os
+import uuid
+import zipfile
+
+import httpx
+import orjson
+
+from app.config import settings
+from app.main import app
+from app.models.database import Session as SessionModel, SessionLocal
+from app.services import export_service
+
+
+def add_session(timestamp: int, images: int = 2) -> tuple:
+    """保存一个带生成图片的会话，返回会话 ID 和归档内路径到文件内容的映射"""
+    session_id = str(uuid.uuid4())
+    files = {}
+    outputs = []
+    for idx in range(images):
+        filename = f"{session_id}_{idx}.png"
+        data = os.urandom(1000 + idx * 500)
+        with open(os.path.join(settings.output_dir, filename), "wb") as f:
+            f.write(data)
+        files[f"{session_id}/{filename}"] = data
+        outputs.append(f"/outputs/{filename}")
+
+    db = SessionLocal()
+    db.add(
+        SessionModel(
+            id=session_id,
+            timestamp=timestamp,
+            gender="female",
+            background_mode="white",
+            pose_ids=[f"p{idx}" for idx in range(images)],
+            model="test",
+            inputs={},
+            outputs=outputs,
+            pose_status=[
+                {"pose_id": f"p{idx}", "status": "done", "output": url}
+                for idx, url in enumerate(outputs)
+            ],
+        )
+    )
+    db.commit()
+    db.close()
+    return session_id, files
+
+
+def fetch(url: str, headers: dict = None) -> httpx.Response:
+    async def request():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get(url, headers=headers)
+
+    return asyncio.run(request())
+
+
+def assert_archive(body: bytes, files: dict, session_ids: list):
+    with zipfile.ZipFile(io.BytesIO(body)) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == ["manifest.json", *files]
+        for name, data in files.items():
+            assert archive.read(name) == data
+        manifest = orjson.loads(archive.read("manifest.json"))
+    assert [session["id"] for session in manifest["sessions"]] == session_ids
+    return manifest
+
+
+def test_export_round_trips_through_zipfile():
+    first, first_files = add_session(1000)
+    second, second_files = add_session(2000, images=1)
+
+    response = fetch(f"/api/export?session_id={first}&session_id={second}")
+
+    assert response.status_code == 200
+    assert int(response.headers["content-length"]) == len(response.content)
+    manifest = assert_archive(response.content, {**first_files, **second_files}, [first, second])
+    assert manifest["sessions"][0]["poses"][1]["files"] == [f"{first}/{first}_1.png"]
+
+
+def test_export_zip64_round_trips_through_zipfile(monkeypatch):
+    # 降低阈值，让后面的条目偏移和中央目录都走 zip64 扩展
+    monkeypatch.setattr(export_service, "ZIP64_LIMIT", 1500)
+    session_id, files = add_session(1000, images=3)
+    sessions = SessionLocal()
+    try:
+        archive = export_service.export_service.build(sessions.query(SessionModel).all())
+    finally:
+        sessions.close()
+    assert archive.zip64
+
+    response = fetch(f"/api/history/{session_id}/export")
+
+    assert response.status_code == 200
+    assert len(response.content) == archive.size
+    assert_archive(response.content, files, [session_id])
+
+
+def test_range_resume_matches_full_body():
+    session_id, _ = add_session(1000, images=3)
+    url = f"/api/history/{session_id}/export"
+    full = fetch(url)
+    etag = full.headers["etag"]
+
+    # 从某个文件中间恢复
+    start = len(full.content) // 2
+    response = fetch(url, {"Range": f"bytes={start}-", "If-Range": etag})
+
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes {start}-{len(full.content) - 1}/{len(full.content)}"
+    assert response.content == full.content[start:]
+
+    response = fetch(url, {"Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.content == full.content[100:200]
+
+    response = fetch(url, {"Range": "bytes=-50"})
+    assert response.status_code == 206
+    assert response.content == full.content[-50:]
+
+
+def test_range_out_of_bounds_is_416():
+    session_id, _ = add_session(1000)
+    url = f"/api/history/{session_id}/export"
+    size = len(fetch(url).content)
+
+    response = fetch(url, {"Range": f"bytes={size}-"})
+
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{size}"
+
+
+def test_stale_if_range_returns_full_archive():
+    session_id, files = add_session(1000)
+    url = f"/api/history/{session_id}/export"
+    etag = fetch(url).headers["etag"]
+
+    # 图片被重新生成，旧的 ETag 失效
+    name = next(iter(files))
+    files[name] = os.urandom(3000)
+    with open(os.path.join(settings.output_dir, os.path.basename(name)), "wb") as f:
+        f.write(files[name])
+
+    response = fetch(url, {"Range": "bytes=100-", "If-Range": etag})
+
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert "content-range" not in response.headers
+    assert_archive(response.content, files, [session_id])
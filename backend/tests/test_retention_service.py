@@ -0,0 +1,172 @@
+import asyncio
+import os
+import time
+import uuid
+
+import pytest
+
+from app.config import settings
+from app.models.database import Session as SessionModel, SessionLocal
+from app.services.generation_pipeline import GenerationContext, GenerationPipeline, generation_pipeline
+from app.services.retention_service import retention_service
+
+
+@pytest.fixture(autouse=True)
+def retention_settings(monkeypatch):
+    monkeypatch.setattr(settings, "gc_grace_period", 3600)
+    monkeypatch.setattr(settings, "storage_quota_bytes", 0)
+    monkeypatch.setattr(settings, "storage_max_age_days", 0)
+    monkeypatch.setattr(settings, "storage_retention_policy", "age")
+    yield
+
+
+def write_output(name: str, size: int, age: float = 0) -> str:
+    path = os.path.join(settings.output_dir, name)
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    if age:
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def add_session(timestamp: int, size: int) -> str:
+    """保存一个带一张生成图片的会话"""
+    session_id = str(uuid.uuid4())
+    write_output(f"{session_id}_0.png", size)
+    db = SessionLocal()
+    db.add(
+        SessionModel(
+            id=session_id,
+            timestamp=timestamp,
+            gender="female",
+            background_mode="white",
+            pose_ids=["p1"],
+            model="test",
+            inputs={},
+            outputs=[f"/outputs/{session_id}_0.png"],
+            pose_status=[{"pose_id": "p1", "status": "done", "output": f"/outputs/{session_id}_0.png"}],
+        )
+    )
+    db.commit()
+    db.close()
+    return session_id
+
+
+def session_ids() -> set:
+    db = SessionLocal()
+    try:
+        return {row[0] for row in db.query(SessionModel.id)}
+    finally:
+        db.close()
+
+
+def test_orphans_removed_only_after_grace_period():
+    saved = add_session(1000, 10)
+    stale = write_output(f"{uuid.uuid4()}_0.png", 20, age=7200)
+    fresh = write_output(f"{uuid.uuid4()}_0.png", 30)
+    unrelated = write_output("notes.txt", 40, age=7200)
+
+    report = asyncio.run(retention_service.run())
+
+    assert not os.path.exists(stale)
+    assert os.path.exists(fresh)
+    assert os.path.exists(unrelated)
+    assert os.path.exists(os.path.join(settings.output_dir, f"{saved}_0.png"))
+    assert report["files_removed"] == 1
+    assert report["bytes_reclaimed"] == 20
+
+
+def test_stale_temp_files_removed():
+    session_id = str(uuid.uuid4())
+    stale = write_output(f".{session_id}_0.png.1a2b3c4d.tmp", 10, age=7200)
+    writing = write_output(f".{session_id}_1.png.5e6f7a8b.tmp", 10)
+
+    asyncio.run(retention_service.run())
+
+    assert not os.path.exists(stale)
+    assert os.path.exists(writing)
+
+
+def test_active_session_files_are_not_orphans(monkeypatch):
+    session_id = str(uuid.uuid4())
+    path = write_output(f"{session_id}_0.png", 10, age=7200)
+    monkeypatch.setitem(generation_pipeline._active, session_id, 1)
+
+    asyncio.run(retention_service.run())
+
+    assert os.path.exists(path)
+
+
+def test_running_generation_is_protected(monkeypatch):
+    """非流式生成和重新生成在写入数据库前运行清理，已保存的图片也不会被删除"""
+    monkeypatch.setattr(settings, "gc_grace_period", 0)
+    ctx = GenerationContext({}, {}, {"pose_ids": ["p1"], "model": "test"})
+    path = os.path.join(settings.output_dir, f"{ctx.session_id}_0.png")
+
+    class Ticket:
+        async def wait(self, on_position=None):
+            pass
+
+        def release(self):
+            pass
+
+    class Pipeline(GenerationPipeline):
+        async def ingest(self, ctx):
+            pass
+
+        async def generate_pose(self, ctx, idx, pose_id):
+            write_output(os.path.basename(path), 10, age=60)
+            return {"pose_id": pose_id, "image": None, "images": [], "error": "x", "latency_ms": 0}
+
+        async def save_pose(self, ctx, idx, result, emit):
+            pass
+
+        async def persist(self, ctx):
+            await retention_service.run()
+            return os.path.exists(path)
+
+    assert asyncio.run(Pipeline().run(ctx, Ticket())) is True
+    assert ctx.session_id not in generation_pipeline.active_sessions()
+
+
+def test_quota_evicts_oldest_sessions_first(monkeypatch):
+    monkeypatch.setattr(settings, "storage_quota_bytes", 250)
+    oldest = add_session(1000, 100)
+    middle = add_session(2000, 100)
+    newest = add_session(3000, 100)
+
+    report = asyncio.run(retention_service.run())
+
+    assert session_ids() == {middle, newest}
+    assert not os.path.exists(os.path.join(settings.output_dir, f"{oldest}_0.png"))
+    assert report["sessions_evicted"] == 1
+    assert report["storage_bytes"] == 200
+
+
+def test_quota_lru_evicts_least_recently_accessed(monkeypatch):
+    monkeypatch.setattr(settings, "storage_quota_bytes", 250)
+    monkeypatch.setattr(settings, "storage_retention_policy", "lru")
+    oldest = add_session(1000, 100)
+    middle = add_session(2000, 100)
+    newest = add_session(3000, 100)
+    retention_service.touch(oldest)
+
+    asyncio.run(retention_service.run())
+
+    assert session_ids() == {oldest, newest}
+
+
+def test_quota_ignores_usage_that_cannot_be_evicted(monkeypatch):
+    monkeypatch.setattr(settings, "storage_quota_bytes", 250)
+    saved = add_session(1000, 100)
+    # 宽限期内的孤立文件和进行中的生成都不能淘汰，不应导致历史会话被删除
+    write_output(f"{uuid.uuid4()}_0.png", 1000)
+    active = str(uuid.uuid4())
+    write_output(f"{active}_0.png", 1000)
+    monkeypatch.setitem(generation_pipeline._active, active, 1)
+
+    report = asyncio.run(retention_service.run())
+
+    assert session_ids() == {saved}
+    assert report["sessions_evicted"] == 0